@@ -0,0 +1,386 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyBudget pytest plugin
+Times every decorated function called by each test of a pytest session and
+checks them against the budgets the test declares: at most so many calls, a
+p95 latency, bytes allocated per call. A test going over a budget fails, or
+is only reported with --budget-report-only, and --budget-summary writes
+every test's numbers as JSON, to track them from run to run.
+
+Usage, with this module importable:
+
+  python -m pytest -p pyBudget --budget-summary=budgets.json
+
+or pytest_plugins = ['pyBudget'] in the conftest.py of the test root, then
+
+  @pytest.mark.pyBudget('parse', maxCalls=100, maxP95Ms=2.0)
+  def test_parse():
+    ...
+
+  def test_load(pyBudget):
+    pyBudget('load*', maxAllocated=1 << 20)
+    ...
+
+Function names are matched, with fnmatch patterns, against the qualified
+name of the function or its last parts.
+
+Created by unsignedzero (David Tran)
+'''
+
+import json
+import threading
+from fnmatch import fnmatchcase
+from time import time
+
+import pytest
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+try:
+  from .pyDecorator import pyDecorator
+  from .pyHistogram import pyHistogram
+except (ImportError, ValueError):
+  from pyDecorator import pyDecorator
+  from pyHistogram import pyHistogram
+
+class pyBudget(object):
+  r'''
+  The plugin registered for a session. It is a pyDecorator hook, see
+  pyDecorator.addHook, recording the calls made while a test runs, its
+  setup and teardown left out, into histograms of its own.
+
+  A budget is a dict of the limits set, among
+
+      maxCalls         Calls of the function during the test.
+      maxP95Ms         95th percentile of their latency, in milliseconds.
+      maxAllocated     Peak bytes traced by tracemalloc while one call
+                       runs, over those traced when it started, worst call.
+
+  Warning:
+
+  Allocations are traced process wide, so other threads allocating during a
+  call count against it, and a thread starting a call resets the peak that
+  calls running in other threads would see. Before Python 3.9, without
+  tracemalloc.reset_peak, a call is charged the bytes it allocated and still
+  holds when it returns instead. They are not measured without tracemalloc,
+  that is before Python 3.4, and such budgets are then never exceeded.
+  '''
+
+  _version = 1
+
+  def __init__(self, config):
+    r'''
+    Initializes the plugin from the command line options of config.
+    '''
+
+    self.summaryPath = config.getoption('budget_summary')
+    self.reportOnly = config.getoption('budget_report_only')
+    self.traceAllocations = config.getoption('budget_allocations')
+
+    self.tests = {}           # node id -> summary of the test
+    self.started = time()
+
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._recording = False
+    self._budgets = []
+    self._histograms = {}
+    self._allocated = {}
+    self._tracing = False
+    self._stopTracing = False
+
+
+  ###########################################################################
+  # Hook methods
+
+  def callStarted(self, name):
+    r'''
+    pyDecorator hook method. Notes the traced memory when allocations are
+    traced and starts a new peak.
+    '''
+
+    if not self._recording or not self._tracing:
+      return
+
+    try:
+      stack = self._local.stack
+    except AttributeError:
+      stack = self._local.stack = []
+
+    current, peak = tracemalloc.get_traced_memory()
+
+    if hasattr(tracemalloc, 'reset_peak'):
+      # Resetting forgets the peak of the call we are in, keep it
+      if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+      tracemalloc.reset_peak()
+      current = tracemalloc.get_traced_memory()[0]
+
+    # The traced memory when the call started and its peak so far
+    stack.append([current, current])
+
+
+  def callEnded(self, name, elapsed, error):
+    r'''
+    pyDecorator hook method. Records the call in the histogram of name.
+    '''
+
+    if not self._recording:
+      return
+
+    histogram = self._histograms.get(name)
+    if histogram is None:
+      histogram = self._histograms.setdefault(name, pyHistogram(name))
+    histogram.record(elapsed)
+
+    stack = getattr(self._local, 'stack', None)
+    if not self._tracing or not stack:
+      return
+
+    start, peak = stack.pop()
+    current, traced = tracemalloc.get_traced_memory()
+
+    if hasattr(tracemalloc, 'reset_peak'):
+      peak = max(peak, traced)
+      if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    else:
+      peak = current
+
+    allocated = peak - start
+    with self._lock:
+      if allocated > self._allocated.get(name, 0):
+        self._allocated[name] = allocated
+
+
+  ###########################################################################
+  # Budgets
+
+  def budget(self, name, maxCalls=None, maxP95Ms=None, maxAllocated=None):
+    r'''
+    Adds a budget for the functions matching name to the running test.
+    This is what the pyBudget fixture returns.
+    '''
+
+    self._budgets.append((name, { 'maxCalls': maxCalls,
+      'maxP95Ms': maxP95Ms, 'maxAllocated': maxAllocated }))
+
+    if maxAllocated is not None:
+      self._startTracing()
+
+
+  def _startTracing(self):
+    r'''
+    Starts tracing allocations for the rest of the running test.
+    '''
+
+    if tracemalloc is None or self._tracing:
+      return
+
+    self._stopTracing = not tracemalloc.is_tracing()
+    if self._stopTracing:
+      tracemalloc.start()
+    self._tracing = True
+
+
+  @staticmethod
+  def _matches(qualname, pattern):
+    r'''
+    Returns True if pattern matches qualname or its last dotted parts.
+    '''
+
+    return fnmatchcase(qualname, pattern) or \
+      fnmatchcase(qualname, '*.' + pattern)
+
+
+  def _measure(self):
+    r'''
+    Returns, by function name, the calls, latencies and allocations of the
+    test that just ran.
+    '''
+
+    functions = {}
+
+    for name, histogram in sorted(self._histograms.items()):
+      snap = histogram.snapshot()
+      if not snap['count']:
+        continue
+
+      functions[name] = { 'calls': snap['count'], 'mean': snap['mean'],
+        'p95': histogram.percentile(0.95), 'max': snap['max'],
+        'allocated': self._allocated.get(name) if self._tracing else None }
+
+    return functions
+
+
+  def _check(self, functions):
+    r'''
+    Returns the budgets the test went over, as text.
+    '''
+
+    violations = []
+
+    for pattern, limits in self._budgets:
+      for name, stats in sorted(functions.items()):
+        if not pyBudget._matches(name, pattern):
+          continue
+
+        if limits['maxCalls'] is not None and \
+            stats['calls'] > limits['maxCalls']:
+          violations.append('%s: %i calls, budget %i' % (name,
+            stats['calls'], limits['maxCalls']))
+
+        if limits['maxP95Ms'] is not None and \
+            stats['p95'] * 1e3 > limits['maxP95Ms']:
+          violations.append('%s: p95 %.3fms, budget %.3fms' % (name,
+            stats['p95'] * 1e3, limits['maxP95Ms']))
+
+        if limits['maxAllocated'] is not None and \
+            stats['allocated'] is not None and \
+            stats['allocated'] > limits['maxAllocated']:
+          violations.append('%s: %i bytes allocated, budget %i' % (name,
+            stats['allocated'], limits['maxAllocated']))
+
+    return violations
+
+
+  ###########################################################################
+  # pytest hooks
+
+  def pytest_sessionstart(self, session):
+    pyDecorator.addHook(self)
+
+
+  @pytest.hookimpl(hookwrapper=True)
+  def pytest_runtest_call(self, item):
+    r'''
+    Records the calls made by the test body under the budgets of its
+    pyBudget marks.
+    '''
+
+    self._budgets = []
+    self._histograms = {}
+    self._allocated = {}
+
+    for mark in item.iter_markers('pyBudget'):
+      self.budget(*mark.args, **mark.kwargs)
+    if self.traceAllocations:
+      self._startTracing()
+
+    self._recording = True
+    try:
+      yield
+    finally:
+      self._recording = False
+
+
+  @pytest.hookimpl(hookwrapper=True)
+  def pytest_runtest_makereport(self, item, call):
+    r'''
+    Checks the budgets once the test body ran, failing a test that passed
+    but went over one.
+    '''
+
+    outcome = yield
+    report = outcome.get_result()
+
+    if report.when != 'call':
+      return
+
+    functions = self._measure()
+    violations = self._check(functions)
+
+    if self._tracing:
+      if self._stopTracing:
+        tracemalloc.stop()
+      self._tracing = False
+
+    self.tests[item.nodeid] = { 'functions': functions,
+      'budgets': [ dict(limits, name=name) for name, limits in self._budgets ],
+      'violations': violations }
+
+    if violations and report.passed and not self.reportOnly:
+      report.outcome = 'failed'
+      report.longrepr = 'Over its pyDecorator budgets:\n  ' + \
+        '\n  '.join(violations)
+
+
+  def pytest_terminal_summary(self, terminalreporter):
+    r'''
+    Lists the budgets gone over.
+    '''
+
+    over = [ (nodeid, test['violations'])
+      for nodeid, test in sorted(self.tests.items()) if test['violations'] ]
+
+    if not over:
+      return
+
+    terminalreporter.section('pyDecorator budgets')
+    for nodeid, violations in over:
+      terminalreporter.write_line(nodeid)
+      for violation in violations:
+        terminalreporter.write_line('  ' + violation)
+
+
+  def pytest_sessionfinish(self, session, exitstatus):
+    r'''
+    Stops recording and writes the summary, if asked for. It holds every
+    test's numbers and budgets, the session totals of each function and the
+    calls over their slowMs budget.
+    '''
+
+    pyDecorator.removeHook(self)
+
+    if not self.summaryPath:
+      return
+
+    totals = {}
+    for snap in pyDecorator.latencySnapshot():
+      totals[snap['name']] = dict( (key, value)
+        for key, value in snap.items() if key not in ('name', 'counts') )
+
+    with open(self.summaryPath, 'w') as output:
+      json.dump({ 'version': pyBudget._version, 'started': self.started,
+        'ended': time(), 'tests': self.tests, 'functions': totals,
+        'slowCalls': pyDecorator.budgetViolations() }, output,
+        indent=1, sort_keys=True)
+
+# End of pyBudget class
+
+###########################################################################
+# Plugin entry points
+
+def pytest_addoption(parser):
+  group = parser.getgroup('pyBudget', 'pyDecorator budgets')
+  group.addoption('--budget-summary', dest='budget_summary', default=None,
+    metavar='PATH', help='write the calls, latencies and allocations of '
+    'decorated functions per test to PATH, as JSON')
+  group.addoption('--budget-report-only', dest='budget_report_only',
+    action='store_true', help='report tests over their budgets without '
+    'failing them')
+  group.addoption('--budget-allocations', dest='budget_allocations',
+    action='store_true', help='trace allocations in every test, not only '
+    'those with an allocation budget')
+
+
+def pytest_configure(config):
+  config.addinivalue_line('markers', 'pyBudget(name, maxCalls=None, '
+    'maxP95Ms=None, maxAllocated=None): budget of the decorated functions '
+    'matching name during the test')
+  config.pluginmanager.register(pyBudget(config), 'pyBudgetSession')
+
+
+@pytest.fixture(name='pyBudget')
+def _pyBudgetFixture(request):
+  r'''
+  Returns the function declaring a budget of the running test, see
+  pyBudget.budget.
+  '''
+
+  return request.config.pluginmanager.getplugin('pyBudgetSession').budget
@@ -15,18 +15,122 @@ Created by unsignedzero (David Tran)
 Version 0.8.2.0
 '''
 
+import gc
 import logging
-from pprint import pprint
-from sys import version_info
-
-# We don't require the frame support but it helps
+from copy import copy
+from inspect import currentframe
+from itertools import islice
+from os.path import abspath, splitext
+from heapq import heappush, heapreplace
+from fnmatch import fnmatchcase
+from functools import partial
+from pprint import pformat, pprint
+from random import getrandbits, random
+from sys import exc_info, modules, version_info
+from traceback import format_stack
+from collections import deque, namedtuple
+from threading import Lock, RLock, current_thread, local
+from types import FunctionType, MethodType
+from weakref import WeakKeyDictionary, ref
+
+# We don't require the frame support but it helps. Every frame backend
+# returns the frame depth levels above its caller, like sys._getframe, and
+# raises ValueError past the bottom of the stack. The fastest that works is
+# put in _getframe at import, None when there are no frames, see
+# pyDecorator.setFrameBackend.
 try:
   # Will work on mostly all CPython builds
-  from sys import _getframe
+  from sys import _getframe as _frameByGetframe
+except ImportError:
+  _frameByGetframe = None
+
+try:
+  from traceback import walk_stack
+except ImportError:
+  walk_stack = None
+
+def _frameAbove(frame, depth):
+  r'''
+  Returns the frame depth levels above frame.
+  '''
+
+  if walk_stack is not None:
+    for frame, line in islice(walk_stack(frame), depth, None):
+      return frame
+    raise ValueError('call stack is not deep enough')
+
+  for each in range(depth):
+    if frame is None:
+      break
+    frame = frame.f_back
+
+  if frame is None:
+    raise ValueError('call stack is not deep enough')
+  return frame
+
+def _frameByCurrentframe(depth=0):
+  r'''
+  Frame backend on inspect.currentframe, None where it is not supported.
+  '''
+
+  frame = currentframe()
+  if frame is None:
+    raise ValueError('frames are not available')
+
+  # One more level skips this function
+  return _frameAbove(frame, depth + 1)
+
+def _frameByTraceback(depth=0):
+  r'''
+  Frame backend on the traceback of a caught exception, which has the frame
+  even where the interpreter has no other way to get at it.
+  '''
+
+  try:
+    raise ZeroDivisionError
+  except ZeroDivisionError:
+    frame = exc_info()[2].tb_frame
+
+  return _frameAbove(frame, depth + 1)
+
+_getframe = _frameByGetframe
+
+try:
+  from .pyEventBuffer import pyEventBuffer
+  from .pyHistogram import pyHistogram
+except (ImportError, ValueError):
+  from pyEventBuffer import pyEventBuffer
+  from pyHistogram import pyHistogram
+
+try:
+  from threading import get_ident
+except ImportError:
+  from thread import get_ident
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+# Spans need contextvars, Python 3.7+
+try:
+  from contextvars import ContextVar, copy_context
+  _spanContext = ContextVar('pyDecoratorSpan', default=None)
 except ImportError:
-  # All others here...
-  from sys import callstats
-  _getframe = None
+  _spanContext = None
+
+# Python 2 has no async functions
+try:
+  from inspect import iscoroutinefunction
+except ImportError:
+  def iscoroutinefunction(func):
+    return False
+
+# Call timing uses the best clock this interpreter offers
+try:
+  from time import perf_counter as _clock
+except ImportError:
+  from time import time as _clock
 
 # Set default input to be input even in Python 2.X
 if version_info[0] == 2:
@@ -70,6 +174,99 @@ class pyDecorator(object):
                            built in functions with respect to the current
                            frame
 
+      _captureLocals   Set True to print the locals of the frame that raised
+                       when a decorated call fails. Successful calls never
+                       pay for it.
+
+      _diffLocals      Set True so that, from _verbosity 2, printCurFrame
+                       prints only the locals added, changed or removed since
+                       the last dump of the same frame.
+
+      _diffGlobals     Set True so that printGlobals and printBuiltins print
+                       only what changed since their last call for the same
+                       module, and a summary.
+
+      _foldRecursion   Set True to print only the outermost call of a
+                       recursive function, followed by a summary of the calls
+                       made under it per depth.
+
+      _foldTopK        How many of the most expensive recursive calls the
+                       summary above lists. 0 lists none.
+
+      _rateLimit       How many calls per second of each function may be
+                       printed, 0 for no limit. Calls over the limit are
+                       still counted and timed. See setRateLimit for limits
+                       on single functions.
+
+      _collapseRepeats Set True so that a call repeating the previous one,
+                       same function, arguments and result, with nothing
+                       printed in between, is only counted. The count is
+                       printed before the next thing that is.
+
+      _snapshot        How args and kwargs are kept for printing from
+                       _verbosity 1. See setSnapshot for single functions.
+
+                       render    - Printed with the start record, as the
+                                   function gets them. The default.
+
+                       reference - Nothing is copied, they are printed when
+                                   the call ends, as the function left them.
+
+                       shallow   - Shallow copies are printed when the call
+                                   ends. Cheap, misses nested changes.
+
+                       pickle    - A pickled deep copy is printed when the
+                                   call ends. Values that can not be pickled
+                                   are rendered at the start instead.
+
+                       Snapshots are taken on the calling thread. With
+                       _buffered set, reference and pickle snapshots are
+                       rendered by the flusher thread, reference ones then
+                       showing the arguments as they are when flushed.
+                       Otherwise, or while _collapseRepeats needs the text,
+                       they are rendered on the calling thread as well.
+
+      _sampleEvery     Print only one call in every _sampleEvery. The others
+                       are still counted and timed.
+
+      _echo            Set False to write records to the logfile only, not to
+                       output.
+
+      _buffered        Set True so that each thread appends what it prints to
+                       its own buffer, and a flusher thread writes the
+                       buffers merged in timestamp order. See setBuffered.
+
+      _spans           Set True to give every decorated call a span, ids held
+                       in contextvars that follow the work into executors and
+                       asyncio tasks, shown on every record. See setSpans.
+
+      _tailSampling    Set True to hold back the records of every call tree,
+                       from the outermost decorated call down, and print the
+                       tree only when its root returns if one of its calls
+                       raised, the root was slow or it is picked at random.
+                       See setTailSampling.
+
+      _overheadBudget  The share of the run time of decorated functions
+                       pyDecorator may spend on itself, 0.02 for 2%, 0 for no
+                       budget. Over it, the governor steps the verbosity
+                       calls are printed with down, then prints fewer of
+                       them, then stops the echo, and undoes its steps once
+                       overhead falls. The settings themselves are left as
+                       they were set. See setOverheadBudget.
+
+      _frameBackend    How the stack features get at frames, picked at import
+                       as the fastest that works on this interpreter.
+
+                       getframe     - sys._getframe, CPython and PyPy.
+
+                       currentframe - inspect.currentframe, walking up.
+
+                       traceback    - The frame of a caught exception,
+                                      walking up with traceback.walk_stack.
+
+                       none         - No frames. printCurStack only prints
+                                      the call count.
+
   Warning:
 
   For attributes, the next time it is set will OVERRIDE the last value.
@@ -80,19 +277,125 @@ class pyDecorator(object):
   This has more notable effects when _verbosity is changed and a new function
   is decorated. This will change the logging output for the rest of the
   debugging session.
+
+  Every thread keeps its own call counters and takes call numbers in blocks,
+  so call numbers are unique but only in order within a thread. Collapsing
+  repeated calls compares calls of all threads as one stream.
   '''
 
-  # Private static counters
-  _recursionLevel = 0    # States how many times this function is repeatedly
-                         # called. Useful when applying this on recursive
-                         # functions
-  _callCount = 0         # States the number of times this is called since
-                         # start of execution
+  # Private per thread counters, see _state. Every thread counts the calls
+  # it made and how deep it is in decorated calls (its recursion level), and
+  # takes call numbers in blocks, so no counter is shared between threads.
+  # Use getCallCount and getRecursionLevel.
+  _local = local()
+  _states = []
+  _retiredCalls = 0
+  _retiredTrees = [0, 0]
+  _nextCallNumber = 1
+  _callNumberBlock = 256
+
+  # Guards the per thread counters list, the call number blocks, _hooks and
+  # _config. It is never taken for a call, except for a new block of numbers.
+  _lock = Lock()
+
+  # The flags read for every call, as an immutable _pyConfig swapped in by
+  # _publish whenever a setter changes one.
+  _config = None
 
   # Static state flags constructor. Use setter/getter methods to change it.
   _debug = False
   _log = True
   _verbosity = 0
+  _captureLocals = False
+  _diffLocals = False
+  _diffGlobals = False
+  _foldRecursion = False
+  _foldTopK = 0
+  _rateLimit = 0
+  _collapseRepeats = False
+  _snapshot = 'render'
+  _sampleEvery = 1
+  _echo = True
+  _buffered = False
+  _spans = False
+  _tailSampling = False
+  _tailSlowMs = 100
+  _tailRate = 0.0
+  _overheadBudget = 0
+  _frameBackend = 'none'
+
+  # Everything wrapped by instrument, keyed by id of the module or class
+  # holding it, so uninstrument can put the originals back.
+  # id(target) -> (target, [(owner, name, original attribute), ...])
+  _instrumented = {}
+
+  # Latency histogram of every decorated or traced function, keyed by the
+  # qualified function name. Use histogramFor and latencySnapshot. Calls that
+  # raised are kept apart in _errorHistograms so they do not skew the rest.
+  _histograms = {}
+  _errorHistograms = {}
+
+  # Objects told about the start and end of every call, see addHook. A tuple
+  # replaced, never changed, so a call can go through it without a lock.
+  _hooks = ()
+
+  # Rate limiting. Per function limits, the token bucket of every function
+  # printed so far, by qualified name, and the numbers of the calls whose
+  # records were dropped. The buckets are only taken from under _rateLock.
+  _rateLimits = {}
+  _buckets = {}
+  _muted = set()
+  _rateLock = Lock()
+
+  # Collapsing. The start record being held back as (callNumber, messages,
+  # argsText), the last call printed as (name, qualname, argsText, retText)
+  # and how many times it was repeated since. They are shared by every
+  # thread, as the output is, and only read and changed together under
+  # _collapseLock.
+  _held = None
+  _lastCall = None
+  _repeats = 0
+  _collapseLock = RLock()
+
+  # The snapshot strategies. The snapshots of the calls running with one
+  # other than render are kept by their thread, see _pyThreadState.
+  _snapshotStrategies = ('render', 'reference', 'shallow', 'pickle')
+  _snapshots = {}
+
+  # Text printCurFrame prints for each code object, see _formatCode. Weakly
+  # keyed so reloaded code is collected. Code objects compare equal without
+  # looking at their file, so the text is kept per file and first line too.
+  # code -> {(co_filename, co_firstlineno): text}
+  _codeText = WeakKeyDictionary()
+
+  # Last globals or builtins printed in _diffGlobals mode.
+  # (title, module name, include) -> {name: id(value)}
+  _namespaceSnapshots = {}
+
+  # The overhead governor, a _pyGovernor while there is a budget, and the
+  # highest _sampleEvery it may set.
+  _governor = None
+  _governorMaxSampleEvery = 1024
+
+  # The pyEventBuffer everything printed goes through while _buffered is set.
+  _buffer = None
+
+  # Calls of functions decorated with a slowMs budget that went over it, by
+  # qualified function name. See budgetViolations.
+  _budgetViolations = {}
+
+  # The last spans that ended, as (trace id, span id, parent span id,
+  # qualified name, start, elapsed), for spanTree and criticalPath.
+  _finishedSpans = deque(maxlen=10000)
+
+  # The most records a call tree held back by _tailSampling may have. Those
+  # past it are only counted.
+  _tailMaxEvents = 10000
+
+  # The frame backends, in order of preference, see _frameBackend. A tuple so
+  # the functions are not turned into methods.
+  _frameBackends = (('getframe', _frameByGetframe),
+    ('currentframe', _frameByCurrentframe), ('traceback', _frameByTraceback))
 
   ###########################################################################
   # Setters and getters for the class attributes
@@ -105,6 +408,7 @@ class pyDecorator(object):
 
     if val == False or val == True:
       pyDecorator._debug = val
+      pyDecorator._publish()
       return True
     else:
       return False
@@ -127,6 +431,7 @@ class pyDecorator(object):
 
     if isinstance(val, int):
       pyDecorator._verbosity = val
+      pyDecorator._publish()
       return True
     else:
       return False
@@ -149,6 +454,7 @@ class pyDecorator(object):
 
     if val == False or val == True:
       pyDecorator._log = val
+      pyDecorator._publish()
       return True
     else:
       return False
@@ -163,85 +469,2176 @@ class pyDecorator(object):
     return pyDecorator._log
 
 
-  ###########################################################################
-  # __Methods__
+  @staticmethod
+  def setCaptureLocals(val):
+    r'''
+    Setter for _captureLocals static variable.
+    '''
+
+    if val == False or val == True:
+      pyDecorator._captureLocals = val
+      pyDecorator._publish()
+      return True
+    else:
+      return False
+
 
-  def __init__(self, func):
+  @staticmethod
+  def getCaptureLocals():
     r'''
-    Initializes the pyDecorator by setting the function and the call to it.
-    We also initialize the logging class regardless of its usage as it
-    might be changed later on.
+    Getter for _captureLocals static variable.
     '''
 
-    _verbosity = pyDecorator.getVerbosity()
+    return pyDecorator._captureLocals
 
-    if _verbosity == 0:
-      fmtstr = '%(message)s'
-    elif _verbosity == 1:
-      fmtstr = '%(levelname)-8s %(message)s'
+
+  @staticmethod
+  def setDiffLocals(val):
+    r'''
+    Setter for _diffLocals static variable. Turning it off forgets the
+    locals remembered so far.
+    '''
+
+    if val == False or val == True:
+      pyDecorator._diffLocals = val
+      if not val:
+        with pyDecorator._lock:
+          states = list(pyDecorator._states)
+        for state in states:
+          state.locals.clear()
+      return True
     else:
-      fmtstr = '%(asctime)-15s %(levelname)-8s %(message)s'
+      return False
+
+
+  @staticmethod
+  def getDiffLocals():
+    r'''
+    Getter for _diffLocals static variable.
+    '''
+
+    return pyDecorator._diffLocals
+
+
+  @staticmethod
+  def setDiffGlobals(val):
+    r'''
+    Setter for _diffGlobals static variable. Turning it off forgets the
+    snapshots taken so far.
+    '''
+
+    if val == False or val == True:
+      pyDecorator._diffGlobals = val
+      if not val:
+        pyDecorator._namespaceSnapshots.clear()
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getDiffGlobals():
+    r'''
+    Getter for _diffGlobals static variable.
+    '''
+
+    return pyDecorator._diffGlobals
+
+
+  @staticmethod
+  def setFoldRecursion(val):
+    r'''
+    Setter for _foldRecursion static variable.
+    '''
+
+    if val == False or val == True:
+      pyDecorator._foldRecursion = val
+      pyDecorator._publish()
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getFoldRecursion():
+    r'''
+    Getter for _foldRecursion static variable.
+    '''
+
+    return pyDecorator._foldRecursion
+
+
+  @staticmethod
+  def setFoldTopK(val):
+    r'''
+    Setter for _foldTopK static variable.
+    '''
+
+    if isinstance(val, int) and val >= 0:
+      pyDecorator._foldTopK = val
+      pyDecorator._publish()
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getFoldTopK():
+    r'''
+    Getter for _foldTopK static variable.
+    '''
+
+    return pyDecorator._foldTopK
+
+
+  @staticmethod
+  def setRateLimit(val, name=None):
+    r'''
+    Setter for _rateLimit static variable, in calls per second. If name is
+    given only the limit of that function is set, None removing it. name is
+    a qualified function name, or a bare one for every function so named.
+    Every function has a bucket of its own either way.
+    '''
+
+    if name is not None and val is None:
+      pyDecorator._rateLimits.pop(name, None)
+    elif isinstance(val, (int, float)) and val >= 0:
+      if name is None:
+        pyDecorator._rateLimit = val
+      else:
+        pyDecorator._rateLimits[name] = val
+    else:
+      return False
+
+    with pyDecorator._rateLock:
+      pyDecorator._buckets.clear()
+    pyDecorator._publish()
+    return True
+
+
+  @staticmethod
+  def getRateLimit(name=None):
+    r'''
+    Getter for _rateLimit static variable, or the limit of function name.
+    '''
+
+    return pyDecorator._rateLimits.get(name, pyDecorator._rateLimit)
+
+
+  @staticmethod
+  def setCollapseRepeats(val):
+    r'''
+    Setter for _collapseRepeats static variable. Turning it off prints what
+    it was holding back.
+    '''
+
+    if val == False or val == True:
+      pyDecorator._collapseRepeats = val
+      pyDecorator._publish()
+      if not val:
+        pyDecorator._flushCollapsed()
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getCollapseRepeats():
+    r'''
+    Getter for _collapseRepeats static variable.
+    '''
+
+    return pyDecorator._collapseRepeats
+
+
+  @staticmethod
+  def setSnapshot(val, name=None):
+    r'''
+    Setter for _snapshot static variable. If name is given only the
+    strategy of that function is set, None removing it. name is a qualified
+    function name, or a bare one for every function so named, the qualified
+    one winning when both are set.
+    '''
+
+    if name is not None and val is None:
+      pyDecorator._snapshots.pop(name, None)
+    elif val in pyDecorator._snapshotStrategies:
+      if name is None:
+        pyDecorator._snapshot = val
+      else:
+        pyDecorator._snapshots[name] = val
+    else:
+      return False
+
+    pyDecorator._publish()
+    return True
+
+
+  @staticmethod
+  def getSnapshot(name=None):
+    r'''
+    Getter for _snapshot static variable, or the strategy set for name, a
+    qualified or bare function name, see setSnapshot.
+    '''
+
+    return pyDecorator._snapshots.get(name, pyDecorator._snapshot)
+
+
+  @staticmethod
+  def setSampleEvery(val):
+    r'''
+    Setter for _sampleEvery static variable.
+    '''
+
+    if isinstance(val, int) and not isinstance(val, bool) and val >= 1:
+      pyDecorator._sampleEvery = val
+      pyDecorator._publish()
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getSampleEvery():
+    r'''
+    Getter for _sampleEvery static variable.
+    '''
+
+    return pyDecorator._sampleEvery
+
+
+  @staticmethod
+  def setEcho(val):
+    r'''
+    Setter for _echo static variable.
+    '''
+
+    if val == False or val == True:
+      pyDecorator._echo = val
+      pyDecorator._publish()
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getEcho():
+    r'''
+    Getter for _echo static variable.
+    '''
+
+    return pyDecorator._echo
+
+
+  @staticmethod
+  def setBuffered(val, interval=0.1):
+    r'''
+    Setter for _buffered static variable. The flusher writes every interval
+    seconds. Turning it off writes what is still buffered.
+    '''
+
+    if val == False or val == True:
+      if val and pyDecorator._buffer is None:
+        pyDecorator._buffer = pyEventBuffer(pyDecorator._emit, interval)
+        pyDecorator._buffer.start()
+      elif not val and pyDecorator._buffer is not None:
+        pyDecorator._buffer.stop()
+        pyDecorator._buffer = None
+      pyDecorator._buffered = val
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getBuffered():
+    r'''
+    Getter for _buffered static variable.
+    '''
+
+    return pyDecorator._buffered
+
+
+  @staticmethod
+  def setSpans(val):
+    r'''
+    Setter for _spans static variable. While on, work submitted to a
+    concurrent.futures.ThreadPoolExecutor runs in the context of the code
+    submitting it. The span of a call to an async function lasts until the
+    coroutine is done, while its records and timings still only cover
+    making the coroutine. Returns False if this Python has no contextvars.
+    '''
+
+    if (val == False or val == True) and _spanContext is not None:
+      pyDecorator._spans = val
+      pyDecorator._propagateToExecutors(val)
+      pyDecorator._publish()
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getSpans():
+    r'''
+    Getter for _spans static variable.
+    '''
+
+    return pyDecorator._spans
+
+
+  @staticmethod
+  def setTailSampling(val, slowMs=100, rate=0.0):
+    r'''
+    Setter for _tailSampling static variable. A call tree is printed when
+    one of its calls raised, when its root took over slowMs milliseconds,
+    None for never, or else with probability rate. A tree already started
+    is finished the way it began.
+    '''
+
+    if (val == False or val == True) and 0 <= rate <= 1 and \
+        (slowMs is None or slowMs >= 0):
+      pyDecorator._tailSampling = val
+      pyDecorator._tailSlowMs = slowMs
+      pyDecorator._tailRate = rate
+      pyDecorator._publish()
+      return True
+    else:
+      return False
+
+
+  @staticmethod
+  def getTailSampling():
+    r'''
+    Getter for _tailSampling static variable.
+    '''
+
+    return pyDecorator._tailSampling
+
+
+  @staticmethod
+  def setOverheadBudget(val, window=1.0):
+    r'''
+    Setter for _overheadBudget static variable. The governor weighs the
+    overhead every window seconds. Its steps down are only applied to the
+    published configuration, getVerbosity and the other getters still
+    return what was set. Setting 0 undoes every step it took.
+    '''
+
+    if not isinstance(val, (int, float)) or val < 0 or window < 0:
+      return False
+
+    with pyDecorator._lock:
+      pyDecorator._overheadBudget = val
+
+      if not val:
+        pyDecorator._governor = None
+      elif pyDecorator._governor is None:
+        pyDecorator._governor = _pyGovernor(window)
+      else:
+        pyDecorator._governor.window = window
+
+    pyDecorator._publish()
+    return True
+
+
+  @staticmethod
+  def getOverheadBudget():
+    r'''
+    Getter for _overheadBudget static variable.
+    '''
+
+    return pyDecorator._overheadBudget
+
+
+  @staticmethod
+  def setFrameBackend(val):
+    r'''
+    Setter for _frameBackend static variable. Only backends that work on
+    this interpreter, see frameBackends, and 'none' are accepted.
+    '''
+
+    global _getframe
+
+    if val == 'none':
+      function = None
+    else:
+      function = pyDecorator.frameBackends().get(val)
+      if function is None:
+        return False
+
+    _getframe = function
+    pyDecorator._frameBackend = val
+    return True
+
+
+  @staticmethod
+  def getFrameBackend():
+    r'''
+    Getter for _frameBackend static variable.
+    '''
+
+    return pyDecorator._frameBackend
+
+
+  ###########################################################################
+  # Per thread call accounting and the configuration snapshot
+
+  @staticmethod
+  def _state():
+    r'''
+    Returns the calling thread's counters, creating them on its first call.
+    Counters of threads that ended are folded into _retiredCalls then.
+    '''
+
+    try:
+      return pyDecorator._local.state
+    except AttributeError:
+      state = _pyThreadState()
+
+      with pyDecorator._lock:
+        live = []
+        for each in pyDecorator._states:
+          thread = each.thread()
+          if thread is not None and thread.is_alive():
+            live.append(each)
+          else:
+            pyDecorator._retiredCalls += each.calls
+            pyDecorator._retiredTrees[0] += each.treesKept
+            pyDecorator._retiredTrees[1] += each.treesDropped
+            each.locals.clear()
+        live.append(state)
+        pyDecorator._states = live
+
+      pyDecorator._local.state = state
+      return state
+
+
+  @staticmethod
+  def _takeCallNumbers(state):
+    r'''
+    Hands the next block of call numbers to the thread owning state.
+    '''
+
+    with pyDecorator._lock:
+      state.nextNumber = pyDecorator._nextCallNumber
+      pyDecorator._nextCallNumber += pyDecorator._callNumberBlock
+
+    state.endNumber = state.nextNumber + pyDecorator._callNumberBlock
+
+
+  @staticmethod
+  def getCallCount():
+    r'''
+    Returns the number of decorated or traced calls made, by every thread,
+    since the start of execution.
+    '''
+
+    with pyDecorator._lock:
+      states = list(pyDecorator._states)
+      calls = pyDecorator._retiredCalls
+
+    return calls + sum( state.calls for state in states )
+
+
+  @staticmethod
+  def getRecursionLevel(allThreads=False):
+    r'''
+    Returns how many decorated or traced calls the calling thread is in, or
+    with allThreads set, every thread together.
+    '''
+
+    if not allThreads:
+      return pyDecorator._state().depth
+
+    with pyDecorator._lock:
+      states = list(pyDecorator._states)
+
+    return sum( state.depth for state in states )
+
+
+  @staticmethod
+  def recursionLevels():
+    r'''
+    Returns the recursion level of every thread in a call, keyed by thread
+    name and id.
+    '''
+
+    with pyDecorator._lock:
+      states = list(pyDecorator._states)
+
+    levels = {}
+    for state in states:
+      thread = state.thread()
+      if state.depth and thread is not None:
+        levels['%s (%i)' % (thread.name, state.ident)] = state.depth
+
+    return levels
+
+
+  @staticmethod
+  def runningFolds():
+    r'''
+    Returns the recursive call trees being folded, see setFoldRecursion, as
+    (thread id, qualified function name, _pyFold) for every thread.
+    '''
+
+    with pyDecorator._lock:
+      states = list(pyDecorator._states)
+
+    return [ (state.ident, name, fold) for state in states
+      for name, fold in list(state.folds.items()) ]
+
+
+  @staticmethod
+  def _leaveCall(callNumber):
+    r'''
+    Takes the running call callNumber off the calling thread without ending
+    it, as a generator yielding, one level up. See _rejoinCall.
+    '''
+
+    state = pyDecorator._state()
+    if callNumber in state.running:
+      state.running.remove(callNumber)
+      state.depth -= 1
+
+
+  @staticmethod
+  def _rejoinCall(callNumber):
+    r'''
+    Puts the call callNumber, left by _leaveCall, back on the calling
+    thread, which may not be the one it left, one level deeper.
+    '''
+
+    state = pyDecorator._state()
+    state.running.append(callNumber)
+    state.depth += 1
+
+
+  @staticmethod
+  def _abandonCalls(state, callNumbers):
+    r'''
+    Forgets the running calls callNumbers of the thread owning state, which
+    will never end because the engine tracing them stopped, so that its
+    recursion level comes back down. Once it is in no call, the call tree
+    and folds it held back for them are dropped too.
+    '''
+
+    for callNumber in callNumbers:
+      if callNumber not in state.running:
+        continue
+      state.running.remove(callNumber)
+      state.depth -= 1
+      state.deferred.pop(callNumber, None)
+      pyDecorator._unmute(callNumber)
+
+    if not state.depth:
+      state.tree = None
+      state.folds.clear()
+
+
+  @staticmethod
+  def _publish():
+    r'''
+    Swaps in a new snapshot of the flags read for every call, so that a call
+    sees them as they were at one moment even while another thread changes
+    them. Every setter calls this.
+    '''
+
+    with pyDecorator._lock:
+      governor = pyDecorator._governor
+      steps = list(governor.steps) if governor is not None else []
+
+      # The governor's steps down apply over what was set, never to it
+      verbosity = max(pyDecorator._verbosity - steps.count('verbosity'), 0)
+      sampleEvery = pyDecorator._sampleEvery
+      if 'sampleEvery' in steps:
+        sampleEvery = max(sampleEvery, min(sampleEvery <<
+          steps.count('sampleEvery'), pyDecorator._governorMaxSampleEvery))
+      echo = pyDecorator._echo and not (pyDecorator._log and 'echo' in steps)
+
+      pyDecorator._config = _pyConfig(
+        debug=pyDecorator._debug,
+        log=pyDecorator._log,
+        verbosity=verbosity,
+        captureLocals=pyDecorator._captureLocals,
+        foldRecursion=pyDecorator._foldRecursion,
+        foldTopK=pyDecorator._foldTopK,
+        rateLimited=bool(pyDecorator._rateLimit or pyDecorator._rateLimits),
+        sampleEvery=sampleEvery,
+        collapseRepeats=pyDecorator._collapseRepeats,
+        snapshot=pyDecorator._snapshot,
+        snapshots=dict(pyDecorator._snapshots),
+        echo=echo,
+        spans=pyDecorator._spans,
+        tailSampling=pyDecorator._tailSampling,
+        tailSlowMs=pyDecorator._tailSlowMs,
+        tailRate=pyDecorator._tailRate)
+
+
+  @staticmethod
+  def measureScaling(threadCounts=(1, 2, 4, 8, 16), calls=10000):
+    r'''
+    Times threads making calls calls each to a decorated function, for every
+    count of threads in threadCounts, with nothing printed. Returns the calls
+    made per second keyed by count. Throughput only grows with the threads
+    on a free-threaded build, where sys._is_gil_enabled() returns False.
+    '''
+
+    log, echo, verbosity = pyDecorator._log, pyDecorator._echo, \
+      pyDecorator._verbosity
+
+    pyDecorator.setLog(False)
+    pyDecorator.setEcho(False)
+    pyDecorator.setVerbosity(0)
+
+    try:
+      @pyDecorator
+      def scaling(value):
+        return value
+
+      return dict( (threads, pyEventBuffer._rate(scaling, threads, calls))
+        for threads in threadCounts )
+
+    finally:
+      pyDecorator.setLog(log)
+      pyDecorator.setEcho(echo)
+      pyDecorator.setVerbosity(verbosity)
+
+
+  ###########################################################################
+  # __Methods__
+
+  def __new__(cls, func=None, **options):
+    r'''
+    Lets pyDecorator take options, @pyDecorator(slowMs=5), by returning a
+    decorator that passes them on when no function is given.
+    '''
+
+    if func is None:
+      return partial(cls, **options)
+    return object.__new__(cls)
+
+
+  def __init__(self, func, slowMs=None, slowStack=False):
+    r'''
+    Initializes the pyDecorator by setting the function and the call to it.
+    We also initialize the logging class regardless of its usage as it
+    might be changed later on.
+
+    With slowMs, a latency budget in milliseconds, nothing is printed for
+    calls within it. A call over it, or one that raises, is printed once it
+    ends as a single record with its arguments, as the call left them, and
+    its result, plus the stack of the caller if slowStack is set. Calls over
+    budget are counted, see budgetViolations.
+    '''
+
+    _verbosity = pyDecorator.getVerbosity()
+
+    if _verbosity == 0:
+      fmtstr = '%(message)s'
+    elif _verbosity == 1:
+      fmtstr = '%(levelname)-8s %(message)s'
+    else:
+      fmtstr = '%(asctime)-15s %(levelname)-8s %(message)s'
+
+    logging.basicConfig( level=logging.DEBUG, filename='logfile',
+                         filemode='a+', format=fmtstr
+                       )
+
+    self._print( '>>Initializing pyDecorator class' )
+
+    self.func = func
+    self.count = 0
+    self.slowMs = slowMs
+    self.slowStack = slowStack
+    self.qualname = pyDecorator._qualifiedName(func)
+    self.isAsync = iscoroutinefunction(func)
+    self.histogram = pyDecorator.histogramFor(self.qualname)
+    self.errorHistogram = pyDecorator.histogramFor(self.qualname, errors=True)
+
+    # Set by pyRecorder.attach to sample the calls of this function
+    self.recorder = None
+
+
+  def __call__(self, *args, **kwargs):
+    r'''
+    Manages the call of the function by printing debugging information as
+    defined from pyDecorator._verbosity and pyDecorator._debug
+    '''
+
+    governor = pyDecorator._governor
+    if governor is not None:
+      entered = _clock()
+
+    name = self.func.__name__
+    slowMs = self.slowMs
+    state = None
+
+    spans = pyDecorator._config.spans
+    if spans:
+      span = pyDecorator._openSpan()
+
+    # Under a latency budget the start is only counted, see _printSlow
+    if slowMs is None:
+      callNumber = pyDecorator._enterCall(name, self.qualname, args, kwargs)
+    else:
+      state, callNumber = pyDecorator._countCall()
+
+    # From here the call is ended exactly once whatever raises, so the
+    # recursion level always comes back down
+    hooks = pyDecorator._hooks
+    recorder = self.recorder
+    recording = None
+    start = _clock()
+    elapsed = None
+
+    try:
+      # Hook point
+      if hooks:
+        pyDecorator._notify(hooks, 'callStarted', self.qualname)
+
+      # The inputs are captured before the call can change them
+      if recorder is not None:
+        recording = self._record(recorder.sample, args, kwargs)
+
+      # Remember to capture and return the args of the function called
+      start = _clock()
+      try:
+        ret = self.func(*args, **kwargs)
+      except BaseException:
+        elapsed = _clock() - start
+        self.errorHistogram.record(elapsed)
+        if hooks:
+          pyDecorator._notify(hooks, 'callEnded', self.qualname, elapsed,
+            exc_info()[1])
+        if recording is not None:
+          self._record(recorder.write, recording, False, exc_info()[1])
+        raise
+      elapsed = _clock() - start
+
+      # Hook point
+      if hooks:
+        pyDecorator._notify(hooks, 'callEnded', self.qualname, elapsed, None)
+      if recording is not None:
+        self._record(recorder.write, recording, True, ret)
+
+      self.histogram.record(elapsed)
+
+    except BaseException:
+      if elapsed is None:
+        elapsed = _clock() - start
+      self._endCall(state, callNumber, args, kwargs, exc_info()[1], elapsed,
+        True, exc_info()[2])
+      if spans:
+        pyDecorator._closeSpan(span, self.qualname, start, elapsed)
+      if governor is not None:
+        ratio = governor.account(_clock() - entered - elapsed, elapsed)
+        if ratio is not None:
+          pyDecorator._govern(governor, ratio)
+      raise
+
+    self._endCall(state, callNumber, args, kwargs, ret, elapsed, False)
+
+    if spans:
+      if self.isAsync:
+        ret = pyDecorator._awaitSpan(span, ret, self.qualname, start)
+      else:
+        pyDecorator._closeSpan(span, self.qualname, start, elapsed)
+
+    if governor is not None:
+      ratio = governor.account(_clock() - entered - elapsed, elapsed)
+      if ratio is not None:
+        pyDecorator._govern(governor, ratio)
+
+    return ret
+
+
+  def _record(self, method, *args):
+    r'''
+    Calls method, the sample or write method of the recorder, and returns
+    what it returns. A recorder that raises is logged and detached, the
+    call itself goes on or raises what it raised.
+    '''
+
+    try:
+      return method(*args)
+    except Exception:
+      recorder = self.recorder
+      logging.exception( '>>The recorder of %s raised, it is detached' %
+        self.qualname )
+      if recorder is not None:
+        self.recorder = None
+        recorder.failed = exc_info()[1]
+      return None
+
+
+  def _endCall(self, state, callNumber, args, kwargs, outcome, elapsed,
+      failed, traceback=None):
+    r'''
+    Accounts for and prints the end of a call made by __call__, outcome
+    being what it returned, or raised if failed is set. Never raises, the
+    records that can not be printed are reported instead.
+    '''
+
+    name = self.func.__name__
+
+    if self.slowMs is None:
+      if failed:
+        pyDecorator._failCall(name, self.qualname, callNumber, outcome,
+          elapsed, traceback)
+      else:
+        pyDecorator._exitCall(name, self.qualname, callNumber, outcome,
+          elapsed)
+      return
+
+    state.depth -= 1
+    state.running.pop()
+    if state.locals:
+      pyDecorator._pruneLocals(state.locals)
+    if failed or elapsed * 1e3 > self.slowMs:
+      try:
+        self._printSlow(callNumber, args, kwargs, outcome, elapsed, failed)
+      except Exception:
+        pyDecorator._printFailed(name, callNumber)
+
+
+  @staticmethod
+  def _enterCall(name, qualname, args, kwargs):
+    r'''
+    Accounts for and prints the start of a call to the function name, whose
+    recursion is folded, rate limited, collapsed and snapshot strategy looked
+    up under its qualified name qualname. This is the record every tracing
+    engine produces so __call__ and pyMonitor read the same.
+    Returns the call number to hand back to _exitCall.
+    '''
+
+    config = pyDecorator._config
+    state, callNumber = pyDecorator._countCall()
+
+    # The call is made even if its record can not be printed
+    try:
+      if state.tree is not None or (config.tailSampling and state.depth == 1):
+        pyDecorator._treeEnter(state, config, name, qualname, callNumber,
+          args, kwargs)
+        return callNumber
+
+      if config.foldRecursion:
+        fold = state.folds.get(qualname)
+
+        # A recursive call is only counted, its root prints for it
+        if fold is not None:
+          fold.enter()
+          return callNumber
+
+      if config.rateLimited and not pyDecorator._takeToken(name, qualname):
+        pyDecorator._muted.add(callNumber)
+        return callNumber
+
+      if config.sampleEvery > 1 and state.calls % config.sampleEvery:
+        pyDecorator._muted.add(callNumber)
+        return callNumber
+
+      if config.foldRecursion:
+        state.folds[qualname] = _pyFold(callNumber)
+
+      # One snapshot of the flags for the whole record
+      _debug = config.debug
+      _verbosity = config.verbosity
+      output_string = ''
+      argsText = None
+      messages = []
+
+      if _verbosity >= 1:
+        output_string = '>>--------------------------------------------------\n'
+
+      if _debug:
+        pyDecorator.__print( '\n\n>>pyDecorator:recursionLevel count is %i' %
+          state.depth )
+
+      if _verbosity >= 1:
+        strategy = pyDecorator._snapshotStrategy(config, name, qualname)
+
+        if strategy == 'render':
+          argsText = (pformat(args), pformat(kwargs))
+          messages = [ '>>We are calling %s' % name, '>>For args we have:',
+            argsText[0], '>>For kwargs we have:', argsText[1] ]
+        else:
+          state.deferred[callNumber] = (strategy,
+            pyDecorator._takeSnapshot(strategy, args, kwargs))
+          messages = [ '>>We are calling %s' % name,
+            '>>Args are printed when the call ends (%s)' % strategy ]
+
+      messages.append( '\n>>Starting call to %s [Call#%03i]%s\n%s' %
+        (name, callNumber, config.spans and pyDecorator._spanText() or '',
+        output_string) )
+
+      if config.collapseRepeats:
+        pyDecorator._holdStart(callNumber, messages, argsText)
+      else:
+        pyDecorator.__print( *messages )
+
+    except Exception:
+      pyDecorator._printFailed(name, callNumber)
+
+    return callNumber
+
+
+  @staticmethod
+  def _countCall():
+    r'''
+    Counts a call made by the calling thread, one level deeper, and returns
+    the thread's counters and the call's number.
+    '''
+
+    try:
+      state = pyDecorator._local.state
+    except AttributeError:
+      state = pyDecorator._state()
+
+    state.depth += 1
+    state.calls += 1
+    if state.nextNumber == state.endNumber:
+      pyDecorator._takeCallNumbers(state)
+    callNumber = state.nextNumber
+    state.nextNumber += 1
+    state.running.append(callNumber)
+
+    return state, callNumber
+
+
+  @staticmethod
+  def _exitCall(name, qualname, callNumber, ret, elapsed):
+    r'''
+    Accounts for and prints the end of the call callNumber to the function
+    name, qualified name qualname, which returned ret after elapsed seconds.
+    The recursion level is lowered even if the record can not be printed.
+    '''
+
+    config = pyDecorator._config
+    state = pyDecorator._state()
+
+    try:
+      if state.tree is not None:
+        pyDecorator._treeExit(state, ('end', name, callNumber, ret, elapsed,
+          config.spans and _spanContext.get() or None))
+        return
+
+      fold = pyDecorator._foldExit(state, qualname, callNumber, elapsed,
+        False)
+      if fold is not None and fold.depth:
+        return
+
+      if pyDecorator._muted and pyDecorator._unmute(callNumber):
+        return
+
+      argsText = None
+      messages = []
+
+      if state.deferred:
+        deferred = state.deferred.pop(callNumber, None)
+        if deferred is not None:
+          argsText, messages = pyDecorator._snapshotMessages(config, deferred)
+
+      spanText = config.spans and pyDecorator._spanText() or ''
+
+      if config.verbosity >= 1:
+        messages.append(
+          '>>--------------------------------------------------\n'
+          '>>Ended call to %s [Call#%03i]%s. Returned %s in %.6fs' %
+          (name, callNumber, spanText, str(ret), elapsed) )
+      else:
+        messages.append( '>>Ended call to %s [Call#%03i]%s. Returned %s' %
+          (name, callNumber, spanText, str(ret)) )
+
+      held = pyDecorator._held
+      if held is not None and held[0] == callNumber:
+        pyDecorator._collapseCall(held, name, qualname, str(ret), messages,
+          argsText)
+      else:
+        pyDecorator.__print( *messages )
+
+      if fold is not None:
+        pyDecorator._printFold(name, fold)
+
+      if config.debug:
+        pyDecorator.__print (
+          '\n\npyDecorator:pyDecorator._recursionLevel count is %i' %
+          (state.depth - 1) )
+
+    except Exception:
+      pyDecorator._printFailed(name, callNumber)
+
+    finally:
+      state.depth -= 1
+      state.running.pop()
+      if state.locals:
+        pyDecorator._pruneLocals(state.locals)
+
+
+  @staticmethod
+  def _failCall(name, qualname, callNumber, error, elapsed, traceback=None):
+    r'''
+    Accounts for and prints the end of the call callNumber to the function
+    name, qualified name qualname, which raised error after elapsed seconds.
+    The record still reads 'Ended call' so it pairs with its start. If
+    _captureLocals is set, the locals of the innermost frame of traceback,
+    the one that raised, are printed as well. Failures are never collapsed.
+    The recursion level is lowered even if the record can not be printed.
+    '''
+
+    config = pyDecorator._config
+    state = pyDecorator._state()
+
+    try:
+      if state.tree is not None:
+        pyDecorator._treeExit(state, ('fail', name, callNumber, error,
+          elapsed, config.spans and _spanContext.get() or None))
+        return
+
+      fold = pyDecorator._foldExit(state, qualname, callNumber, elapsed,
+        True)
+      if fold is not None and fold.depth:
+        return
+
+      if pyDecorator._muted and pyDecorator._unmute(callNumber):
+        return
+
+      errorString = '%s: %s' % (type(error).__name__, error)
+
+      if state.deferred:
+        deferred = state.deferred.pop(callNumber, None)
+        if deferred is not None:
+          pyDecorator.__print(
+            *pyDecorator._snapshotMessages(config, deferred)[1] )
+
+      spanText = config.spans and pyDecorator._spanText() or ''
+
+      if config.verbosity >= 1:
+        pyDecorator.__print(
+          '>>--------------------------------------------------\n'
+          '>>Ended call to %s [Call#%03i]%s. Raised %s in %.6fs' %
+          (name, callNumber, spanText, errorString, elapsed) )
+      else:
+        pyDecorator.__print( '>>Ended call to %s [Call#%03i]%s. Raised %s' %
+          (name, callNumber, spanText, errorString) )
+
+      if config.captureLocals and traceback is not None:
+        while traceback.tb_next is not None:
+          traceback = traceback.tb_next
+
+        pyDecorator.__print( '>>>Locals where %s was raised, in %s, are:' %
+          (type(error).__name__, traceback.tb_frame.f_code.co_name) )
+        pyDecorator.__pprint( traceback.tb_frame.f_locals )
+
+      if fold is not None:
+        pyDecorator._printFold(name, fold)
+
+      if config.debug:
+        pyDecorator.__print (
+          '\n\npyDecorator:pyDecorator._recursionLevel count is %i' %
+          (state.depth - 1) )
+
+    except Exception:
+      pyDecorator._printFailed(name, callNumber)
+
+    finally:
+      state.depth -= 1
+      state.running.pop()
+      if state.locals:
+        pyDecorator._pruneLocals(state.locals)
+
+
+  @staticmethod
+  def _printFailed(name, callNumber):
+    r'''
+    Reports that a record of the call callNumber to the function name could
+    not be printed, most likely because the repr of an argument or of the
+    result raised. Called from an except clause, the error is logged with
+    its traceback and never reaches the caller of the decorated function.
+    '''
+
+    error = exc_info()[1]
+    message = '>>Could not print the record of %s [Call#%03i], %s raised' % \
+      (name, callNumber, type(error).__name__)
+
+    try:
+      logging.exception( message )
+      if pyDecorator._config.echo:
+        print( message )
+    except Exception:
+      pass
+
+
+  def _printSlow(self, callNumber, args, kwargs, outcome, elapsed, failed):
+    r'''
+    Prints the whole record of a call of a function with a latency budget,
+    counting it if it went over. outcome is what it returned, or raised if
+    failed is set. Only _endCall should call this, the stack printed starts
+    at the caller of __call__.
+    '''
+
+    name = self.func.__name__
+    slowMs = self.slowMs
+    spanText = pyDecorator._config.spans and pyDecorator._spanText() or ''
+    messages = [ '>>--------------------------------------------------' ]
+
+    if elapsed * 1e3 > slowMs:
+      with pyDecorator._lock:
+        violations = pyDecorator._budgetViolations.get(self.qualname, 0) + 1
+        pyDecorator._budgetViolations[self.qualname] = violations
+
+      messages.append( '>>Slow call to %s [Call#%03i]%s took %.3fms, over '
+        'its %gms budget (%i so far)' % (name, callNumber, spanText,
+        elapsed * 1e3, slowMs, violations) )
+    else:
+      messages.append( '>>Failed call to %s [Call#%03i]%s took %.3fms' %
+        (name, callNumber, spanText, elapsed * 1e3) )
+
+    messages.extend([ '>>For args we have:', pformat(args),
+      '>>For kwargs we have:', pformat(kwargs) ])
+
+    if failed:
+      messages.append( '>>Raised %s: %s' % (type(outcome).__name__, outcome) )
+    else:
+      messages.append( '>>Returned %s' % str(outcome) )
+
+    if self.slowStack and _getframe is not None:
+      messages.append( '>>Stack of the caller:' )
+      messages.append( ''.join(format_stack(_getframe(3))).rstrip() )
+
+    pyDecorator.__print( *messages )
+
+
+  @staticmethod
+  def budgetViolations():
+    r'''
+    Returns how many calls went over their slowMs budget, by qualified
+    function name.
+    '''
+
+    with pyDecorator._lock:
+      return dict(pyDecorator._budgetViolations)
+
+
+  ###########################################################################
+  # Spans
+
+  @staticmethod
+  def _openSpan():
+    r'''
+    Starts the span of a call, a child of the current one or the root of a
+    new trace, and returns the token that _closeSpan ends it with.
+    '''
+
+    parent = _spanContext.get()
+    spanId = getrandbits(64) or 1
+
+    if parent is None:
+      return _spanContext.set((spanId, spanId, 0))
+    return _spanContext.set((parent[0], spanId, parent[1]))
+
+
+  @staticmethod
+  def _closeSpan(token, name, start, elapsed):
+    r'''
+    Ends the span opened with token, keeping it for spanTree, and makes its
+    parent current again.
+    '''
+
+    traceId, spanId, parentId = _spanContext.get()
+    _spanContext.reset(token)
+    pyDecorator._finishedSpans.append((traceId, spanId, parentId, name, start,
+      elapsed))
+
+
+  @staticmethod
+  def _awaitSpan(token, coroutine, name, start):
+    r'''
+    Makes the parent of the span opened with token current again, without
+    ending it, and returns coroutine wrapped to end it once it is awaited.
+    '''
+
+    span = _spanContext.get()
+    _spanContext.reset(token)
+    return _pyAwaitedSpan(coroutine, span, name, start)
+
+
+  @staticmethod
+  def _spanText(span=None):
+    r'''
+    Formats span, by default the current one, for a record.
+    '''
+
+    if span is None:
+      span = _spanContext.get()
+      if span is None:
+        return ''
+
+    return ' [trace %016x span %016x parent %016x]' % span
+
+
+  @staticmethod
+  def currentSpan():
+    r'''
+    Returns (trace id, span id, parent span id) of the decorated call being
+    made in this context, or None. Parent is 0 for the root of a trace.
+    '''
+
+    if _spanContext is None:
+      return None
+    return _spanContext.get()
+
+
+  @staticmethod
+  def _propagateToExecutors(install):
+    r'''
+    Makes ThreadPoolExecutor.submit run the work in a copy of the submitting
+    context, or puts the original back. asyncio tasks do that already.
+    '''
+
+    try:
+      from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+      return
+
+    submit = ThreadPoolExecutor.submit
+    original = getattr(submit, '_pyDecoratorOriginal', None)
+
+    if install and original is None:
+      def contextSubmit(self, fn, *args, **kwargs):
+        return submit(self, copy_context().run, fn, *args, **kwargs)
+
+      contextSubmit._pyDecoratorOriginal = submit
+      contextSubmit.__doc__ = submit.__doc__
+      ThreadPoolExecutor.submit = contextSubmit
+
+    elif not install and original is not None:
+      ThreadPoolExecutor.submit = original
+
+
+  @staticmethod
+  def spanTree(traceId):
+    r'''
+    Reassembles the spans kept of trace traceId into trees and returns their
+    roots, normally one. A span is a dict of its name, span id, start and
+    elapsed seconds and children, in start order.
+    '''
+
+    nodes = {}
+    for each in list(pyDecorator._finishedSpans):
+      if each[0] == traceId:
+        nodes[each[1]] = { 'name': each[3], 'span': each[1], 'parent': each[2],
+          'start': each[4], 'elapsed': each[5], 'children': [] }
+
+    roots = []
+    for node in sorted(nodes.values(), key=lambda node: node['start']):
+      parent = nodes.get(node['parent'])
+      if parent is None:
+        roots.append(node)
+      else:
+        parent['children'].append(node)
+
+    return roots
+
+
+  @staticmethod
+  def criticalPath(traceId):
+    r'''
+    Returns the critical path of trace traceId as a list of (name, elapsed)
+    from its root down: from each span, the child that ended last, as that
+    is the one the span waited for.
+    '''
+
+    roots = pyDecorator.spanTree(traceId)
+    if not roots:
+      return []
+
+    path = []
+    node = max(roots, key=lambda node: node['elapsed'])
+
+    while node is not None:
+      path.append((node['name'], node['elapsed']))
+      children = node['children']
+      node = max(children, key=lambda child: child['start'] +
+        child['elapsed']) if children else None
+
+    return path
+
+
+  ###########################################################################
+  # Tail sampling of call trees
+
+  @staticmethod
+  def _treeEnter(state, config, name, qualname, callNumber, args, kwargs):
+    r'''
+    Holds back the start of a call in the calling thread's tree, starting
+    the tree if this is its root. Nothing is formatted, from _verbosity 1
+    the arguments are kept as the snapshot strategy says, by reference for
+    render.
+    '''
+
+    if state.tree is None:
+      state.tree = []
+      state.treeFailed = False
+      state.treeDropped = 0
+
+    snapshot = None
+    if config.verbosity >= 1:
+      strategy = pyDecorator._snapshotStrategy(config, name, qualname)
+      if strategy == 'render':
+        strategy = 'reference'
+      snapshot = (strategy, pyDecorator._takeSnapshot(strategy, args, kwargs))
+
+    span = config.spans and _spanContext.get() or None
+
+    if len(state.tree) < pyDecorator._tailMaxEvents:
+      state.tree.append(('start', name, callNumber, snapshot, span))
+    else:
+      state.treeDropped += 1
+
+
+  @staticmethod
+  def _treeExit(state, event):
+    r'''
+    Holds back the end of a call, event, and decides the fate of the tree
+    when it is the end of the root.
+    '''
+
+    if len(state.tree) < pyDecorator._tailMaxEvents:
+      state.tree.append(event)
+    else:
+      state.treeDropped += 1
+
+    if event[0] == 'fail':
+      state.treeFailed = True
+
+    # The caller lowers the recursion level once this returns
+    if state.depth > 1:
+      return
+
+    tree = state.tree
+    state.tree = None
+    config = pyDecorator._config
+
+    if state.treeFailed:
+      reason = 'a call raised'
+    elif config.tailSlowMs is not None and event[4] * 1e3 > config.tailSlowMs:
+      reason = 'the root took %.3fms' % (event[4] * 1e3)
+    elif config.tailRate and random() < config.tailRate:
+      reason = 'sampled'
+    else:
+      state.treesDropped += 1
+      return
+
+    state.treesKept += 1
+    pyDecorator._printTree(tree, event, reason, state.treeDropped,
+      config.verbosity)
+
+
+  @staticmethod
+  def _printTree(tree, root, reason, dropped, verbosity):
+    r'''
+    Prints a call tree that was kept, the records of its calls in the order
+    they were made, ending with root, the end of its root call.
+    '''
+
+    separator = ''
+    if verbosity >= 1:
+      separator = '>>--------------------------------------------------\n'
+
+    messages = [ '>>Kept the call tree of %s [Call#%03i], %s' %
+      (root[1], root[2], reason) ]
+
+    for event in tree:
+      kind, name, callNumber = event[:3]
+
+      if kind == 'start':
+        if event[3] is not None:
+          messages.append( '>>We are calling %s' % name )
+          messages.extend( pyDecorator._renderSnapshot(*event[3])[1] )
+        messages.append( '\n>>Starting call to %s [Call#%03i]%s\n%s' %
+          (name, callNumber, event[4] and pyDecorator._spanText(event[4]) or
+          '', separator) )
+        continue
+
+      if kind == 'end':
+        outcome = 'Returned %s' % str(event[3])
+      else:
+        outcome = 'Raised %s: %s' % (type(event[3]).__name__, event[3])
+
+      spanText = event[5] and pyDecorator._spanText(event[5]) or ''
+
+      if verbosity >= 1:
+        messages.append( '%s>>Ended call to %s [Call#%03i]%s. %s in %.6fs' %
+          (separator, name, callNumber, spanText, outcome, event[4]) )
+      else:
+        messages.append( '>>Ended call to %s [Call#%03i]%s. %s' %
+          (name, callNumber, spanText, outcome) )
+
+    if dropped:
+      messages.append( '>>%i more records of this tree were not kept' %
+        dropped )
+
+    pyDecorator.__print( *messages )
+
+
+  @staticmethod
+  def tailSamplingStats():
+    r'''
+    Returns how many call trees tail sampling kept and dropped.
+    '''
+
+    with pyDecorator._lock:
+      states = list(pyDecorator._states)
+      kept, dropped = pyDecorator._retiredTrees
+
+    return { 'kept': kept + sum( state.treesKept for state in states ),
+      'dropped': dropped + sum( state.treesDropped for state in states ) }
+
+
+  ###########################################################################
+  # Argument snapshots
+
+  @staticmethod
+  def _snapshotStrategy(config, name, qualname):
+    r'''
+    Returns the snapshot strategy of the function name, qualified name
+    qualname, in config: the one set for qualname, else for name, else the
+    default one.
+    '''
+
+    snapshots = config.snapshots
+    if not snapshots:
+      return config.snapshot
+    return snapshots.get(qualname, snapshots.get(name, config.snapshot))
+
+
+  @staticmethod
+  def _takeSnapshot(strategy, args, kwargs):
+    r'''
+    Takes what is needed to print args and kwargs at the end of the call,
+    as strategy wants it. See setSnapshot.
+    '''
+
+    if strategy == 'shallow':
+      return ( tuple(pyDecorator._shallowCopy(value) for value in args),
+        dict( (key, pyDecorator._shallowCopy(value))
+          for key, value in kwargs.items() ) )
+
+    if strategy == 'pickle':
+      try:
+        return pickle.dumps((args, kwargs), pickle.HIGHEST_PROTOCOL)
+      except Exception:
+        # Can not be pickled, so render now instead
+        return (pformat(args), pformat(kwargs))
+
+    return (args, kwargs)
+
+
+  @staticmethod
+  def _shallowCopy(value):
+    r'''
+    Returns a shallow copy of value, or value itself if it can not be copied.
+    '''
+
+    try:
+      return copy(value)
+    except Exception:
+      return value
+
+
+  @staticmethod
+  def _renderSnapshot(strategy, snapshot):
+    r'''
+    Formats a snapshot taken by _takeSnapshot. Returns the (args, kwargs)
+    text and the messages printing it.
+    '''
+
+    if strategy == 'pickle' and not isinstance(snapshot, tuple):
+      snapshot = pickle.loads(snapshot)
+
+    if isinstance(snapshot[0], str) and isinstance(snapshot[1], str):
+      argsText = snapshot
+    else:
+      argsText = (pformat(snapshot[0]), pformat(snapshot[1]))
+
+    if strategy == 'reference':
+      when = 'as they are after the call'
+    else:
+      when = 'as they were before the call'
+
+    return argsText, [ '>>For args we have, %s:' % when, argsText[0],
+      '>>For kwargs we have, %s:' % when, argsText[1] ]
+
+
+  @staticmethod
+  def _snapshotMessages(config, deferred):
+    r'''
+    Returns the (args, kwargs) text and the messages printing deferred, a
+    (strategy, snapshot) taken by _takeSnapshot, for the end record of a
+    call. While _buffered is set, reference and pickle snapshots are handed
+    to the flusher to render as a _pyDeferredArgs, and the text is None.
+    '''
+
+    if pyDecorator._buffer is not None and not config.collapseRepeats and \
+        deferred[0] in ('reference', 'pickle'):
+      return None, [ _pyDeferredArgs(*deferred) ]
+
+    return pyDecorator._renderSnapshot(*deferred)
+
+
+  @staticmethod
+  def measureSnapshotCost(args, kwargs=None, calls=1000):
+    r'''
+    Returns, for every snapshot strategy, a dict of the seconds per call
+    spent taking the snapshot (on the calling thread, before the call) and
+    rendering it, for the given args and kwargs. Rendering is paid by the
+    calling thread as well unless _buffered hands it to the flusher, see
+    _snapshot.
+    '''
+
+    kwargs = kwargs or {}
+    results = {}
+
+    for strategy in pyDecorator._snapshotStrategies:
+      taking = rendering = 0.0
+
+      for _ in range(calls):
+        start = _clock()
+        if strategy == 'render':
+          snapshot = (pformat(args), pformat(kwargs))
+        else:
+          snapshot = pyDecorator._takeSnapshot(strategy, args, kwargs)
+        middle = _clock()
+        if strategy != 'render':
+          pyDecorator._renderSnapshot(strategy, snapshot)
+        end = _clock()
+
+        taking += middle - start
+        rendering += end - middle
+
+      results[strategy] = { 'take': taking / calls,
+        'render': rendering / calls }
+
+    return results
+
+
+  ###########################################################################
+  # Rate limiting and collapsing of repeated calls
+
+  @staticmethod
+  def _takeToken(name, qualname):
+    r'''
+    Takes a token from the bucket of the function name, qualified name
+    qualname, and returns True if there was one, that is if this call may be
+    printed. The first call printed after some were dropped says how many.
+    '''
+
+    with pyDecorator._rateLock:
+      bucket = pyDecorator._buckets.get(qualname)
+
+      if bucket is None:
+        limits = pyDecorator._rateLimits
+        rate = limits.get(qualname, limits.get(name, pyDecorator._rateLimit))
+        bucket = pyDecorator._buckets[qualname] = _pyTokenBucket(rate)
+
+      if not bucket.take(_clock()):
+        bucket.dropped += 1
+        return False
+
+      dropped, bucket.dropped = bucket.dropped, 0
+
+    if dropped:
+      pyDecorator.__print( '>>%i calls to %s were not printed (rate limited)'
+        % (dropped, name) )
+
+    return True
+
+
+  @staticmethod
+  def _unmute(callNumber):
+    r'''
+    Returns True, and forgets it, if callNumber was dropped by the rate limit.
+    '''
+
+    # One operation on the set, so no lock is needed
+    try:
+      pyDecorator._muted.remove(callNumber)
+    except KeyError:
+      return False
+    return True
+
+
+  @staticmethod
+  def _holdStart(callNumber, messages, argsText):
+    r'''
+    Holds back the start record of a call so that, if nothing is printed
+    before it ends, the whole call can be compared with the previous one.
+    '''
+
+    with pyDecorator._collapseLock:
+      # The call held so far is not a leaf, so it can not be collapsed
+      if pyDecorator._held is not None:
+        pyDecorator._flushCollapsed()
+
+      pyDecorator._held = (callNumber, messages, argsText)
+
+
+  @staticmethod
+  def _collapseCall(held, name, qualname, retText, messages, argsText=None):
+    r'''
+    Ends the call whose start record held was, with messages as its end
+    record. It is counted and dropped when it repeats the previous call,
+    same qualified function name, arguments and result, and printed in full
+    otherwise.
+    argsText is given when the arguments were printed at the end rather than
+    with the start record. If another thread printed in between, held is no
+    longer the call held back and the end record is printed as it is.
+    '''
+
+    with pyDecorator._collapseLock:
+      if pyDecorator._held is not held:
+        pyDecorator.__print( *messages )
+        return
+
+      pyDecorator._held = None
+      key = (name, qualname, argsText or held[2], retText)
+
+      if key == pyDecorator._lastCall:
+        pyDecorator._repeats += 1
+        return
+
+      if pyDecorator._repeats:
+        pyDecorator._writeRepeats()
+
+      pyDecorator._write( *held[1] )
+      pyDecorator._write( *messages )
+      pyDecorator._lastCall = key
+
+
+  @staticmethod
+  def _writeRepeats():
+    r'''
+    Prints how many times the previous call was repeated and starts over.
+    Called under _collapseLock.
+    '''
+
+    pyDecorator._write( '>>Previous call to %s repeated %i more times' %
+      (pyDecorator._lastCall[0], pyDecorator._repeats) )
+    pyDecorator._repeats = 0
+
+
+  @staticmethod
+  def _flushCollapsed():
+    r'''
+    Prints the pending repeat count and held start record, if any, and ends
+    the current run of repeated calls. Anything else printed calls this
+    first so the output stays in order.
+    '''
+
+    with pyDecorator._collapseLock:
+      if pyDecorator._repeats:
+        pyDecorator._writeRepeats()
+      pyDecorator._lastCall = None
+
+      held = pyDecorator._held
+      if held is not None:
+        pyDecorator._held = None
+        pyDecorator._write( *held[1] )
+
+
+  @staticmethod
+  def flush():
+    r'''
+    Prints whatever is being held back by _collapseRepeats, then writes
+    everything buffered by _buffered. Call this before exiting to see the
+    count of the last run of repeated calls.
+    '''
+
+    pyDecorator._flushCollapsed()
+
+    if pyDecorator._buffer is not None:
+      pyDecorator._buffer.flush(everything=True)
+
+
+  ###########################################################################
+  # Overhead governor
+
+  @staticmethod
+  def _govern(governor, ratio):
+    r'''
+    Weighs the overhead of the window that just ended, ratio, against the
+    budget, takes a step down when over it and undoes the last one after
+    enough windows well under it, printing what it did.
+    '''
+
+    budget = pyDecorator._overheadBudget
+
+    with governor.lock:
+      if ratio > budget:
+        governor.calm = 0
+        decision = pyDecorator._degrade(governor)
+      elif ratio < budget / 2.0 and governor.steps:
+        governor.calm += 1
+        if governor.calm < governor.calmWindows:
+          return
+        governor.calm = 0
+        decision = pyDecorator._restore(governor)
+      else:
+        governor.calm = 0
+        return
+
+      # The next step is taken from what this one published
+      pyDecorator._publish()
+
+    if decision:
+      pyDecorator.__print( '>>pyDecorator governor: overhead was %.2f%% of '
+        'run time, budget %.2f%%. %s' % (ratio * 100, budget * 100, decision) )
+
+
+  @staticmethod
+  def _degrade(governor):
+    r'''
+    Takes the next step down, adding it to governor.steps, and describes it.
+    Steps are applied over the settings by _publish. Returns None when
+    there is nothing left to give up. Called under governor.lock.
+    '''
+
+    config = pyDecorator._config
+    steps = governor.steps
+
+    if config.verbosity > 0:
+      steps.append('verbosity')
+      return 'Lowered verbosity to %i' % (config.verbosity - 1)
+
+    if config.sampleEvery < pyDecorator._governorMaxSampleEvery:
+      steps.append('sampleEvery')
+      return 'Printing one call in %i' % min(config.sampleEvery * 2,
+        pyDecorator._governorMaxSampleEvery)
+
+    # Without a logfile there is nowhere else to write to
+    if config.echo and config.log:
+      steps.append('echo')
+      return 'Writing to the logfile only'
+
+    return None
+
+
+  @staticmethod
+  def _restore(governor):
+    r'''
+    Undoes the last step down taken by governor and describes it. Called
+    under governor.lock.
+    '''
+
+    return 'Restored %s' % governor.steps.pop()
+
+
+  ###########################################################################
+  # Recursion folding
+
+  @staticmethod
+  def _foldExit(state, qualname, callNumber, elapsed, failed):
+    r'''
+    Accounts for the end of a call of the function qualname in the fold it
+    belongs to, in the thread owning state, and returns that fold, or None if
+    qualname is not being folded. A fold left with a depth is still running,
+    one left at depth 0 just finished its root and is forgotten.
+    '''
+
+    if not state.folds:
+      return None
+
+    fold = state.folds.get(qualname)
+
+    if fold is not None:
+      fold.exit(callNumber, elapsed, failed, pyDecorator._config.foldTopK)
+      if not fold.depth:
+        del state.folds[qualname]
+
+    return fold
+
+
+  @staticmethod
+  def _printFold(name, fold):
+    r'''
+    Prints the summary of the finished recursive call tree fold of name.
+    '''
+
+    pyDecorator.__print(
+      '>>Recursion summary for %s [Call#%03i]: %i calls, max depth %i, '
+      '%i raised' % (name, fold.root, fold.calls, len(fold.callsPerLevel),
+      fold.errors) )
+
+    lines = [ '>>%8s %12s %14s' % ('depth', 'calls', 'seconds') ]
+    for level, calls in enumerate(fold.callsPerLevel):
+      lines.append( '>>%8i %12i %14.6f' %
+        (level + 1, calls, fold.timePerLevel[level]) )
+    pyDecorator.__print( '\n'.join(lines) )
+
+    if fold.top:
+      lines = [ '>>Most expensive recursive calls:' ]
+      for elapsed, callNumber, level in sorted(fold.top, reverse=True):
+        lines.append( '>>  [Call#%03i] at depth %i took %.6fs' %
+          (callNumber, level, elapsed) )
+      pyDecorator.__print( '\n'.join(lines) )
+
+
+  def __get__(self, obj, objtype=None):
+    r'''
+    Binds the decorator the same way a plain function would be bound so that
+    decorated (or instrumented) methods still receive their instance, as a
+    bound method with the decorator as its __func__.
+    '''
+
+    if obj is None:
+      return self
+    return MethodType(self, obj)
+
+
+  ###########################################################################
+  # Hooks
+
+  @staticmethod
+  def addHook(hook):
+    r'''
+    Registers hook to be told about every decorated or traced call. A hook
+    is any object with the two methods below, called on the thread making
+    the call. They should be quick as they run for every call. A hook that
+    raises is removed, see _notify.
+
+        callStarted(name)                 Before the call. name is the
+                                          qualified function name.
+
+        callEnded(name, elapsed, error)   After it, elapsed in seconds and
+                                          error the exception it raised or
+                                          None.
+    '''
+
+    with pyDecorator._lock:
+      if hook not in pyDecorator._hooks:
+        pyDecorator._hooks = pyDecorator._hooks + (hook,)
+
+
+  @staticmethod
+  def _notify(hooks, method, *args):
+    r'''
+    Calls method of every hook in hooks with args. A hook that raises is
+    logged and removed, the call itself goes on or raises what it raised.
+    '''
+
+    for hook in hooks:
+      try:
+        getattr(hook, method)(*args)
+      except Exception:
+        # Only the thread that removes it reports it
+        if pyDecorator.removeHook(hook):
+          logging.exception( '>>The hook %r raised in %s, it is removed' %
+            (hook, method) )
+
+
+  @staticmethod
+  def removeHook(hook):
+    r'''
+    Stops telling hook about calls. Returns False if it was not registered.
+    '''
+
+    with pyDecorator._lock:
+      if hook in pyDecorator._hooks:
+        pyDecorator._hooks = tuple( each for each in pyDecorator._hooks
+          if each is not hook )
+        return True
+    return False
+
+
+  ###########################################################################
+  # Latency histograms
+
+  @staticmethod
+  def _qualifiedName(func):
+    r'''
+    Returns the name func's latency is recorded under, module.qualname when
+    the interpreter knows it. A code object gets the name of its function,
+    or else of the module loaded from its file, so that tracing a function
+    or its code records under the same name.
+    '''
+
+    if hasattr(func, 'co_code'):
+      for referrer in gc.get_referrers(func):
+        if isinstance(referrer, FunctionType) and referrer.__code__ is func:
+          return pyDecorator._qualifiedName(referrer)
+
+      filename = splitext(abspath(func.co_filename))[0]
+      module = None
+      for name, each in list(modules.items()):
+        path = getattr(each, '__file__', None)
+        if path and splitext(abspath(path))[0] == filename:
+          module = name
+          break
+
+      return '%s.%s' % (module, getattr(func, 'co_qualname', func.co_name))
+
+    return '%s.%s' % (getattr(func, '__module__', None),
+      getattr(func, '__qualname__', func.__name__))
+
+
+  @staticmethod
+  def histogramFor(name, errors=False):
+    r'''
+    Returns the latency pyHistogram of the function name, creating it if
+    needed. Functions decorated or traced under the same name share it. With
+    errors set, the histogram of the calls that raised is returned instead.
+    '''
+
+    if errors:
+      histograms = pyDecorator._errorHistograms
+    else:
+      histograms = pyDecorator._histograms
+
+    histogram = histograms.get(name)
+
+    if histogram is None:
+      histogram = histograms.setdefault(name, pyHistogram(name))
+
+    return histogram
+
+
+  @staticmethod
+  def latencySnapshot(errors=False):
+    r'''
+    Returns a list of pyHistogram snapshots, one per function that has been
+    called, sorted by name. With errors set, only the calls that raised are
+    counted, so each count is the number of failures of that function.
+    '''
+
+    if errors:
+      histograms = pyDecorator._errorHistograms
+    else:
+      histograms = pyDecorator._histograms
+
+    snapshots = [ histogram.snapshot() for name, histogram in
+      sorted(histograms.items()) ]
+
+    return [ snap for snap in snapshots if snap['count'] ]
+
+
+  @staticmethod
+  def resetLatency():
+    r'''
+    Forgets the latency and errors recorded so far for every function.
+    '''
+
+    for histograms in (pyDecorator._histograms, pyDecorator._errorHistograms):
+      for histogram in list(histograms.values()):
+        histogram.reset()
+
+
+  @staticmethod
+  def printLatency():
+    r'''
+    Prints the latency percentiles of every function called so far, then
+    those of the calls that raised if there were any.
+    '''
+
+    pyDecorator.__print( pyHistogram.report(pyDecorator.latencySnapshot()) )
+
+    errors = pyDecorator.latencySnapshot(errors=True)
+    if errors:
+      pyDecorator.__print( '>>Calls that raised:' )
+      pyDecorator.__print( pyHistogram.report(errors) )
+
+
+  ###########################################################################
+  # Frame access
+
+  @staticmethod
+  def _frameBackendWorks(function):
+    r'''
+    Returns True if the frame backend function finds the frames of its
+    caller and of the caller's caller.
+    '''
+
+    def probe():
+      return function(0), function(1)
+
+    try:
+      caller, above = probe()
+    except Exception:
+      return False
+
+    return caller.f_code is probe.__code__ and \
+      above.f_code is pyDecorator._frameBackendWorks.__code__
+
+
+  @staticmethod
+  def frameBackends():
+    r'''
+    Returns the frame backends that work on this interpreter, by name, see
+    _frameBackend.
+    '''
+
+    return dict( (name, function)
+      for name, function in pyDecorator._frameBackends
+      if function is not None and pyDecorator._frameBackendWorks(function) )
+
+
+  @staticmethod
+  def measureFrameBackends(calls=1000):
+    r'''
+    Returns, for every frame backend that works on this interpreter, the
+    seconds per call it takes to get the frame above its caller.
+    '''
+
+    results = {}
+
+    for name, function in pyDecorator.frameBackends().items():
+      start = _clock()
+      for _ in range(calls):
+        function(1)
+      results[name] = (_clock() - start) / calls
+
+    return results
+
+
+  @staticmethod
+  def _pickFrameBackend(calls=200):
+    r'''
+    Sets the fastest frame backend that works, or 'none'. Run at import.
+    '''
+
+    costs = pyDecorator.measureFrameBackends(calls)
+    pyDecorator.setFrameBackend(costs and min(costs, key=costs.get) or 'none')
+
+
+  ###########################################################################
+  # Bulk instrumentation
+
+  @staticmethod
+  def instrument(target, include=None, exclude=None):
+    r'''
+    Wraps, in place, every function and method of a module or class whose
+    name passes the filters, as if each was decorated by hand. For a module
+    the classes defined in it are walked as well and their methods are
+    matched by their qualified name, Class.method.
+
+    The filters are resolved once here into a lookup table, so a wrapped
+    function costs exactly what a hand decorated one does. Anything that is
+    already wrapped is left alone, so this can be called repeatedly.
+
+    Arguments:
+
+        target           The module or class to instrument.
+
+        include          A glob pattern, or list of them, a name must match
+                         to be wrapped. If not passed, every name that does
+                         not start with '__' matches.
+
+        exclude          A glob pattern, or list of them, that removes names
+                         from the include set.
+
+    Returns the sorted list of qualified names that were wrapped.
+    '''
+
+    candidates = {}
+
+    if isinstance(target, type):
+      pyDecorator._collectFunctions(target, '', candidates)
+    else:
+      moduleName = getattr(target, '__name__', None)
+      pyDecorator._collectFunctions(target, '', candidates, moduleName)
+
+      for name, obj in list(vars(target).items()):
+        if isinstance(obj, type) and obj.__module__ == moduleName:
+          pyDecorator._collectFunctions(obj, name + '.', candidates)
+
+    table = pyDecorator._resolveFilters(candidates, include, exclude)
+
+    wrapped = pyDecorator._instrumented.setdefault(id(target), (target, []))[1]
+
+    for qualname in sorted(table):
+      owner, name, original = candidates[qualname]
+
+      if isinstance(original, staticmethod):
+        replacement = staticmethod(pyDecorator(original.__func__))
+      elif isinstance(original, classmethod):
+        replacement = classmethod(pyDecorator(original.__func__))
+      else:
+        replacement = pyDecorator(original)
+
+      setattr(owner, name, replacement)
+      wrapped.append((owner, name, original))
+
+    return sorted(table)
+
+
+  @staticmethod
+  def uninstrument(target):
+    r'''
+    Undoes every instrument call made on target, restoring the original
+    functions and methods. Returns the number of attributes restored.
+    '''
+
+    entry = pyDecorator._instrumented.pop(id(target), None)
 
-    logging.basicConfig( level=logging.DEBUG, filename='logfile',
-                         filemode='a+', format=fmtstr
-                       )
+    if entry is None:
+      return 0
 
-    self._print( '>>Initializing pyDecorator class' )
+    for owner, name, original in reversed(entry[1]):
+      setattr(owner, name, original)
 
-    self.func = func
-    self.count = 0
+    return len(entry[1])
 
 
-  def __call__(self, *args, **kwargs):
+  @staticmethod
+  def _collectFunctions(owner, prefix, candidates, moduleName=None):
     r'''
-    Manages the call of the function by printing debugging information as
-    defined from pyDecorator._verbosity and pyDecorator._debug
+    Adds to candidates every plain, static and class method found directly in
+    owner, keyed by prefix + name. When moduleName is given only functions
+    defined in that module are taken, so imported helpers are skipped.
     '''
 
-    pyDecorator._recursionLevel += 1
-    pyDecorator._callCount += 1
-
-    # Caching values so we don't have to go out to the class repeatedly
-    # and make it mostly local to the class
-    _debug = pyDecorator._debug
-    _verbosity = pyDecorator._verbosity
-    output_string = ''
-
-    if _verbosity >= 1:
-      output_string = '>>--------------------------------------------------\n'
+    for name, obj in list(vars(owner).items()):
+      func = obj
+      if isinstance(obj, (staticmethod, classmethod)):
+        func = obj.__func__
 
-    if _debug:
-      self._print ( '\n\n>>pyDecorator:recursionLevel count is %i' %
-        self._recursionLevel )
+      if not isinstance(func, FunctionType):
+        continue
+      if moduleName is not None and func.__module__ != moduleName:
+        continue
 
-    if _verbosity >= 1:
-      self._print( '>>We are calling %s' % self.func.__name__ )
-      self._print( '>>For args we have:' )
-      self._pprint( args )
-      self._print( '>>For kwargs we have:' )
-      self._pprint( kwargs )
+      candidates[prefix + name] = (owner, name, obj)
 
-    self._print( '\n>>Starting call to %s [Call#%03i]\n%s' %
-      (self.func.__name__, pyDecorator._callCount, output_string) )
 
-    # Hook point
+  @staticmethod
+  def _resolveFilters(names, include=None, exclude=None):
+    r'''
+    Resolves the include and exclude glob patterns against names and returns
+    a lookup table (dict) of the names that pass. Only the last component of
+    a qualified name is checked against the default '__' rule.
+    '''
 
-    # Remember to capture and return the args of the function called
-    ret = self.func(*args, **kwargs)
+    if isinstance(include, str):
+      include = [include]
+    if isinstance(exclude, str):
+      exclude = [exclude]
 
-    # Hook point
+    table = {}
 
-    self._print( '%s>>Ended call to %s [Call#%03i]. Returned %s' %
-      (output_string, self.func.__name__, pyDecorator._callCount, str(ret) ))
+    for name in names:
+      if include is None:
+        if name.rsplit('.', 1)[-1].startswith('__'):
+          continue
+      elif not any(fnmatchcase(name, pattern) for pattern in include):
+        continue
 
-    pyDecorator._recursionLevel -= 1
+      if exclude and any(fnmatchcase(name, pattern) for pattern in exclude):
+        continue
 
-    if _debug:
-      self._print (
-        '\n\npyDecorator:pyDecorator._recursionLevel count is %i' %
-        pyDecorator._recursionLevel )
+      table[name] = True
 
-    return ret
+    return table
 
 
   ###########################################################################
@@ -254,7 +2651,8 @@ class pyDecorator(object):
     it should pyDecorator.__print out its header.
     '''
 
-    self.count += 1
+    with pyDecorator._lock:
+      self.count += 1
 
     if pyDecorator._debug:
       pyDecorator.__print(
@@ -297,10 +2695,46 @@ class pyDecorator(object):
     Note: def print doesn't work in Python 2.x so we will not use it.
     '''
 
-    for each_msg in pargs:
-      if pyDecorator.getLog():
+    if pyDecorator._held is not None or pyDecorator._lastCall is not None:
+      pyDecorator._flushCollapsed()
+
+    pyDecorator._write( *pargs )
+
+
+  @staticmethod
+  def _write(*pargs):
+    r'''
+    Prints to output and to logfile without looking at what _collapseRepeats
+    holds back. Only the collapsing methods should call this directly.
+    '''
+
+    buffer = pyDecorator._buffer
+    if buffer is not None:
+      for each_msg in pargs:
+        buffer.append(each_msg)
+      return
+
+    pyDecorator._emit(pargs)
+
+
+  @staticmethod
+  def _emit(messages):
+    r'''
+    Writes messages to output and to logfile now. This is the sink of the
+    event buffer.
+    '''
+
+    config = pyDecorator._config
+
+    for each_msg in messages:
+      if isinstance(each_msg, _pyDeferredArgs):
+        pyDecorator._emit(each_msg.render())
+        continue
+
+      if config.log:
         logging.info( each_msg )
-      print( each_msg )
+      if config.echo:
+        print( each_msg )
 
 
   @staticmethod
@@ -309,20 +2743,25 @@ class pyDecorator(object):
     A static global variant method that pprints both to output and to logfile
     '''
 
+    if pyDecorator._held is not None or pyDecorator._lastCall is not None:
+      pyDecorator._flushCollapsed()
+
+    if pyDecorator._buffer is not None:
+      pyDecorator._write( *[ pformat(each_msg) for each_msg in pargs ] )
+      return
+
     for each_msg in pargs:
       if pyDecorator.getLog():
         logging.info( each_msg )
-      pprint( each_msg )
+      if pyDecorator._config.echo:
+        pprint( each_msg )
 
   def _print(self, *pargs):
     r'''
     A local private variant method that prints both to output and to logfile
     '''
 
-    for each_msg in pargs:
-      if self._log:
-        logging.info( each_msg )
-      print( each_msg )
+    pyDecorator.__print( *pargs )
 
 
   def _pprint(self, *pargs):
@@ -330,10 +2769,7 @@ class pyDecorator(object):
     A local private variant method that pprints both to output and to logfile
     '''
 
-    for each_msg in pargs:
-      if self._log:
-        logging.info( each_msg )
-      pprint( each_msg )
+    pyDecorator.__pprint( *pargs )
 
   ###########################################################################
 
@@ -344,7 +2780,8 @@ class pyDecorator(object):
     should print out its header.
     '''
 
-    self.count += 1
+    with pyDecorator._lock:
+      self.count += 1
 
     if self._debug:
       pyDecorator.__print(
@@ -383,8 +2820,8 @@ class pyDecorator(object):
           i += 1
 
       else:
-        pyDecorator.__print(
-          '>>Number of functions already called %i' % callstats()[0] )
+        pyDecorator.__print( '>>Frames are not available, number of '
+          'functions already called %i' % pyDecorator.getCallCount() )
 
     except ValueError:
       pass
@@ -414,48 +2851,294 @@ class pyDecorator(object):
                          calls this method.
     '''
 
-    _verbosity = pyDecorator._verbosity
+    _verbosity = pyDecorator._config.verbosity
+
+    if _getframe is None:
+      pyDecorator.__print( '>>Frames are not available' )
+      return
 
     frame = _getframe(frameIndex)
     frameCode = frame.f_code
 
-    pyDecorator.__print( '>>Function %s' % frameCode.co_name )
+    # Everything but the line number only depends on the code object
+    codeText = pyDecorator._codeText.get(frameCode)
+    if codeText is not None:
+      codeText = codeText.get(
+        (frameCode.co_filename, frameCode.co_firstlineno) )
+    if codeText is None:
+      codeText = pyDecorator._formatCode(frameCode)
+
+    pyDecorator.__print( codeText[0] )
 
     if _verbosity >= 1:
-      pyDecorator.__print( '>>File \'%s\', line %i, in %s, argcount %i' % (
-          frameCode.co_filename, frame.f_lineno, frameCode.co_name,
-          frameCode.co_argcount)
-        )
+      pyDecorator.__print( codeText[1] + str(frame.f_lineno) + codeText[2] )
 
     if _verbosity >= 2:
-      pyDecorator.__print( '>>>Locals in the function are:' )
-      pyDecorator.__pprint( frame.f_locals )
+      if pyDecorator._diffLocals:
+        pyDecorator._printLocalsDiff(frame)
+      else:
+        pyDecorator.__print( '>>>Locals in the function are:' )
+        pyDecorator.__pprint( frame.f_locals )
 
       if _verbosity >= 3:
+        if codeText[3] is None:
+          codeText[3] = pformat(frameCode.co_consts)
+
         pyDecorator.__print( '>>>Constants set are:' )
-        pyDecorator.__pprint(frameCode.co_consts)
+        pyDecorator.__print( codeText[3] )
+
+
+  @staticmethod
+  def _formatCode(frameCode):
+    r'''
+    Formats, once per code object, the parts of printCurFrame's output that
+    come from it alone and caches them in _codeText. Returns a list of the
+    function line, the header before and after the line number, and the
+    formatted constants, left None until first needed.
+    '''
+
+    codeText = [
+      '>>Function %s' % frameCode.co_name,
+      '>>File \'%s\', line ' % frameCode.co_filename,
+      ', in %s, argcount %i' % (frameCode.co_name, frameCode.co_argcount),
+      None,
+    ]
+
+    try:
+      texts = pyDecorator._codeText.get(frameCode)
+      if texts is None:
+        texts = pyDecorator._codeText[frameCode] = {}
+    except TypeError:
+      # Code objects can not be weakly referenced here, so do not cache
+      return codeText
+
+    texts[(frameCode.co_filename, frameCode.co_firstlineno)] = codeText
+
+    return codeText
+
+
+  @staticmethod
+  def _printLocalsDiff(frame):
+    r'''
+    Prints the locals of frame that were added or changed since it was last
+    dumped, and the names that were removed. Nothing is formatted to find
+    out what changed, see _fingerprint. The first dump of a frame prints all
+    of its locals.
+
+    Frames can not be weakly referenced, so the calling thread keeps each
+    frame it dumped with its locals, which also keeps its id from being
+    reused. Frames no longer on the stack are dropped at every dump and
+    whenever a decorated call of the thread ends, see _pruneLocals, so the
+    frame of a decorated call and its locals can be collected once it
+    returns. A suspended generator is off the stack too, so the first dump
+    after it resumes prints all of its locals again.
+    '''
+
+    f_locals = frame.f_locals
+    fingerprint = pyDecorator._fingerprint
+
+    current = dict( (name, fingerprint(value))
+      for name, value in f_locals.items() )
+
+    snapshots = pyDecorator._state().locals
+
+    if snapshots:
+      pyDecorator._pruneLocals(snapshots)
+
+    last = snapshots.get(id(frame))
+    snapshots[id(frame)] = (frame, current)
+
+    if last is None:
+      pyDecorator.__print( '>>>Locals in the function are:' )
+      pyDecorator.__pprint( f_locals )
+      return
+
+    last = last[1]
+    changed = dict( (name, f_locals[name])
+      for name, value in current.items() if last.get(name) != value )
+    removed = sorted( name for name in last if name not in current )
+
+    if not changed and not removed:
+      pyDecorator.__print( '>>>Locals unchanged since the last dump' )
+      return
+
+    if changed:
+      pyDecorator.__print( '>>>Locals added or changed since the last dump:' )
+      pyDecorator.__pprint( changed )
+
+    if removed:
+      pyDecorator.__print( '>>>Locals removed since the last dump: %s' %
+        ', '.join(removed) )
+
+
+  @staticmethod
+  def _pruneLocals(snapshots):
+    r'''
+    Drops from snapshots, the locals dumped by the calling thread by frame
+    id, the frames no longer on its stack.
+    '''
+
+    live = set()
+    each = _getframe(0) if _getframe is not None else None
+    while each is not None:
+      live.add(id(each))
+      each = each.f_back
+
+    for key in [ key for key in snapshots if key not in live ]:
+      del snapshots[key]
+
+
+  @staticmethod
+  def _fingerprint(value):
+    r'''
+    Returns a cheap value that changes when value does: its identity and hash
+    or, for containers that cannot be hashed, their length and the identity
+    of their members. A change nested deeper than the first level of a
+    container is not seen.
+    '''
+
+    try:
+      return (id(value), hash(value))
+    except Exception:
+      pass
+
+    try:
+      if isinstance(value, dict):
+        return (id(value), len(value), tuple(map(id, value)),
+          tuple(map(id, value.values())))
+      return (id(value), len(value), tuple(map(id, value)))
+    except Exception:
+      return (id(value),)
 
 
   @staticmethod
-  def printGlobals():
+  def printGlobals(include=None, frameIndex=0):
     r'''
-    Prints the current globals seen from the source code. Note, this is the
-    same regardless of what frame we are on.
+    Prints the globals of the module of the frameIndexth frame on the stack.
+    By default that is pyDecorator's own module, as it always was, pass
+    frameIndex=1 for the module of the function that calls this. Note, this
+    is the same regardless of which function of that module we are in.
+
+    With _diffGlobals set only what changed since the last call for the same
+    module is printed, followed by a one line summary.
+
+    Arguments:
+
+        include          A glob pattern, or list of them, restricting what is
+                         printed to the names that match.
+
+        frameIndex       Which frame's module to print, as in printCurFrame.
     '''
 
-    pyDecorator.__print( '>>>Globals seen are:' )
-    pyDecorator.__pprint( _getframe(0).f_globals )
+    if _getframe is None:
+      pyDecorator.__print( '>>Frames are not available' )
+      return
+
+    f_globals = _getframe(frameIndex).f_globals
+
+    pyDecorator._printNamespace( 'Globals', f_globals,
+      f_globals.get('__name__'), include )
 
 
   @staticmethod
-  def printBuiltins():
+  def printBuiltins(include=None, frameIndex=0):
     r'''
     Prints the current builtins seen from the source code. Note, this is the
-    same regardless of what frame we are on.
+    same regardless of what frame we are on. See printGlobals for the
+    arguments and for _diffGlobals.
+    '''
+
+    if _getframe is None:
+      pyDecorator.__print( '>>Frames are not available' )
+      return
+
+    pyDecorator._printNamespace( 'Builtins', _getframe(frameIndex).f_builtins,
+      None, include )
+
+
+  @staticmethod
+  def _printNamespace(title, namespace, module, include):
+    r'''
+    Prints namespace, either in full or, with _diffGlobals set, as the delta
+    from the snapshot last taken of the same title and module. Changes are
+    found by comparing the names and the identity of their values, so
+    nothing is formatted unless it is printed. The snapshot holds each value,
+    weakly when it can, see _holdValue, so a value replaced by a new one at
+    the same address is still seen as changed.
+    '''
+
+    if isinstance(include, str):
+      include = [include]
+
+    if include:
+      namespace = dict( (name, value) for name, value in namespace.items()
+        if any(fnmatchcase(name, pattern) for pattern in include) )
+
+    if not pyDecorator._diffGlobals:
+      pyDecorator.__print( '>>>%s seen are:' % title )
+      pyDecorator.__pprint( namespace )
+      return
+
+    key = (title, module, tuple(include or ()))
+    holdValue = pyDecorator._holdValue
+    current = dict( (name, holdValue(value))
+      for name, value in namespace.items() )
+    last = pyDecorator._namespaceSnapshots.get(key)
+    pyDecorator._namespaceSnapshots[key] = current
+
+    if last is None:
+      pyDecorator.__print( '>>>%s seen are:' % title )
+      pyDecorator.__pprint( namespace )
+      added, changed, removed = len(current), 0, []
+
+    else:
+      heldValue = pyDecorator._heldValue
+      delta = dict( (name, value) for name, value in namespace.items()
+        if name not in last or heldValue(last[name]) is not value )
+      removed = sorted( name for name in last if name not in current )
+      added = sum( 1 for name in delta if name not in last )
+      changed = len(delta) - added
+
+      if delta:
+        pyDecorator.__print( '>>>%s added or changed since the last dump:' %
+          title )
+        pyDecorator.__pprint( delta )
+
+      if removed:
+        pyDecorator.__print( '>>>%s removed since the last dump: %s' %
+          (title, ', '.join(removed)) )
+
+    pyDecorator.__print( '>>>%s: %i names, %i added, %i changed, %i removed' %
+      (title, len(current), added, changed, len(removed)) )
+
+
+  @staticmethod
+  def _holdValue(value):
+    r'''
+    Returns what a namespace snapshot keeps of value: a weak reference when
+    value has them, else value itself, so its address can not be reused
+    while it is kept.
+    '''
+
+    try:
+      return (True, ref(value))
+    except TypeError:
+      return (False, value)
+
+
+  @staticmethod
+  def _heldValue(held):
+    r'''
+    Returns the value kept by _holdValue or, if it was collected, held
+    itself, which is the value of no name.
     '''
 
-    pyDecorator.__print( '>>>Builtins seen are:' )
-    pyDecorator.__pprint( _getframe(0).f_builtins )
+    weak, value = held
+    if not weak:
+      return value
+
+    value = value()
+    return held if value is None else value
 
 
   ###########################################################################
@@ -502,6 +3185,342 @@ class pyDecorator(object):
 
 # End of pyDecorator class
 
+class _pyFold(object):
+  r'''
+  Counters of one recursive call tree folded by pyDecorator. Levels are
+  counted from 1, the root call.
+  '''
+
+  __slots__ = ('root', 'depth', 'calls', 'errors', 'callsPerLevel',
+    'timePerLevel', 'top')
+
+  def __init__(self, root):
+    self.root = root
+    self.depth = 1
+    self.calls = 1
+    self.errors = 0
+    self.callsPerLevel = [1]
+    self.timePerLevel = [0.0]
+    self.top = []
+
+
+  def enter(self):
+    r'''
+    Accounts for a recursive call one level deeper.
+    '''
+
+    self.depth += 1
+    self.calls += 1
+
+    if self.depth > len(self.callsPerLevel):
+      self.callsPerLevel.append(0)
+      self.timePerLevel.append(0.0)
+
+    self.callsPerLevel[self.depth - 1] += 1
+
+
+  def exit(self, callNumber, elapsed, failed, topK):
+    r'''
+    Accounts for the end of the call at the current depth, keeping it if it
+    is one of the topK most expensive below the root.
+    '''
+
+    self.timePerLevel[self.depth - 1] += elapsed
+    if failed:
+      self.errors += 1
+
+    if topK and self.depth > 1:
+      entry = (elapsed, callNumber, self.depth)
+      if len(self.top) < topK:
+        heappush(self.top, entry)
+      elif entry > self.top[0]:
+        heapreplace(self.top, entry)
+
+    self.depth -= 1
+
+
+class _pyTokenBucket(object):
+  r'''
+  Token bucket of the calls of one function pyDecorator may print. It holds
+  up to one second worth of tokens, and at least one.
+  '''
+
+  __slots__ = ('rate', 'tokens', 'last', 'dropped')
+
+  def __init__(self, rate):
+    self.rate = rate
+    self.tokens = max(1.0, rate)
+    self.last = _clock()
+    self.dropped = 0
+
+
+  def take(self, now):
+    r'''
+    Refills the bucket for the time elapsed and takes a token if there is
+    one. A rate of 0 means no limit.
+    '''
+
+    if not self.rate:
+      return True
+
+    self.tokens = min(max(1.0, self.rate),
+      self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+    if self.tokens >= 1.0:
+      self.tokens -= 1.0
+      return True
+    return False
+
+
+class _pyGovernor(object):
+  r'''
+  What the pyDecorator overhead governor measured in the current window and
+  the steps down it took, last one last, as the name of what each lowered.
+
+  Each thread adds its calls to its own _pyGovernorShard so accounting takes
+  no lock. The shards are summed by the one call that closes the window.
+
+  The run time of a call includes the overhead of the decorated calls it
+  makes, so nested calls make the overhead look a little smaller than it is.
+  '''
+
+  __slots__ = ('window', 'start', 'steps', 'calm', 'calmWindows', 'lock',
+    'shards', 'local')
+
+  def __init__(self, window, calmWindows=5):
+    self.lock = Lock()
+    self.window = window
+    self.start = _clock()
+    self.steps = []
+    self.calm = 0
+    self.calmWindows = calmWindows
+    self.shards = []
+    self.local = local()
+
+
+  def account(self, overhead, runtime):
+    r'''
+    Adds a call. When the window is over, returns what close does, to the
+    one call that ended it, else None.
+    '''
+
+    try:
+      shard = self.local.shard
+    except AttributeError:
+      shard = _pyGovernorShard()
+      with self.lock:
+        self.shards.append(shard)
+      self.local.shard = shard
+
+    shard.overhead += overhead
+    shard.runtime += runtime
+
+    if _clock() - self.start < self.window:
+      return None
+
+    with self.lock:
+      # Another thread may have closed it while we waited
+      if _clock() - self.start < self.window:
+        return None
+      return self.close()
+
+
+  def close(self):
+    r'''
+    Returns the overhead of the window as a share of the run time and
+    starts the next one. Called under lock.
+    '''
+
+    overhead = runtime = 0.0
+    live = []
+
+    for shard in self.shards:
+      overhead += shard.overhead - shard.seenOverhead
+      runtime += shard.runtime - shard.seenRuntime
+      shard.seenOverhead = shard.overhead
+      shard.seenRuntime = shard.runtime
+
+      # A thread that ended adds nothing more, its calls are in this window
+      thread = shard.thread()
+      if thread is not None and thread.is_alive():
+        live.append(shard)
+
+    self.shards = live
+
+    if runtime > 0:
+      ratio = overhead / runtime
+    else:
+      ratio = float('inf') if overhead > 0 else 0.0
+
+    self.start = _clock()
+
+    return ratio
+
+
+class _pyGovernorShard(object):
+  r'''
+  The overhead and run time one thread accounted to the governor, only ever
+  grown by it. The seen totals are what earlier windows already counted, so
+  closing a window never writes what the thread writes.
+  '''
+
+  __slots__ = ('thread', 'overhead', 'runtime', 'seenOverhead',
+    'seenRuntime')
+
+  def __init__(self):
+    self.thread = ref(current_thread())
+    self.overhead = 0.0
+    self.runtime = 0.0
+    self.seenOverhead = 0.0
+    self.seenRuntime = 0.0
+
+
+class _pyThreadState(object):
+  r'''
+  The call counters of one thread, only ever changed by it. Call numbers
+  nextNumber up to, but not including, endNumber are its to hand out.
+  '''
+
+  __slots__ = ('thread', 'ident', 'depth', 'calls', 'nextNumber',
+    'endNumber', 'tree', 'treeFailed', 'treeDropped', 'treesKept',
+    'treesDropped', 'folds', 'deferred', 'running', 'locals')
+
+  def __init__(self):
+    self.thread = ref(current_thread())
+    self.ident = get_ident()
+    self.depth = 0
+    self.calls = 0
+    self.nextNumber = 0
+    self.endNumber = 0
+
+    # The call tree held back by tail sampling, see pyDecorator._treeEnter
+    self.tree = None
+    self.treeFailed = False
+    self.treeDropped = 0
+    self.treesKept = 0
+    self.treesDropped = 0
+
+    # Recursive call trees being folded, qualname -> _pyFold, and the
+    # argument snapshots of its calls printed at their end, (strategy,
+    # snapshot) by call number
+    self.folds = {}
+    self.deferred = {}
+
+    # The numbers of the calls the thread is in, innermost last
+    self.running = []
+
+    # The frames on its stack printCurFrame dumped in _diffLocals mode, and
+    # their locals then, id(frame) -> (frame, {name: fingerprint})
+    self.locals = {}
+
+
+class _pyAwaitedSpan(object):
+  r'''
+  The coroutine of a call to a decorated async function, made current in
+  span while it runs, a step at a time. The span ends when the coroutine
+  returns or raises, so it covers the await and not only creating it. It
+  has the methods of a coroutine, so it can be awaited or made a task.
+  '''
+
+  __slots__ = ('coroutine', 'span', 'name', 'start', 'steps')
+
+  def __init__(self, coroutine, span, name, start):
+    self.coroutine = coroutine
+    self.span = span
+    self.name = name
+    self.start = start
+    self.steps = None
+
+
+  def __await__(self):
+    return self
+
+
+  def __iter__(self):
+    return self
+
+
+  def __next__(self):
+    return self.send(None)
+
+
+  def send(self, value):
+    return self._step('send', value)
+
+
+  def throw(self, *error):
+    return self._step('throw', *error)
+
+
+  def close(self):
+    self.coroutine.close()
+
+
+  def _step(self, method, *args):
+    r'''
+    Runs one step of the coroutine with the span current, and ends the span
+    when that step returns or raises.
+    '''
+
+    if self.steps is None:
+      self.steps = self.coroutine.__await__()
+
+    token = _spanContext.set(self.span)
+    try:
+      return getattr(self.steps, method)(*args)
+    except BaseException:
+      traceId, spanId, parentId = self.span
+      pyDecorator._finishedSpans.append((traceId, spanId, parentId,
+        self.name, self.start, _clock() - self.start))
+      raise
+    finally:
+      _spanContext.reset(token)
+
+
+class _pyDeferredArgs(object):
+  r'''
+  The arguments of a call as a snapshot, appended to the pyEventBuffer in
+  place of their text so that the flusher renders them, see
+  pyDecorator._snapshotMessages.
+  '''
+
+  __slots__ = ('strategy', 'snapshot')
+
+  def __init__(self, strategy, snapshot):
+    self.strategy = strategy
+    self.snapshot = snapshot
+
+
+  def render(self):
+    r'''
+    Returns the messages printing the arguments. Never raises, the flusher
+    would die with it.
+    '''
+
+    try:
+      return pyDecorator._renderSnapshot(self.strategy, self.snapshot)[1]
+    except Exception:
+      error = exc_info()[1]
+      return [ '>>Could not print the args, %s raised: %s' %
+        (type(error).__name__, error) ]
+
+
+class _pyConfig(namedtuple('_pyConfig', ('debug', 'log', 'verbosity',
+    'captureLocals', 'foldRecursion', 'foldTopK', 'rateLimited',
+    'sampleEvery', 'collapseRepeats', 'snapshot', 'snapshots', 'echo',
+    'spans', 'tailSampling', 'tailSlowMs', 'tailRate'))):
+  r'''
+  The pyDecorator flags read for every call, see pyDecorator._publish.
+  '''
+
+  __slots__ = ()
+
+
+pyDecorator._publish()
+pyDecorator._pickFrameBackend()
+
+
 def pyDecorator_test():
   r'''
   Test function for pyDecorator
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyEventBuffer class
+Per thread buffers of the records pyDecorator prints, and a flusher that
+merges them by timestamp into the sink. Threads calling decorated functions
+then never wait on stdout or the logging handler lock, and each record is
+written whole.
+
+Usage:
+
+  pyDecorator.setBuffered(True)
+
+  python pyEventBuffer.py [events per thread]
+
+runs the contention benchmark.
+
+Created by unsignedzero (David Tran)
+'''
+
+import atexit
+import sys
+import threading
+from collections import deque
+from heapq import heappop, heappush
+
+try:
+  from cStringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+# Same clock as pyDecorator, which imports this module
+try:
+  from time import perf_counter as _clock
+except ImportError:
+  from time import time as _clock
+
+class pyEventBuffer(object):
+  r'''
+  Records appended by many threads, written to sink in timestamp order.
+
+  Every thread appends to its own deque, so appending takes no lock shared
+  with other threads. The flusher drains the deques into a heap ordered by
+  (timestamp, shard, sequence) and hands sink the records older than grace
+  seconds, in order. Newer ones wait for the next flush, as a thread may
+  still be about to append one it timed earlier.
+
+  Warning:
+
+  A record appended after a final flush, the one stop makes, is only
+  written by the next flush. A thread that takes longer than grace between
+  timing a record and appending it can still have it written out of order.
+  '''
+
+  def __init__(self, sink, interval=0.1, grace=None):
+    r'''
+    Initializes empty buffers. sink is called with a list of records, in
+    timestamp order, on every flush that has some. The flusher thread, once
+    started, flushes every interval seconds. grace defaults to interval.
+    '''
+
+    self.sink = sink
+    self.interval = interval
+    self.grace = interval if grace is None else grace
+
+    self._local = threading.local()
+    self._lock = threading.Lock()        # Guards _shards only
+    self._shards = []
+    self._shardCount = 0
+    self._pending = []
+    self._flushLock = threading.Lock()
+    self._thread = None
+    self._stopping = threading.Event()
+
+
+  def _shard(self):
+    r'''
+    Returns the calling thread's shard, creating it on its first call.
+    '''
+
+    try:
+      return self._local.shard
+    except AttributeError:
+      with self._lock:
+        shard = _pyEventShard(self._shardCount)
+        self._shardCount += 1
+        self._shards.append(shard)
+      self._local.shard = shard
+      return shard
+
+
+  ###########################################################################
+  # Appending
+
+  def append(self, record):
+    r'''
+    Appends record, timed now, to the calling thread's buffer.
+    '''
+
+    try:
+      shard = self._local.shard
+    except AttributeError:
+      shard = self._shard()
+
+    shard.sequence += 1
+    shard.events.append((_clock(), shard.index, shard.sequence, record))
+
+
+  ###########################################################################
+  # Flushing
+
+  def flush(self, everything=False):
+    r'''
+    Drains every buffer and writes the records old enough to sink, or all
+    of them if everything is set. Returns how many were written.
+    '''
+
+    with self._flushLock:
+      with self._lock:
+        shards = list(self._shards)
+
+      horizon = _clock() - (0.0 if everything else self.grace)
+      pending = self._pending
+
+      for shard in shards:
+        events = shard.events
+
+        # Only as many as are there now, the owner may be appending more
+        for each in range(len(events)):
+          heappush(pending, events.popleft())
+
+        if not events and not shard.thread.is_alive():
+          with self._lock:
+            self._shards.remove(shard)
+
+      ready = []
+      while pending and (everything or pending[0][0] <= horizon):
+        ready.append(heappop(pending)[3])
+
+      if ready:
+        self.sink(ready)
+
+    return len(ready)
+
+
+  def start(self):
+    r'''
+    Starts the flusher, a daemon thread, and makes sure the buffers are
+    flushed at exit.
+    '''
+
+    if self._thread is not None:
+      return
+
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._run, name='pyEventBuffer')
+    self._thread.daemon = True
+    self._thread.start()
+    atexit.register(self.stop)
+
+
+  def _run(self):
+    r'''
+    The flusher loop.
+    '''
+
+    while not self._stopping.wait(self.interval):
+      self.flush()
+
+
+  def stop(self):
+    r'''
+    Stops the flusher and writes everything still buffered.
+    '''
+
+    if self._thread is not None:
+      self._stopping.set()
+      self._thread.join()
+      self._thread = None
+      if hasattr(atexit, 'unregister'):
+        atexit.unregister(self.stop)
+
+    self.flush(everything=True)
+
+
+  ###########################################################################
+  # Benchmark
+
+  @staticmethod
+  def measureContention(threadCounts=(1, 2, 4, 8, 16, 32, 64),
+      events=10000):
+    r'''
+    Times threads appending events records each, for every count of threads
+    in threadCounts, to a pyEventBuffer and to an in memory stream behind one
+    shared lock, the way records reach a logging StreamHandler. Returns, per
+    count, a dict of the records appended per second by each.
+    '''
+
+    results = {}
+
+    for threads in threadCounts:
+      buffered = pyEventBuffer(lambda records: None)
+      stream = StringIO()
+      lock = threading.Lock()
+
+      def appendLocked(record):
+        with lock:
+          stream.write('%s\n' % record)
+
+      results[threads] = {
+        'buffered': pyEventBuffer._rate(buffered.append, threads, events),
+        'locked': pyEventBuffer._rate(appendLocked, threads, events),
+      }
+      buffered.flush(everything=True)
+
+    return results
+
+
+  @staticmethod
+  def _rate(append, threads, events):
+    r'''
+    Starts threads threads together, each calling append events times, and
+    returns the calls made per second.
+    '''
+
+    gate = threading.Event()
+
+    def work():
+      gate.wait()
+      for each in range(events):
+        append(each)
+
+    workers = [ threading.Thread(target=work) for each in range(threads) ]
+    for worker in workers:
+      worker.start()
+
+    start = _clock()
+    gate.set()
+    for worker in workers:
+      worker.join()
+    elapsed = _clock() - start
+
+    return threads * events / elapsed if elapsed > 0 else float('inf')
+
+# End of pyEventBuffer class
+
+class _pyEventShard(object):
+  r'''
+  The buffer of one thread. Only the owner appends to events and touches
+  sequence, the flusher only pops from the left.
+  '''
+
+  __slots__ = ('index', 'sequence', 'events', 'thread')
+
+  def __init__(self, index):
+    self.index = index
+    self.sequence = 0
+    self.events = deque()
+    self.thread = threading.current_thread()
+
+
+if __name__ == '__main__':
+  perThread = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  results = pyEventBuffer.measureContention(events=perThread)
+
+  print( '%8s %16s %16s' % ('threads', 'buffered/s', 'locked/s') )
+  for threads in sorted(results):
+    print( '%8i %16.0f %16.0f' % (threads, results[threads]['buffered'],
+      results[threads]['locked']) )
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyHistogram class
+Fixed memory, log bucketed (HDR style) latency histogram used by pyDecorator
+to answer percentile questions over any number of calls without keeping the
+samples themselves.
+
+Created by unsignedzero (David Tran)
+'''
+
+import threading
+from array import array
+from functools import partial
+from weakref import ref
+
+# Counters are 64 bits wide, 'L' is only 32 on Windows. Python 2 has no 'Q',
+# its 'L' is the widest there is.
+try:
+  array('Q')
+  _counterType = 'Q'
+except ValueError:
+  _counterType = 'L'
+
+class pyHistogram(object):
+  r'''
+  Records durations, in seconds, into log bucketed counters. Values are kept
+  as integer nanoseconds. Every power of two range is split into
+  2**(_subBucketBits - 1) linear sub-buckets, so a reported value is never
+  more than about 3% away from the recorded one, and a bucket array for
+  values up to hours stays around 10KB.
+
+  Each thread records into its own shard so the hot path takes no lock. The
+  shards are merged whenever the histogram is read. When a thread ends its
+  shard is folded into a retired one and dropped.
+
+  Warning:
+
+  reset zeroes the shards in place without stopping the threads writing to
+  them, so a call recorded while resetting may be kept or lost.
+  '''
+
+  _subBucketBits = 6
+  _subBucketHalf = 1 << (_subBucketBits - 1)
+
+  def __init__(self, name=''):
+    r'''
+    Initializes an empty histogram. name is only used in reports.
+    '''
+
+    self.name = name
+    self._local = threading.local()
+    # Reentrant as a shard may be retired by a collection under it
+    self._lock = threading.RLock()
+    self._shards = []
+    self._retired = _pyHistogramShard()
+
+
+  def _shard(self):
+    r'''
+    Returns the calling thread's shard, creating it on its first call.
+    '''
+
+    try:
+      return self._local.shard
+    except AttributeError:
+      shard = _pyHistogramShard()
+
+      # The owner lives in the thread's local dict, which is dropped when the
+      # thread ends, calling back to retire the shard
+      owner = _pyShardOwner()
+      shard.owner = ref(owner, partial(pyHistogram._retire, ref(self), shard))
+
+      with self._lock:
+        self._shards.append(shard)
+      self._local.shard = shard
+      self._local.owner = owner
+      return shard
+
+
+  @staticmethod
+  def _retire(histogram, shard, owner):
+    r'''
+    Folds the shard of a thread that ended into a new retired shard and drops
+    it, unless the histogram, a weak reference, is gone. Both are swapped
+    under the lock so a reader sees the counts once.
+    '''
+
+    histogram = histogram()
+    if histogram is None:
+      return
+
+    with histogram._lock:
+      retired = _pyHistogramShard()
+      retired.add(histogram._retired)
+      retired.add(shard)
+
+      histogram._shards = [ each for each in histogram._shards
+        if each is not shard ]
+      histogram._retired = retired
+
+
+  ###########################################################################
+  # Recording
+
+  def record(self, seconds):
+    r'''
+    Records one duration given in seconds.
+    '''
+
+    value = int(seconds * 1e9)
+
+    try:
+      shard = self._local.shard
+    except AttributeError:
+      shard = self._shard()
+
+    counts = shard.counts
+    index = pyHistogram._index(value)
+
+    if index >= len(counts):
+      counts.extend([0] * (index + 1 - len(counts)))
+
+    counts[index] += 1
+    shard.count += 1
+    shard.total += value
+    if value > shard.max:
+      shard.max = value
+
+
+  @staticmethod
+  def _index(value):
+    r'''
+    Returns the bucket index of value, in nanoseconds.
+    '''
+
+    if value < 0:
+      return 0
+
+    shift = value.bit_length() - pyHistogram._subBucketBits
+
+    if shift <= 0:
+      return value
+    return (shift << (pyHistogram._subBucketBits - 1)) + (value >> shift)
+
+
+  @staticmethod
+  def _highestValue(index):
+    r'''
+    Returns the largest value, in nanoseconds, that lands in bucket index.
+    '''
+
+    if index < 2 * pyHistogram._subBucketHalf:
+      return index
+
+    shift = (index >> (pyHistogram._subBucketBits - 1)) - 1
+    mantissa = index - (shift << (pyHistogram._subBucketBits - 1))
+    return ((mantissa + 1) << shift) - 1
+
+
+  ###########################################################################
+  # Reading
+
+  def merged(self):
+    r'''
+    Merges every thread's shard and returns (counts, count, total, max) with
+    counts an array of bucket counts and the rest in nanoseconds.
+    '''
+
+    with self._lock:
+      shards = [self._retired] + self._shards
+
+    merged = _pyHistogramShard()
+
+    for shard in shards:
+      merged.add(shard)
+
+    return merged.counts, merged.count, merged.total, merged.max
+
+
+  @staticmethod
+  def percentileOf(counts, count, maximum, fraction):
+    r'''
+    Returns the value, in seconds, below which fraction (0 to 1) of the count
+    values in the merged bucket counts fall.
+    '''
+
+    if not count:
+      return 0.0
+
+    wanted = max(1, int(fraction * count + 0.5))
+    seen = 0
+
+    for index, bucket in enumerate(counts):
+      seen += bucket
+      if seen >= wanted:
+        return min(pyHistogram._highestValue(index), maximum) / 1e9
+
+    return maximum / 1e9
+
+
+  def percentile(self, fraction):
+    r'''
+    Returns the fraction (0 to 1) percentile, in seconds.
+    '''
+
+    counts, count, total, maximum = self.merged()
+    return pyHistogram.percentileOf(counts, count, maximum, fraction)
+
+
+  def snapshot(self):
+    r'''
+    Returns a dict with the count, mean, p50, p90, p99, p999 and max of the
+    recorded values (all times in seconds) as well as the merged bucket
+    counts, for later merging or comparing.
+    '''
+
+    counts, count, total, maximum = self.merged()
+
+    snap = {
+      'name'  : self.name,
+      'count' : count,
+      'mean'  : (total / 1e9 / count) if count else 0.0,
+      'max'   : maximum / 1e9,
+      'counts': counts,
+    }
+
+    for key, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+        ('p999', 0.999)):
+      snap[key] = pyHistogram.percentileOf(counts, count, maximum, fraction)
+
+    return snap
+
+
+  def reset(self):
+    r'''
+    Forgets everything recorded so far. See the class warning.
+    '''
+
+    with self._lock:
+      shards = list(self._shards)
+      self._retired = _pyHistogramShard()
+
+    for shard in shards:
+      shard.counts = array(_counterType)
+      shard.count = shard.total = shard.max = 0
+
+
+  ###########################################################################
+  # Reports
+
+  _reportHeader = '%-40s %10s %10s %10s %10s %10s %10s' % (
+    'function', 'calls', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+
+  @staticmethod
+  def report(snapshots):
+    r'''
+    Formats a list of snapshots as a text table, one function per line,
+    with times in milliseconds.
+    '''
+
+    lines = [pyHistogram._reportHeader]
+
+    for snap in snapshots:
+      lines.append('%-40s %10i %10.3f %10.3f %10.3f %10.3f %10.3f' % (
+        snap['name'], snap['count'], snap['mean'] * 1e3, snap['p50'] * 1e3,
+        snap['p90'] * 1e3, snap['p99'] * 1e3, snap['max'] * 1e3))
+
+    return '\n'.join(lines)
+
+# End of pyHistogram class
+
+class _pyHistogramShard(object):
+  r'''
+  One thread's counters of a pyHistogram, or those of the threads that
+  ended. owner is the weak reference that retires it.
+  '''
+
+  __slots__ = ('counts', 'count', 'total', 'max', 'owner')
+
+  def __init__(self):
+    self.counts = array(_counterType)
+    self.count = 0
+    self.total = 0
+    self.max = 0
+    self.owner = None
+
+
+  def add(self, other):
+    r'''
+    Adds the counters of other to ours.
+    '''
+
+    counts = self.counts
+    otherCounts = other.counts
+    if len(otherCounts) > len(counts):
+      counts.extend([0] * (len(otherCounts) - len(counts)))
+    for index, bucket in enumerate(otherCounts):
+      if bucket:
+        counts[index] += bucket
+    self.count += other.count
+    self.total += other.total
+    self.max = max(self.max, other.max)
+
+class _pyShardOwner(object):
+  r'''
+  Kept only in a thread's local dict, so it dies with the thread.
+  '''
+
+  __slots__ = ('__weakref__',)
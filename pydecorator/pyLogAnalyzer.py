@@ -0,0 +1,255 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyLogAnalyzer class
+Streams through a logfile written by pyDecorator, in constant memory, and
+reports per function call counts and durations, the deepest nesting of
+calls and the slowest calls.
+
+The file is read in large binary chunks and the records are found with one
+regular expression run over each chunk, so only the lines holding a call
+record are ever turned into objects.
+
+Usage:
+
+  python pyLogAnalyzer.py logfile [top]
+
+Created by unsignedzero (David Tran)
+'''
+
+import re
+import sys
+from heapq import heappush, heapreplace
+from time import time
+
+class pyLogAnalyzer(object):
+  r'''
+  Accumulates the call records fed to it. Each format is a parser, a
+  function taking the analyzer and a chunk of whole lines, in formats.
+
+  The records understood in the text format, the one pyDecorator writes,
+  are the start and end records, whose duration is the 'in ...s' _verbosity
+  1 and up adds, and the single records of calls with a latency budget.
+
+  Warning:
+
+  The depth is the number of calls started and not yet ended, so calls of
+  several threads written to the same logfile add up. Calls whose end
+  record is missing, like rate limited ones, are forgotten past maxOpen.
+  '''
+
+  _record = re.compile(br'>>(Starting|Ended|Slow|Failed) call to (\S+) '
+    br'\[Call#(\d+)\]([^\n]*)')
+  _took = re.compile(br' took ([0-9.]+)ms')
+
+  def __init__(self, top=10, maxOpen=100000):
+    r'''
+    Initializes empty totals, keeping the top slowest calls.
+    '''
+
+    self.top = top
+    self.maxOpen = maxOpen
+
+    self.functions = {}   # name -> [calls, errors, timed calls, total, max]
+    self.slowest = []     # heap of (seconds, call number, name)
+    self.maxDepth = 0
+    self.unmatched = 0
+    self.bytes = 0
+
+    self._open = {}       # call number -> name, calls started not ended
+
+
+  def _stats(self, name):
+    r'''
+    Returns the totals of the function name, creating them.
+    '''
+
+    stats = self.functions.get(name)
+    if stats is None:
+      stats = self.functions[name] = [0, 0, 0, 0.0, 0.0]
+    return stats
+
+
+  def _ended(self, name, callNumber, seconds, failed):
+    r'''
+    Accounts for a call that ended, after seconds if known.
+    '''
+
+    stats = self._stats(name)
+    stats[0] += 1
+    if failed:
+      stats[1] += 1
+
+    if seconds is None:
+      return
+
+    stats[2] += 1
+    stats[3] += seconds
+    if seconds > stats[4]:
+      stats[4] = seconds
+
+    slowest = self.slowest
+    if len(slowest) < self.top:
+      heappush(slowest, (seconds, int(callNumber), name))
+    elif seconds > slowest[0][0]:
+      heapreplace(slowest, (seconds, int(callNumber), name))
+
+
+  ###########################################################################
+  # Text format
+
+  def _parseText(self, chunk):
+    r'''
+    Accounts for every call record of chunk, a bytes object of whole lines.
+    Call numbers are kept as bytes, only the slowest calls are converted.
+    '''
+
+    opened = self._open
+    maxOpen = self.maxOpen
+    ended = self._ended
+
+    for kind, name, callNumber, rest in \
+        pyLogAnalyzer._record.findall(chunk):
+
+      if kind == b'Starting':
+        if len(opened) >= maxOpen:
+          del opened[next(iter(opened))]
+        opened[callNumber] = name
+        if len(opened) > self.maxDepth:
+          self.maxDepth = len(opened)
+
+      elif kind == b'Ended':
+        if opened.pop(callNumber, None) is None:
+          self.unmatched += 1
+
+        seconds = None
+        if rest[-1:] == b's':
+          before, found, after = rest.rpartition(b' in ')
+          if found:
+            try:
+              seconds = float(after[:-1])
+            except ValueError:
+              pass
+
+        ended(name, callNumber, seconds, b'. Raised ' in rest)
+
+      else:
+        # A call with a latency budget, one record for the whole call
+        took = pyLogAnalyzer._took.search(rest)
+        ended(name, callNumber, took and float(took.group(1)) / 1e3,
+          kind == b'Failed')
+
+
+  formats = { 'text': _parseText }
+
+  ###########################################################################
+  # Reading
+
+  def feed(self, stream, fileFormat='text', chunkSize=1 << 22):
+    r'''
+    Reads stream, a binary file object, to its end in chunks of chunkSize
+    bytes and accounts for its records.
+    '''
+
+    parse = pyLogAnalyzer.formats[fileFormat]
+    remainder = b''
+
+    while True:
+      chunk = stream.read(chunkSize)
+      if not chunk:
+        break
+
+      self.bytes += len(chunk)
+
+      # Only whole lines are parsed, the rest waits for the next chunk
+      end = chunk.rfind(b'\n')
+      if end == -1:
+        remainder += chunk
+        continue
+
+      parse(self, remainder + chunk[:end + 1])
+      remainder = chunk[end + 1:]
+
+    if remainder:
+      parse(self, remainder)
+
+
+  @staticmethod
+  def analyze(path, top=10, fileFormat='text', chunkSize=1 << 22):
+    r'''
+    Returns a pyLogAnalyzer fed the file at path.
+    '''
+
+    analyzer = pyLogAnalyzer(top)
+    with open(path, 'rb') as stream:
+      analyzer.feed(stream, fileFormat, chunkSize)
+    return analyzer
+
+
+  ###########################################################################
+  # Reporting
+
+  def summary(self):
+    r'''
+    Returns the totals as a dict: per function calls, errors, total, mean
+    and max seconds over the timed calls, the deepest nesting and the
+    slowest calls as (seconds, call number, name), slowest first.
+    '''
+
+    functions = {}
+    for name, (calls, errors, timed, total, maximum) in self.functions.items():
+      functions[name.decode('utf-8', 'replace')] = { 'calls': calls,
+        'errors': errors, 'total': total, 'max': maximum,
+        'mean': total / timed if timed else 0.0 }
+
+    slowest = [ (seconds, callNumber, name.decode('utf-8', 'replace'))
+      for seconds, callNumber, name in sorted(self.slowest, reverse=True) ]
+
+    return { 'functions': functions, 'maxDepth': self.maxDepth,
+      'unmatched': self.unmatched, 'slowest': slowest, 'bytes': self.bytes }
+
+
+  def report(self):
+    r'''
+    Formats the summary as text tables.
+    '''
+
+    summary = self.summary()
+    lines = [ '%-40s %12s %8s %12s %10s %10s' % ('function', 'calls',
+      'errors', 'total s', 'mean ms', 'max ms') ]
+
+    for name, stats in sorted(summary['functions'].items(),
+        key=lambda item: item[1]['total'], reverse=True):
+      lines.append('%-40s %12i %8i %12.3f %10.3f %10.3f' % (name[-40:],
+        stats['calls'], stats['errors'], stats['total'],
+        stats['mean'] * 1e3, stats['max'] * 1e3))
+
+    lines.append('')
+    lines.append('Deepest nesting: %i, ends without a start: %i' %
+      (summary['maxDepth'], summary['unmatched']))
+
+    if summary['slowest']:
+      lines.append('')
+      lines.append('Slowest calls:')
+      for seconds, callNumber, name in summary['slowest']:
+        lines.append('  %12.3fms  %s [Call#%03i]' % (seconds * 1e3, name,
+          callNumber))
+
+    return '\n'.join(lines)
+
+# End of pyLogAnalyzer class
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print( 'Usage: %s logfile [top]' % sys.argv[0] )
+    sys.exit(2)
+
+  started = time()
+  result = pyLogAnalyzer.analyze(sys.argv[1],
+    int(sys.argv[2]) if len(sys.argv) > 2 else 10)
+  elapsed = time() - started
+
+  print( result.report() )
+  print( '\n%.1fMB in %.2fs, %.1fMB/s' % (result.bytes / 1e6, elapsed,
+    result.bytes / 1e6 / elapsed if elapsed else 0.0) )
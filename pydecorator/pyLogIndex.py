@@ -0,0 +1,690 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyLogIndex class
+A logging handler that writes the logfile and, as it goes, a compact sidecar
+index of where each call record starts, with lookups by call number, by
+function and by time bucket, and a reader that memory maps the index and
+the logfile to jump straight to the records of one call, of one function or
+of a span of time.
+
+Usage, before the first function is decorated:
+
+  pyLogIndex.install('logfile')
+
+and later, from anywhere:
+
+  index = pyLogIndex('logfile')
+  print( index.call(123456) )
+
+  python pyLogIndex.py logfile call 123456
+  python pyLogIndex.py logfile function parse
+
+Created by unsignedzero (David Tran)
+'''
+
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+class pyLogIndex(object):
+  r'''
+  Reads a logfile through its sidecar index, every file of which is memory
+  mapped and read in place.
+
+  path.idx holds the magic line below then one 48 byte entry per call
+  record, in the order written, little endian, each field 8 bytes wide so
+  that a column is a strided memoryview.cast of the map:
+
+      offset           Where the log entry holding the record starts.
+      call number      The number in [Call#...].
+      time             When it was logged, seconds since the epoch.
+      length           Its length in bytes, line end included.
+      function         Index of its function name in path.idx.names.
+      kind             0 start, 1 end, 2 single record of a call with a
+                       latency budget, then 7 bytes of padding.
+
+  path.idx.names holds the function names, one per line, in order of first
+  appearance. The writer keeps three lookups next to it, pointing at
+  entries by their position in path.idx:
+
+      path.idx.calls      (call number, position) of every entry whose call
+                          number is at least that of the entries before it,
+                          so it is sorted and bisected. Call numbers mostly
+                          go up, path.idx.late holds the other entries, the
+                          ends of calls that made calls and the records of
+                          threads interleaving, and is sorted when first
+                          needed.
+
+      path.idx.functions  Blocks of the positions of one function, each
+                          pointing back at the block before it, and after
+                          every flush a table of the last block of every
+                          function. A torn table is found by walking the
+                          blocks instead.
+
+      path.idx.times      (time bucket, position) of every entry logged in
+                          another bucket, of _bucketSeconds, than the one
+                          before it. Times mostly go up but not always,
+                          threads interleave and clocks get stepped, so
+                          every run of a bucket is looked at.
+
+  Warning:
+
+  On a big endian machine the columns are copied out and swapped once, as
+  the index is always little endian.
+  '''
+
+  _magic = b'PYDECLOGINDEX03\n'
+  _entry = struct.Struct('<QQdQQB7x')
+  _pair = struct.Struct('<QQ')
+  _block = struct.Struct('<QQQQ')
+  _kinds = { b'Starting': 0, b'Ended': 1, b'Slow': 2, b'Failed': 2 }
+
+  # Tags of the records of path.idx.functions, the marker ending a table of
+  # the last blocks, and the previous block of a function's first block
+  _blockTag = 1
+  _tableTag = 2
+  _tableMarker = b'PYDECFN\n'
+  _noBlock = 0xFFFFFFFFFFFFFFFF
+
+  _bucketSeconds = 1
+
+  def __init__(self, path):
+    r'''
+    Maps the logfile at path and its index.
+    '''
+
+    self.path = path
+    self._files = []
+    self._maps = []
+    self._views = []
+
+    with open(path + '.idx.names', 'rb') as names:
+      self.names = [ line.rstrip(b'\n').decode('utf-8', 'replace')
+        for line in names ]
+    self._nameIds = dict( (name, index)
+      for index, name in enumerate(self.names) )
+
+    data = self._mapFile(path + '.idx')
+
+    magic = pyLogIndex._magic
+    if len(data) and data[:len(magic)] != magic:
+      self.close()
+      raise ValueError('%s.idx is not a pyLogIndex index' % path)
+
+    # A last entry cut short while it was being written is left out
+    size = pyLogIndex._entry.size
+    count = max(0, len(data) - len(magic)) // size
+    entries = self._view(data[len(magic):len(magic) + count * size])
+    words = self._view(entries.cast('Q'))
+
+    self.offsets = self._column(words[0::6])
+    self.callNumbers = self._column(words[1::6])
+    self.times = self._column(self._view(entries.cast('d'))[2::6])
+    self.lengths = self._column(words[3::6])
+    self.functions = self._column(words[4::6])
+    self.kinds = self._column(entries[40::size])
+
+    calls = self._pairs(path + '.idx.calls')
+    self._callKeys = self._column(calls[0::2])
+    self._callPositions = self._column(calls[1::2])
+    self._late = None
+
+    times = self._pairs(path + '.idx.times')
+    self._buckets = self._column(times[0::2])
+    self._bucketStarts = self._column(times[1::2])
+
+    self._blocks = self._mapFile(path + '.idx.functions')
+    self._heads = pyLogIndex._functionHeads(self._blocks)[0]
+
+    self._file = open(path, 'rb')
+    self._files.append(self._file)
+    self._map = self._mapFile(path)
+
+
+  def _mapFile(self, path):
+    r'''
+    Returns a memoryview of the file at path memory mapped, empty if the
+    file is empty or missing.
+    '''
+
+    try:
+      mapped = open(path, 'rb')
+    except (IOError, OSError):
+      return memoryview(b'')
+
+    self._files.append(mapped)
+    if not os.fstat(mapped.fileno()).st_size:
+      return memoryview(b'')
+
+    self._maps.append(mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ))
+    return self._view(memoryview(self._maps[-1]))
+
+
+  def _view(self, view):
+    r'''
+    Keeps view to release on close, as a map can not be closed while a
+    view of it is held. Returns it.
+    '''
+
+    self._views.append(view)
+    return view
+
+
+  def _pairs(self, path):
+    r'''
+    Maps the file of 16 byte pairs at path and returns its words, a last
+    pair cut short left out.
+    '''
+
+    data = self._mapFile(path)
+    return self._view(self._view(data[:len(data) - len(data) % 16]).cast('Q'))
+
+
+  def _column(self, view):
+    r'''
+    Returns the strided view of a column, or a copy of it with its bytes
+    swapped on a big endian machine.
+    '''
+
+    if sys.byteorder == 'little':
+      return self._view(view)
+
+    column = array(view.format, view.tobytes())
+    if column.itemsize > 1:
+      column.byteswap()
+    return column
+
+
+  @staticmethod
+  def _functionHeads(data):
+    r'''
+    Returns the offset of the last block of every function in data, the
+    contents of path.idx.functions, by function index, and where its last
+    whole record ends. The table written last is read if it is whole, else
+    the blocks are walked from the start.
+    '''
+
+    pair = pyLogIndex._pair
+    marker = pyLogIndex._tableMarker
+    size = len(data)
+
+    if size >= 16 and data[size - 8:] == marker:
+      start = struct.unpack_from('<Q', data, size - 16)[0]
+      if start + 16 <= size:
+        tag, count = pair.unpack_from(data, start)
+        if tag == pyLogIndex._tableTag and start + 32 + 8 * count == size:
+          heads = struct.unpack_from('<%iQ' % count, data, start + 16)
+          return dict( (function, head) for function, head in
+            enumerate(heads) if head != pyLogIndex._noBlock ), size
+
+    heads = {}
+    offset = end = 0
+
+    while offset + 16 <= size:
+      tag, value = pair.unpack_from(data, offset)
+
+      if tag == pyLogIndex._blockTag and offset + 32 <= size:
+        count = pyLogIndex._block.unpack_from(data, offset)[3]
+        following = offset + 32 + 8 * count
+        if following > size:
+          break
+        heads[value] = offset
+      elif tag == pyLogIndex._tableTag:
+        following = offset + 32 + 8 * value
+        if following > size:
+          break
+      else:
+        break
+
+      offset = end = following
+
+    return heads, end
+
+
+  def close(self):
+    r'''
+    Releases the views, unmaps and closes the logfile and its index.
+    '''
+
+    for view in reversed(self._views):
+      view.release()
+    for mapped in self._maps:
+      mapped.close()
+    for each in self._files:
+      each.close()
+
+    self._views = []
+    self._maps = []
+    self._files = []
+
+
+  def __len__(self):
+    return len(self.offsets)
+
+
+  ###########################################################################
+  # Lookups, returning positions of entries
+
+  def _record(self, position):
+    r'''
+    Returns the log entry of the index entry at position, as text. An entry
+    written past what reached the logfile reads as empty.
+    '''
+
+    offset = self.offsets[position]
+    end = offset + self.lengths[position]
+
+    if end > len(self._map):
+      return ''
+    return self._map[offset:end].tobytes().decode('utf-8', 'replace')
+
+
+  def _lateCalls(self):
+    r'''
+    Returns path.idx.late as (sorted call numbers, their positions), read
+    and sorted the first time.
+    '''
+
+    if self._late is None:
+      late = self._pairs(self.path + '.idx.late')
+      pairs = sorted(zip(self._column(late[0::2]), self._column(late[1::2])))
+      self._late = (array('Q', [ each[0] for each in pairs ]),
+        array('Q', [ each[1] for each in pairs ]))
+
+    return self._late
+
+
+  def positionsOfCall(self, callNumber):
+    r'''
+    Returns the positions of the entries of call callNumber.
+    '''
+
+    count = len(self)
+    found = []
+
+    for keys, positions in ((self._callKeys, self._callPositions),
+        self._lateCalls()):
+      low = bisect_left(keys, callNumber)
+      high = bisect_right(keys, callNumber, low)
+      found.extend( positions[each] for each in range(low, high) )
+
+    return sorted( position for position in found if position < count )
+
+
+  def positionsOfFunction(self, name):
+    r'''
+    Returns the positions of the entries of the function name, walking its
+    blocks back from the last one.
+    '''
+
+    head = self._heads.get(self._nameIds.get(name))
+    if head is None:
+      return []
+
+    blocks = []
+    data = self._blocks
+
+    while head != pyLogIndex._noBlock:
+      tag, function, previous, size = pyLogIndex._block.unpack_from(data, head)
+      blocks.append(struct.unpack_from('<%iQ' % size, data, head + 32))
+      head = previous
+
+    count = len(self)
+    return [ position for block in reversed(blocks) for position in block
+      if position < count ]
+
+
+  def positionsBetween(self, start, end):
+    r'''
+    Returns the positions of the entries logged from start to end, both
+    seconds since the epoch, looking only at the runs of entries logged in
+    a bucket that overlaps them.
+    '''
+
+    bucketSeconds = pyLogIndex._bucketSeconds
+    low = int(start // bucketSeconds)
+    high = int(end // bucketSeconds)
+
+    buckets = self._buckets
+    starts = self._bucketStarts
+    times = self.times
+    count = len(self)
+    found = []
+
+    for run in range(len(buckets)):
+      if not low <= buckets[run] <= high:
+        continue
+
+      last = starts[run + 1] if run + 1 < len(starts) else count
+      found.extend( position for position in
+        range(starts[run], min(last, count))
+        if start <= times[position] <= end )
+
+    return found
+
+
+  ###########################################################################
+  # Lookups, returning records
+
+  def call(self, callNumber):
+    r'''
+    Returns the records of call callNumber, start first, as one text.
+    '''
+
+    return ''.join( self._record(position)
+      for position in self.positionsOfCall(callNumber) )
+
+
+  def function(self, name, kinds=(0, 2)):
+    r'''
+    Yields the records of the calls of function name, by default only
+    their start records.
+    '''
+
+    for position in self.positionsOfFunction(name):
+      if self.kinds[position] in kinds:
+        yield self._record(position)
+
+
+  def between(self, start, end):
+    r'''
+    Yields the records logged from start to end, seconds since the epoch.
+    '''
+
+    for position in self.positionsBetween(start, end):
+      yield self._record(position)
+
+
+  ###########################################################################
+  # Writing
+
+  @staticmethod
+  def install(path='logfile', fmt='%(message)s', logger=None):
+    r'''
+    Adds a pyIndexedFileHandler writing path to logger, the root logger by
+    default, in place of any file handler already writing path. Call it
+    before the first function is decorated, as pyDecorator leaves the
+    logging configuration alone once there is a handler. Returns the
+    handler.
+    '''
+
+    logger = logger or logging.getLogger()
+    target = os.path.abspath(path)
+
+    for handler in list(logger.handlers):
+      if getattr(handler, 'baseFilename', None) == target:
+        logger.removeHandler(handler)
+        handler.close()
+
+    handler = pyIndexedFileHandler(path)
+    handler.setFormatter(logging.Formatter(fmt))
+    logger.addHandler(handler)
+    if logger.level == logging.NOTSET or logger.level > logging.INFO:
+      logger.setLevel(logging.INFO)
+
+    return handler
+
+# End of pyLogIndex class
+
+class pyIndexedFileHandler(logging.Handler):
+  r'''
+  Appends log entries to a file, like logging.FileHandler, and an entry to
+  the sidecar index, see pyLogIndex, for each one holding a call record,
+  keeping the lookups of the index up to date as it goes. The byte offsets
+  are counted as the entries are written, the file is never asked for its
+  position.
+
+  Everything is written buffered and reaches the files on flush, close and
+  every flushEvery index entries. A reader in the meantime sees the index
+  as of the last flush, and an entry whose record did not reach the
+  logfile yet reads as empty.
+  '''
+
+  _record = re.compile(r'>>(Starting|Ended|Slow|Failed) call to (\S+) '
+    r'\[Call#(\d+)\]')
+
+  # How many positions of a function are written to path.idx.functions at
+  # once, fewer on flush
+  _blockSize = 256
+
+  def __init__(self, path, flushEvery=1024):
+    r'''
+    Opens path, its index and lookups for appending, carrying on from
+    where they end. Raises ValueError if the index there is not one this
+    version writes.
+    '''
+
+    logging.Handler.__init__(self)
+
+    magic = pyLogIndex._magic
+    if os.path.exists(path + '.idx'):
+      with open(path + '.idx', 'rb') as index:
+        header = index.read(len(magic))
+      if header and header != magic:
+        raise ValueError('%s.idx is not a pyLogIndex index' % path)
+
+    self.baseFilename = os.path.abspath(path)
+    self.flushEvery = flushEvery
+
+    self._stream = open(path, 'ab')
+    self._index = open(path + '.idx', 'ab')
+    self._names = open(path + '.idx.names', 'ab')
+    self._calls = open(path + '.idx.calls', 'ab')
+    self._late = open(path + '.idx.late', 'ab')
+    self._times = open(path + '.idx.times', 'ab')
+    self._functions = open(path + '.idx.functions', 'ab')
+    self._offset = self._stream.seek(0, 2) or self._stream.tell()
+
+    # Entries and pairs cut short by a crash are dropped, so the next ones
+    # line up
+    size = pyLogIndex._entry.size
+    end = self._index.seek(0, 2)
+    if not end:
+      self._index.write(magic)
+      end = len(magic)
+    self._position = (end - len(magic)) // size
+    self._index.truncate(len(magic) + self._position * size)
+
+    self._maxCall = pyIndexedFileHandler._lastPair(self._calls)[0]
+    pyIndexedFileHandler._lastPair(self._late)
+    self._bucket = pyIndexedFileHandler._lastPair(self._times)[0]
+
+    # Function names already in the names file
+    self._nameIds = {}
+    with open(path + '.idx.names', 'rb') as names:
+      for line in names:
+        self._nameIds[line.rstrip(b'\n').decode('utf-8')] = \
+          len(self._nameIds)
+
+    # The last block written of every function, the positions of each not
+    # written yet, and whether a table of the last blocks is due
+    with open(path + '.idx.functions', 'rb') as functions:
+      if os.fstat(functions.fileno()).st_size:
+        mapped = mmap.mmap(functions.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+          self._heads, end = pyLogIndex._functionHeads(mapped)
+        finally:
+          mapped.close()
+      else:
+        self._heads, end = {}, 0
+    self._functions.truncate(end)
+    self._functionsEnd = end
+    self._pending = {}
+    self._tableDue = False
+
+
+  @staticmethod
+  def _lastPair(stream):
+    r'''
+    Drops a pair cut short at the end of stream, a file of 16 byte pairs
+    opened for appending, and returns its last pair, (None, None) if empty.
+    '''
+
+    end = stream.seek(0, 2)
+    end -= end % 16
+    stream.truncate(end)
+
+    if not end:
+      return None, None
+
+    with open(stream.name, 'rb') as pairs:
+      pairs.seek(end - 16)
+      return pyLogIndex._pair.unpack(pairs.read(16))
+
+
+  def emit(self, record):
+    r'''
+    Writes record and, if it holds a call record, its index entry and
+    lookups. Runs under the handler lock.
+    '''
+
+    try:
+      text = self.format(record)
+    except Exception:
+      self.handleError(record)
+      return
+
+    data = (text + '\n').encode('utf-8')
+    offset = self._offset
+
+    self._stream.write(data)
+    self._offset += len(data)
+
+    match = pyIndexedFileHandler._record.search(text)
+    if match is None:
+      return
+
+    kind, name, callNumber = match.groups()
+    callNumber = int(callNumber)
+    pair = pyLogIndex._pair
+
+    function = self._nameIds.get(name)
+    if function is None:
+      function = self._nameIds[name] = len(self._nameIds)
+      self._names.write((name + '\n').encode('utf-8'))
+
+    position = self._position
+    self._position += 1
+
+    self._index.write(pyLogIndex._entry.pack(offset, callNumber,
+      record.created, len(data), function,
+      pyLogIndex._kinds[kind.encode('ascii')]))
+
+    if self._maxCall is None or callNumber >= self._maxCall:
+      self._maxCall = callNumber
+      self._calls.write(pair.pack(callNumber, position))
+    else:
+      self._late.write(pair.pack(callNumber, position))
+
+    bucket = int(record.created // pyLogIndex._bucketSeconds)
+    if bucket != self._bucket:
+      self._bucket = bucket
+      self._times.write(pair.pack(bucket, position))
+
+    pending = self._pending.get(function)
+    if pending is None:
+      pending = self._pending[function] = []
+    pending.append(position)
+    if len(pending) >= pyIndexedFileHandler._blockSize:
+      self._writeBlock(function)
+
+    if self.flushEvery and not self._position % self.flushEvery:
+      self.flush()
+
+
+  def _writeBlock(self, function):
+    r'''
+    Writes the positions of function not written yet as a block pointing
+    back at its previous one.
+    '''
+
+    positions = self._pending.pop(function)
+
+    self._functions.write(pyLogIndex._block.pack(pyLogIndex._blockTag,
+      function, self._heads.get(function, pyLogIndex._noBlock),
+      len(positions)))
+    self._functions.write(struct.pack('<%iQ' % len(positions), *positions))
+
+    self._heads[function] = self._functionsEnd
+    self._functionsEnd += 32 + 8 * len(positions)
+    self._tableDue = True
+
+
+  def _writeTable(self):
+    r'''
+    Writes the table of the last block of every function, so a reader need
+    not walk the blocks.
+    '''
+
+    count = len(self._nameIds)
+    heads = [ self._heads.get(function, pyLogIndex._noBlock)
+      for function in range(count) ]
+
+    self._functions.write(pyLogIndex._pair.pack(pyLogIndex._tableTag, count))
+    self._functions.write(struct.pack('<%iQ' % count, *heads))
+    self._functions.write(struct.pack('<Q', self._functionsEnd))
+    self._functions.write(pyLogIndex._tableMarker)
+
+    self._functionsEnd += 32 + 8 * count
+    self._tableDue = False
+
+
+  def flush(self):
+    r'''
+    Writes the pending blocks of positions and a table of the last ones,
+    then flushes the logfile before its index, so an entry points past the
+    end of the file as rarely as it can.
+    '''
+
+    self.acquire()
+    try:
+      if not self._functions.closed:
+        for function in list(self._pending):
+          self._writeBlock(function)
+        if self._tableDue:
+          self._writeTable()
+
+      for stream in (self._stream, self._names, self._index, self._calls,
+          self._late, self._times, self._functions):
+        if not stream.closed:
+          stream.flush()
+    finally:
+      self.release()
+
+
+  def close(self):
+    self.flush()
+
+    self.acquire()
+    try:
+      for stream in (self._stream, self._names, self._index, self._calls,
+          self._late, self._times, self._functions):
+        stream.close()
+    finally:
+      self.release()
+
+    logging.Handler.close(self)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 4 or sys.argv[2] not in ('call', 'function'):
+    print( 'Usage: %s logfile call number' % sys.argv[0] )
+    print( '       %s logfile function name' % sys.argv[0] )
+    sys.exit(2)
+
+  index = pyLogIndex(sys.argv[1])
+  try:
+    if sys.argv[2] == 'call':
+      sys.stdout.write( index.call(int(sys.argv[3])) )
+    else:
+      for text in index.function(sys.argv[3]):
+        sys.stdout.write( text )
+  finally:
+    index.close()
@@ -0,0 +1,404 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyMetrics class
+Metrics registry fed by pyDecorator, as a hook, that renders the Prometheus
+text exposition format. It keeps per function call and error totals, an in
+flight gauge and a latency histogram, and can write them to a file every few
+seconds (for the node exporter textfile collector) or serve them over HTTP.
+
+Usage:
+
+  metrics = pyMetrics(maxFunctions=50)
+  pyDecorator.addHook(metrics)
+  metrics.startHTTP(9464)
+
+Created by unsignedzero (David Tran)
+'''
+
+import os
+import threading
+import weakref
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+class pyMetrics(object):
+  r'''
+  Prometheus metrics of decorated functions. Every function is a value of
+  the function label, so to bound the number of series only the first
+  maxFunctions functions, among those matching include, get their own label
+  value. The rest are all counted under function="__other__".
+
+  Recording a call is a dict lookup, a bisect over the bucket bounds and a
+  few additions to series of the calling thread's own, so it takes no lock.
+  Rendering sums the series of every thread. A scrape taken while a call
+  is being recorded may count it in some metrics and not yet in others.
+  '''
+
+  _otherLabel = '__other__'
+
+  defaultBuckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+  def __init__(self, prefix='pydecorator', buckets=None, maxFunctions=100,
+      include=None):
+    r'''
+    Initializes an empty registry.
+
+    Arguments:
+
+        prefix           Prepended to every metric name.
+
+        buckets          Upper bounds, in seconds, of the latency histogram
+                         buckets. defaultBuckets if not passed.
+
+        maxFunctions     How many functions may have their own label value.
+
+        include          A glob pattern, or list of them, a function name
+                         must match to have its own label value.
+    '''
+
+    if isinstance(include, str):
+      include = [include]
+
+    self.prefix = prefix
+    self.buckets = tuple(sorted(buckets or pyMetrics.defaultBuckets))
+    self.maxFunctions = maxFunctions
+    self.include = include
+
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._shards = []      # _pyMetricShard of every thread recording
+    self._retired = {}     # label value -> _pyMetricSeries of ended threads
+    self._values = set()   # label values given out
+    self._labels = {}      # function name -> label value, resolved once
+    self._threads = []
+    self._http = None
+    self._stopping = threading.Event()
+
+
+  def _labelFor(self, name):
+    r'''
+    Resolves the label value of the function name the first time it is seen
+    and returns it.
+    '''
+
+    label = self._labels.get(name)
+
+    if label is None:
+      with self._lock:
+        label = name
+        if self.include and not any(fnmatchcase(name, pattern)
+            for pattern in self.include):
+          label = pyMetrics._otherLabel
+        elif label not in self._values and \
+            len(self._values) >= self.maxFunctions:
+          label = pyMetrics._otherLabel
+
+        self._values.add(label)
+        self._labels[name] = label
+
+    return label
+
+
+  def _seriesFor(self, name):
+    r'''
+    Returns the calling thread's series of the function name, creating the
+    thread's shard and the series the first time they are needed.
+    '''
+
+    try:
+      shard = self._local.shard
+    except AttributeError:
+      shard = _pyMetricShard()
+      with self._lock:
+        self._shards.append(shard)
+      self._local.shard = shard
+
+    series = shard.byName.get(name)
+
+    if series is None:
+      label = self._labelFor(name)
+      series = shard.byLabel.get(label)
+      if series is None:
+        series = _pyMetricSeries(len(self.buckets))
+        with self._lock:
+          shard.byLabel[label] = series
+      shard.byName[name] = series
+
+    return series
+
+
+  ###########################################################################
+  # Hook methods
+
+  def callStarted(self, name):
+    r'''
+    pyDecorator hook method. Counts the call as in flight.
+    '''
+
+    self._seriesFor(name).inFlight += 1
+
+
+  def callEnded(self, name, elapsed, error):
+    r'''
+    pyDecorator hook method. Accounts for the finished call.
+    '''
+
+    series = self._seriesFor(name)
+    index = bisect_left(self.buckets, elapsed)
+
+    series.inFlight -= 1
+    series.calls += 1
+    if error is not None:
+      series.errors += 1
+    series.sum += elapsed
+    series.counts[index] += 1
+
+
+  ###########################################################################
+  # Rendering
+
+  @staticmethod
+  def _escape(value):
+    r'''
+    Escapes a label value as the exposition format wants.
+    '''
+
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+  def _merged(self):
+    r'''
+    Returns the series of every thread summed per label value, sorted by
+    it. The series of threads that ended are folded into _retired and their
+    shards dropped.
+    '''
+
+    buckets = len(self.buckets)
+
+    with self._lock:
+      totals = dict( (label, entry.copy())
+        for label, entry in self._retired.items() )
+      live = []
+
+      for shard in self._shards:
+        thread = shard.thread()
+        alive = thread is not None and thread.is_alive()
+        if alive:
+          live.append(shard)
+
+        for label, entry in shard.byLabel.items():
+          if label not in totals:
+            totals[label] = _pyMetricSeries(buckets)
+          totals[label].add(entry)
+
+          if not alive:
+            if label not in self._retired:
+              self._retired[label] = _pyMetricSeries(buckets)
+            self._retired[label].add(entry)
+
+      self._shards = live
+
+    return sorted(totals.items())
+
+
+  def render(self):
+    r'''
+    Returns every metric in the Prometheus text exposition format.
+    '''
+
+    series = self._merged()
+
+    prefix = self.prefix
+    lines = []
+
+    for metric, kind, text, field in (
+        ('calls_total', 'counter', 'Calls of decorated functions.', 'calls'),
+        ('errors_total', 'counter', 'Calls that raised.', 'errors'),
+        ('in_flight', 'gauge', 'Calls currently running.', 'inFlight')):
+      lines.append('# HELP %s_%s %s' % (prefix, metric, text))
+      lines.append('# TYPE %s_%s %s' % (prefix, metric, kind))
+      for label, entry in series:
+        lines.append('%s_%s{function="%s"} %i' % (prefix, metric,
+          pyMetrics._escape(label), getattr(entry, field)))
+
+    lines.append('# HELP %s_call_seconds Latency of decorated functions.' %
+      prefix)
+    lines.append('# TYPE %s_call_seconds histogram' % prefix)
+
+    for label, entry in series:
+      label = pyMetrics._escape(label)
+      cumulative = 0
+
+      for bound, count in zip(self.buckets, entry.counts):
+        cumulative += count
+        lines.append('%s_call_seconds_bucket{function="%s",le="%r"} %i' %
+          (prefix, label, bound, cumulative))
+
+      lines.append('%s_call_seconds_bucket{function="%s",le="+Inf"} %i' %
+        (prefix, label, entry.calls))
+      lines.append('%s_call_seconds_sum{function="%s"} %r' %
+        (prefix, label, entry.sum))
+      lines.append('%s_call_seconds_count{function="%s"} %i' %
+        (prefix, label, entry.calls))
+
+    return '\n'.join(lines) + '\n'
+
+
+  ###########################################################################
+  # Exporting
+
+  def writeFile(self, path):
+    r'''
+    Writes the metrics to path, through a temporary file renamed over it so
+    a scraper never reads half a file.
+    '''
+
+    temporary = '%s.%i.tmp' % (path, os.getpid())
+
+    with open(temporary, 'w') as output:
+      output.write(self.render())
+
+    if hasattr(os, 'replace'):
+      os.replace(temporary, path)
+    else:
+      os.rename(temporary, path)
+
+
+  def startFileExport(self, path, interval=15.0):
+    r'''
+    Writes the metrics to path every interval seconds from a daemon thread
+    until stop is called.
+    '''
+
+    def export():
+      while not self._stopping.wait(interval):
+        self.writeFile(path)
+      self.writeFile(path)
+
+    self._start(export, 'pyMetrics file export')
+
+
+  def startHTTP(self, port, host='127.0.0.1'):
+    r'''
+    Serves the metrics at http://host:port/metrics from a daemon thread
+    until stop is called. Returns the port listened on, useful with 0.
+    '''
+
+    registry = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+          self.send_error(404)
+          return
+
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    self._http = HTTPServer((host, port), Handler)
+    self._start(self._http.serve_forever, 'pyMetrics http')
+
+    return self._http.server_address[1]
+
+
+  def _start(self, target, name):
+    r'''
+    Runs target on a daemon thread we join when stopping.
+    '''
+
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+    thread.start()
+    self._threads.append(thread)
+
+
+  def stop(self):
+    r'''
+    Stops the file export, writing the file one last time, and the HTTP
+    server.
+    '''
+
+    self._stopping.set()
+
+    if self._http is not None:
+      self._http.shutdown()
+      self._http.server_close()
+      self._http = None
+
+    for thread in self._threads:
+      thread.join()
+
+    self._threads = []
+    self._stopping.clear()
+
+# End of pyMetrics class
+
+class _pyMetricSeries(object):
+  r'''
+  The counters of one function label value. counts holds one more bucket
+  than there are bounds, for the calls above the last bound.
+  '''
+
+  __slots__ = ('calls', 'errors', 'inFlight', 'sum', 'counts')
+
+  def __init__(self, buckets):
+    self.calls = 0
+    self.errors = 0
+    self.inFlight = 0
+    self.sum = 0.0
+    self.counts = [0] * (buckets + 1)
+
+
+  def copy(self):
+    r'''
+    Returns a copy.
+    '''
+
+    other = _pyMetricSeries(0)
+    other.calls = self.calls
+    other.errors = self.errors
+    other.inFlight = self.inFlight
+    other.sum = self.sum
+    other.counts = list(self.counts)
+    return other
+
+
+  def add(self, other):
+    r'''
+    Adds the counters of other, a series with as many buckets, to ours.
+    '''
+
+    self.calls += other.calls
+    self.errors += other.errors
+    self.inFlight += other.inFlight
+    self.sum += other.sum
+    for index, count in enumerate(other.counts):
+      self.counts[index] += count
+
+class _pyMetricShard(object):
+  r'''
+  The series one thread records into, by label value and, to skip resolving
+  the label, by function name. Only that thread changes the counters.
+  '''
+
+  __slots__ = ('thread', 'byLabel', 'byName')
+
+  def __init__(self):
+    self.thread = weakref.ref(threading.current_thread())
+    self.byLabel = {}
+    self.byName = {}
@@ -0,0 +1,569 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyMonitor class
+Whole program tracing engine for pyDecorator. Rather than wrapping every
+function, it asks the interpreter to report when selected code objects start
+and finish, and feeds the very same records pyDecorator.__call__ prints.
+
+On Python 3.12+ this uses sys.monitoring (PEP 669) with events enabled only
+on the selected code objects. Older interpreters fall back to sys.setprofile.
+A generator or coroutine is one call from its start to its end, counted in
+the recursion level of a thread only while it runs there, not while it is
+suspended.
+
+Created by unsignedzero (David Tran)
+'''
+
+import dis
+import inspect
+import sys
+import threading
+from functools import partial
+from inspect import CO_VARARGS, CO_VARKEYWORDS
+from os import devnull
+from weakref import ref
+
+try:
+  from .pyDecorator import pyDecorator, _clock
+except (ImportError, ValueError):
+  from pyDecorator import pyDecorator, _clock
+
+# sys.monitoring only exists on 3.12+, everything else uses sys.setprofile
+try:
+  from sys import monitoring
+except ImportError:
+  monitoring = None
+
+class pyMonitor(object):
+  r'''
+  Tracing engine that produces pyDecorator records for a set of functions
+  without wrapping them. Nothing is traced until start is called.
+
+  Attributes:
+
+      engine           'monitoring' when sys.monitoring is used, otherwise
+                       'setprofile'.
+
+  Warning:
+
+  Only one pyMonitor may use sys.monitoring at a time since it claims the
+  profiler tool id. Under sys.setprofile, starting a pyMonitor replaces any
+  profiler already set until stop is called, and a generator closed or
+  thrown into while suspended gets no end record, the profiler not telling
+  it from a yield. Calls still running when stop is called never end, they
+  are taken off the recursion level of their thread by stop, which should
+  not be called while other threads make decorated calls.
+  '''
+
+  # Flags of the code of generators and coroutines, and the opcodes they
+  # are suspended on
+  _suspendable = inspect.CO_GENERATOR | \
+    getattr(inspect, 'CO_COROUTINE', 0) | \
+    getattr(inspect, 'CO_ASYNC_GENERATOR', 0)
+  _yieldOps = frozenset( dis.opmap[name]
+    for name in ('YIELD_VALUE', 'YIELD_FROM') if name in dis.opmap )
+  _resumeOp = dis.opmap.get('RESUME')
+
+  def __init__(self, targets, include=None, exclude=None,
+      useMonitoring=True):
+    r'''
+    Collects the code objects to trace.
+
+    Arguments:
+
+        targets          A list of functions, methods, code objects, classes
+                         or modules. Classes and modules are expanded the
+                         same way pyDecorator.instrument expands them.
+
+        include          Glob pattern(s) used to filter class and module
+                         members, see pyDecorator.instrument.
+
+        exclude          Glob pattern(s) removing members from the above.
+
+        useMonitoring    Set False to force the sys.setprofile engine.
+    '''
+
+    self._codes = {}
+    self._histograms = {}
+    self._errorHistograms = {}
+    self._local = threading.local()
+    self._stacks = []         # [thread state, stack, owner] of live threads
+    self._suspended = {}      # id(frame) -> (callNumber, elapsed so far)
+    self._previous = None
+    self.running = False
+
+    if monitoring is not None and useMonitoring:
+      self.engine = 'monitoring'
+    else:
+      self.engine = 'setprofile'
+
+    for target in targets:
+      self._add(target, include, exclude)
+
+
+  def _add(self, target, include, exclude):
+    r'''
+    Adds the code object(s) of target to the set we trace.
+    '''
+
+    if hasattr(target, 'co_code'):
+      self._codes[target] = target.co_name
+      self._histograms[target] = pyDecorator.histogramFor(
+        pyDecorator._qualifiedName(target))
+      self._errorHistograms[target] = pyDecorator.histogramFor(
+        pyDecorator._qualifiedName(target), errors=True)
+      return
+
+    func = getattr(target, '__func__', target)
+    func = getattr(func, 'func', func)      # Already pyDecorator wrapped
+    code = getattr(func, '__code__', None)
+
+    if code is not None:
+      self._codes[code] = func.__name__
+      self._histograms[code] = pyDecorator.histogramFor(
+        pyDecorator._qualifiedName(func))
+      self._errorHistograms[code] = pyDecorator.histogramFor(
+        pyDecorator._qualifiedName(func), errors=True)
+      return
+
+    candidates = {}
+    if isinstance(target, type):
+      pyDecorator._collectFunctions(target, '', candidates)
+    else:
+      pyDecorator._collectFunctions(target, '', candidates,
+        getattr(target, '__name__', None))
+
+    for name in pyDecorator._resolveFilters(candidates, include, exclude):
+      self._add(candidates[name][2], None, None)
+
+
+  ###########################################################################
+  # Starting and stopping
+
+  def start(self):
+    r'''
+    Starts tracing the selected functions.
+    '''
+
+    if self.running:
+      return
+
+    if self.engine == 'monitoring':
+      tool = monitoring.PROFILER_ID
+      events = monitoring.events
+
+      monitoring.use_tool_id(tool, 'pyDecorator')
+      monitoring.register_callback(tool, events.PY_START, self._onStart)
+      monitoring.register_callback(tool, events.PY_RETURN, self._onReturn)
+      monitoring.register_callback(tool, events.PY_UNWIND, self._onUnwind)
+      monitoring.register_callback(tool, events.PY_YIELD, self._onYield)
+      monitoring.register_callback(tool, events.PY_RESUME, self._onResume)
+      monitoring.register_callback(tool, events.PY_THROW, self._onThrow)
+
+      # PY_UNWIND and PY_THROW can only be enabled globally, the callbacks
+      # filter them
+      monitoring.set_events(tool, events.PY_UNWIND | events.PY_THROW)
+      for code in self._codes:
+        monitoring.set_local_events(tool, code,
+          events.PY_START | events.PY_RETURN | events.PY_YIELD |
+          events.PY_RESUME)
+
+    else:
+      self._previous = sys.getprofile()
+      sys.setprofile(self._onProfile)
+      threading.setprofile(self._onProfile)
+
+    self.running = True
+
+
+  def stop(self):
+    r'''
+    Stops tracing and hands the interpreter hooks back. The calls still
+    running, which will not be seen ending, are taken off the recursion
+    level of their thread.
+    '''
+
+    if not self.running:
+      return
+
+    if self.engine == 'monitoring':
+      tool = monitoring.PROFILER_ID
+      events = monitoring.events
+
+      for code in self._codes:
+        monitoring.set_local_events(tool, code, 0)
+      monitoring.set_events(tool, 0)
+      for event in (events.PY_START, events.PY_RETURN, events.PY_UNWIND,
+          events.PY_YIELD, events.PY_RESUME, events.PY_THROW):
+        monitoring.register_callback(tool, event, None)
+      monitoring.free_tool_id(tool)
+
+    else:
+      sys.setprofile(self._previous)
+      threading.setprofile(self._previous)
+      self._previous = None
+
+    self.running = False
+
+    for state, stack, owner in list(self._stacks):
+      pyDecorator._abandonCalls(state,
+        [ callNumber for callNumber, start in stack ])
+      del stack[:]
+
+    # Suspended calls were already taken off their thread when they yielded
+    self._suspended.clear()
+
+
+  ###########################################################################
+  # Interpreter callbacks
+
+  def _stack(self):
+    r'''
+    Returns this thread's stack of (callNumber, start time) for the calls
+    that are still running. A call resumed after running for some time
+    starts that much earlier.
+    '''
+
+    try:
+      return self._local.stack
+    except AttributeError:
+      stack = self._local.stack = []
+
+      # The owner lives in the thread's local dict, which is dropped when the
+      # thread ends, calling back to forget its stack
+      owner = self._local.owner = _pyStackOwner()
+      entry = [pyDecorator._state(), stack, None]
+      entry[2] = ref(owner, partial(pyMonitor._retire, ref(self), entry))
+
+      self._stacks.append(entry)
+      return stack
+
+
+  @staticmethod
+  def _retire(monitor, entry, owner):
+    r'''
+    Forgets entry, the stack of a thread that ended, unless the monitor, a
+    weak reference, is gone.
+    '''
+
+    monitor = monitor()
+    if monitor is None:
+      return
+
+    try:
+      monitor._stacks.remove(entry)
+    except ValueError:
+      pass
+
+
+  def _begin(self, code, frame):
+    r'''
+    Prints the start record of a traced call and remembers when it began.
+    '''
+
+    if pyDecorator._config.verbosity >= 1:
+      args, kwargs = pyMonitor._frameArgs(frame)
+    else:
+      args, kwargs = (), {}
+
+    callNumber = pyDecorator._enterCall(self._codes[code],
+      self._histograms[code].name, args, kwargs)
+
+    hooks = pyDecorator._hooks
+    if hooks:
+      pyDecorator._notify(hooks, 'callStarted', self._histograms[code].name)
+
+    self._stack().append((callNumber, _clock()))
+
+
+  def _end(self, code, ret, error=None):
+    r'''
+    Prints the end record of a traced call, the failure record if error is
+    the exception it was left by.
+    '''
+
+    end = _clock()
+    stack = self._stack()
+
+    # The call started before we did, so there is nothing to close
+    if not stack:
+      return
+
+    callNumber, start = stack.pop()
+
+    hooks = pyDecorator._hooks
+    if hooks:
+      pyDecorator._notify(hooks, 'callEnded', self._histograms[code].name,
+        end - start, error)
+
+    if error is None:
+      self._histograms[code].record(end - start)
+      pyDecorator._exitCall(self._codes[code], self._histograms[code].name,
+        callNumber, ret, end - start)
+    else:
+      self._errorHistograms[code].record(end - start)
+      pyDecorator._failCall(self._codes[code], self._histograms[code].name,
+        callNumber, error, end - start, getattr(error, '__traceback__', None))
+
+
+  def _suspend(self, frame):
+    r'''
+    Takes the traced call of frame, a generator or coroutine that yielded,
+    off this thread until it is resumed.
+    '''
+
+    stack = self._stack()
+    if not stack:
+      return
+
+    callNumber, start = stack.pop()
+    self._suspended[id(frame)] = (callNumber, _clock() - start)
+    pyDecorator._leaveCall(callNumber)
+
+
+  def _resume(self, frame):
+    r'''
+    Puts the traced call of frame, resumed or thrown into, on this thread.
+    '''
+
+    entry = self._suspended.pop(id(frame), None)
+
+    # It was suspended before we started
+    if entry is None:
+      return
+
+    callNumber, elapsed = entry
+    pyDecorator._rejoinCall(callNumber)
+    self._stack().append((callNumber, _clock() - elapsed))
+
+
+  @staticmethod
+  def _opcodeAt(frame):
+    r'''
+    Returns the opcode and argument frame is at, None for a frame that did
+    not start.
+    '''
+
+    code = bytearray(frame.f_code.co_code)
+    lasti = frame.f_lasti
+
+    if 0 <= lasti < len(code) - 1:
+      return code[lasti], code[lasti + 1]
+    return None, None
+
+
+  def _onStart(self, code, offset):
+    r'''
+    sys.monitoring PY_START callback. Only fires for our code objects.
+    '''
+
+    self._begin(code, sys._getframe(1))
+
+
+  def _onReturn(self, code, offset, retval):
+    r'''
+    sys.monitoring PY_RETURN callback. Only fires for our code objects.
+    '''
+
+    self._end(code, retval)
+
+
+  def _onUnwind(self, code, offset, exception):
+    r'''
+    sys.monitoring PY_UNWIND callback. This fires for every frame exited by
+    an exception so we filter on our code objects here.
+    '''
+
+    if code not in self._codes:
+      return
+
+    # Closing a suspended generator is not a failure
+    if isinstance(exception, GeneratorExit):
+      self._end(code, None)
+    else:
+      self._end(code, None, exception)
+
+
+  def _onYield(self, code, offset, retval):
+    r'''
+    sys.monitoring PY_YIELD callback. Only fires for our code objects.
+    '''
+
+    self._suspend(sys._getframe(1))
+
+
+  def _onResume(self, code, offset):
+    r'''
+    sys.monitoring PY_RESUME callback. Only fires for our code objects.
+    '''
+
+    self._resume(sys._getframe(1))
+
+
+  def _onThrow(self, code, offset, exception):
+    r'''
+    sys.monitoring PY_THROW callback, a generator thrown into or closed.
+    This fires for every frame so we filter on our code objects here.
+    '''
+
+    if code in self._codes:
+      self._resume(sys._getframe(1))
+
+
+  def _onProfile(self, frame, event, arg):
+    r'''
+    sys.setprofile callback used on interpreters without sys.monitoring.
+    A call left by an exception is reported as returning None since the
+    profiler is not told otherwise. Generators and coroutines are told
+    apart by the opcode they are at: a yield when they return, and when
+    they are called, a frame that did not start or the RESUME of a start.
+    '''
+
+    code = frame.f_code
+
+    if code not in self._codes:
+      return
+
+    if not code.co_flags & pyMonitor._suspendable:
+      if event == 'call':
+        self._begin(code, frame)
+      elif event == 'return':
+        self._end(code, arg)
+      return
+
+    opcode, oparg = pyMonitor._opcodeAt(frame)
+
+    if event == 'call':
+      if opcode is None or \
+          (opcode == pyMonitor._resumeOp and not oparg & 3):
+        # A frame id of a generator closed in a yield may come back
+        self._suspended.pop(id(frame), None)
+        self._begin(code, frame)
+      else:
+        self._resume(frame)
+
+    elif event == 'return':
+      if opcode in pyMonitor._yieldOps:
+        self._suspend(frame)
+      else:
+        self._end(code, arg)
+
+
+  @staticmethod
+  def _frameArgs(frame):
+    r'''
+    Rebuilds the args and kwargs a function was called with from its frame,
+    as __call__ would have seen them.
+    '''
+
+    code = frame.f_code
+    names = code.co_varnames
+    f_locals = frame.f_locals
+
+    index = code.co_argcount
+    kwonly = getattr(code, 'co_kwonlyargcount', 0)
+
+    args = tuple(f_locals.get(name) for name in names[:index])
+    kwargs = dict((name, f_locals.get(name))
+      for name in names[index:index + kwonly])
+    index += kwonly
+
+    if code.co_flags & CO_VARARGS:
+      args += tuple(f_locals.get(names[index], ()))
+      index += 1
+    if code.co_flags & CO_VARKEYWORDS:
+      kwargs.update(f_locals.get(names[index], {}))
+
+    return args, kwargs
+
+
+  ###########################################################################
+  # Overhead measurement
+
+  @staticmethod
+  def measureOverhead(func, args=(), calls=10000, useMonitoring=True):
+    r'''
+    Calls func(*args) calls times plain, wrapped by pyDecorator and traced
+    by a pyMonitor and returns the seconds per call of each in a dict keyed
+    by 'plain', 'wrapper' and the name of the engine used. Output is sent to
+    devnull and logging is turned off while timing, so the figures are the
+    cost of tracing rather than of the terminal. Use a function that does
+    not recurse, the wrapper only sees the outermost call of one that does.
+    '''
+
+    def timeCalls(target):
+      start = _clock()
+      for _ in range(calls):
+        target(*args)
+      return (_clock() - start) / calls
+
+    log = pyDecorator.getLog()
+    stdout = sys.stdout
+
+    results = {}
+
+    with open(devnull, 'w') as sink:
+      sys.stdout = sink
+      pyDecorator.setLog(False)
+
+      try:
+        results['plain'] = timeCalls(func)
+        results['wrapper'] = timeCalls(pyDecorator(func))
+
+        monitor = pyMonitor([func], useMonitoring=useMonitoring)
+        monitor.start()
+        try:
+          results[monitor.engine] = timeCalls(func)
+        finally:
+          monitor.stop()
+
+      finally:
+        sys.stdout = stdout
+        pyDecorator.setLog(log)
+
+    return results
+
+# End of pyMonitor class
+
+class _pyStackOwner(object):
+  r'''
+  Kept only in a thread's local dict, so it dies with the thread.
+  '''
+
+  __slots__ = ('__weakref__',)
+
+def pyMonitor_test():
+  r'''
+  Test function for pyMonitor, which also prints the overhead of each engine
+  '''
+
+  def fib(n):
+    if n < 2:
+      return n
+    return fib(n - 1) + fib(n - 2)
+
+  print( 'Executing sample code' )
+
+  monitor = pyMonitor([fib])
+  monitor.start()
+  try:
+    fib(3)
+  finally:
+    monitor.stop()
+
+  def add(a, b):
+    return a + b
+
+  print( 'Measuring overhead (seconds per call)' )
+
+  for engine, seconds in sorted(pyMonitor.measureOverhead(add, (1, 2),
+      1000).items()):
+    print( '%-12s %.9f' % (engine, seconds) )
+
+  print( 'Execution completed' )
+
+
+if __name__ == '__main__':
+  pyMonitor_test()
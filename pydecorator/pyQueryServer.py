@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyQueryServer class
+Optional server thread, listening on a Unix domain socket, that answers
+questions about the live pyDecorator statistics of this process without
+touching stdout or the logfile.
+
+A request is one line holding a command, the reply one line of compact JSON.
+
+  stats      Call count, recursion level and, per function, the number of
+             calls and errors with latency percentiles.
+  depth      The recursion level, in total and per thread, and the depth of
+             every recursive call tree being folded.
+  stacks     The stack of every thread, printCurStack style, innermost last.
+             'stacks locals' adds the repr of each frame's locals.
+
+Usage:
+
+  server = pyQueryServer('/tmp/myapp.pydecorator')
+  server.start()
+
+  python pyQueryServer.py /tmp/myapp.pydecorator stats
+
+Created by unsignedzero (David Tran)
+'''
+
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+
+try:
+  from .pyDecorator import pyDecorator
+except (ImportError, ValueError):
+  from pyDecorator import pyDecorator
+
+class pyQueryServer(object):
+  r'''
+  Serves pyDecorator statistics on a Unix domain socket from a daemon
+  thread. Nothing listens until start is called.
+
+  The socket is made owner only, mode 0600, as 'stacks locals' shows the
+  locals of every thread. Requests are answered one at a time, and a client
+  that sends nothing is dropped after _pyQueryHandler.timeout seconds.
+  '''
+
+  _summaryKeys = ('count', 'mean', 'p50', 'p90', 'p99', 'p999', 'max')
+
+  def __init__(self, path):
+    r'''
+    Remembers path, the filesystem path of the socket to listen on.
+    '''
+
+    self.path = path
+    self._server = None
+    self._thread = None
+
+
+  def start(self):
+    r'''
+    Starts listening, replacing a stale socket file left at path. Raises
+    ValueError if something other than a socket is there.
+    '''
+
+    if self._server is not None:
+      return
+
+    pyQueryServer._removeSocket(self.path)
+
+    # The socket is created by bind, under the umask, so no one else can
+    # connect even before it is listened on
+    umask = os.umask(0o077)
+    try:
+      self._server = socketserver.UnixStreamServer(self.path,
+        _pyQueryHandler)
+    finally:
+      os.umask(umask)
+
+    self._thread = threading.Thread(target=self._server.serve_forever,
+      name='pyQueryServer')
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def stop(self):
+    r'''
+    Stops listening and removes the socket file. Raises ValueError if path
+    was replaced by something other than a socket, which is left alone.
+    '''
+
+    if self._server is None:
+      return
+
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+    self._server = self._thread = None
+
+    pyQueryServer._removeSocket(self.path)
+
+
+  @staticmethod
+  def _removeSocket(path):
+    r'''
+    Removes the socket file at path, if there is one. Anything else found
+    there is never removed, ValueError is raised instead.
+    '''
+
+    try:
+      mode = os.lstat(path).st_mode
+    except OSError:
+      return
+
+    if not stat.S_ISSOCK(mode):
+      raise ValueError('%s is not a socket, not removing it' % path)
+
+    os.remove(path)
+
+
+  ###########################################################################
+  # Answers
+
+  @staticmethod
+  def answer(command):
+    r'''
+    Returns the reply, as a JSON compatible dict, to the request command.
+    '''
+
+    words = command.split()
+    verb = words[0] if words else ''
+
+    if verb == 'stats':
+      return pyQueryServer._stats()
+    if verb == 'depth':
+      return pyQueryServer._depth()
+    if verb == 'stacks':
+      return pyQueryServer._stacks('locals' in words[1:])
+
+    return { 'error': 'unknown command %r' % command }
+
+
+  @staticmethod
+  def _stats():
+    r'''
+    Per function counts and latency percentiles, in seconds.
+    '''
+
+    functions = {}
+
+    for snap in pyDecorator.latencySnapshot():
+      functions[snap['name']] = dict( (key, snap[key])
+        for key in pyQueryServer._summaryKeys )
+      functions[snap['name']]['errors'] = 0
+
+    for snap in pyDecorator.latencySnapshot(errors=True):
+      entry = functions.setdefault(snap['name'],
+        dict( (key, 0) for key in pyQueryServer._summaryKeys ))
+      entry['errors'] = snap['count']
+
+    return {
+      'callCount': pyDecorator.getCallCount(),
+      'recursionLevel': pyDecorator.getRecursionLevel(allThreads=True),
+      'functions': functions,
+    }
+
+
+  @staticmethod
+  def _depth():
+    r'''
+    The recursion level, of all threads together and of each thread in a
+    call, and the call trees being folded.
+    '''
+
+    folds = [ { 'thread': thread, 'function': name, 'root': fold.root,
+      'depth': fold.depth, 'maxDepth': len(fold.callsPerLevel) }
+      for thread, name, fold in pyDecorator.runningFolds() ]
+
+    return {
+      'recursionLevel': pyDecorator.getRecursionLevel(allThreads=True),
+      'recursionLevels': pyDecorator.recursionLevels(),
+      'folds': folds,
+    }
+
+
+  @staticmethod
+  def _stacks(withLocals):
+    r'''
+    The stack of every thread, but the one answering, as lists of frames.
+    '''
+
+    if not hasattr(sys, '_current_frames'):
+      return { 'error': 'frames are not available on this interpreter' }
+
+    names = dict( (thread.ident, thread.name)
+      for thread in threading.enumerate() )
+    current = threading.current_thread().ident
+    stacks = {}
+
+    for ident, frame in sys._current_frames().items():
+      if ident == current:
+        continue
+
+      frames = []
+      while frame is not None:
+        code = frame.f_code
+        entry = { 'function': code.co_name, 'file': code.co_filename,
+          'line': frame.f_lineno }
+        if withLocals:
+          entry['locals'] = dict( (name, pyQueryServer._safeRepr(value))
+            for name, value in list(frame.f_locals.items()) )
+        frames.append(entry)
+        frame = frame.f_back
+
+      frames.reverse()
+      stacks['%s (%i)' % (names.get(ident, '?'), ident)] = frames
+
+    return { 'stacks': stacks }
+
+
+  @staticmethod
+  def _safeRepr(value, limit=200):
+    r'''
+    repr of value cut to limit characters, or a note if repr fails.
+    '''
+
+    try:
+      text = repr(value)
+    except Exception as error:
+      return '<repr failed: %s>' % type(error).__name__
+
+    if len(text) > limit:
+      return text[:limit] + '...'
+    return text
+
+
+  ###########################################################################
+  # Client
+
+  @staticmethod
+  def query(path, command, timeout=5.0):
+    r'''
+    Sends command to the server listening at path and returns its decoded
+    reply.
+    '''
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+
+    try:
+      client.connect(path)
+      client.sendall((command + '\n').encode('utf-8'))
+
+      chunks = []
+      while True:
+        chunk = client.recv(65536)
+        if not chunk:
+          break
+        chunks.append(chunk)
+    finally:
+      client.close()
+
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+# End of pyQueryServer class
+
+class _pyQueryHandler(socketserver.StreamRequestHandler):
+  r'''
+  Answers the one request of a connection, waiting at most timeout seconds
+  for it.
+  '''
+
+  timeout = 5.0
+
+  def handle(self):
+    try:
+      command = self.rfile.readline().decode('utf-8', 'replace').strip()
+    except socket.timeout:
+      return
+
+    try:
+      reply = pyQueryServer.answer(command)
+    except Exception as error:
+      reply = { 'error': '%s: %s' % (type(error).__name__, error) }
+
+    self.wfile.write(json.dumps(reply, separators=(',', ':'),
+      default=str).encode('utf-8'))
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print( 'Usage: %s socket command' % sys.argv[0] )
+    sys.exit(2)
+
+  print( json.dumps(pyQueryServer.query(sys.argv[1], ' '.join(sys.argv[2:])),
+    indent=2, sort_keys=True) )
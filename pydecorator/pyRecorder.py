@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyRecorder class
+Records sampled inputs and outcomes of a decorated function to a compact
+append only file, and replays them as a micro-benchmark, checking that the
+function still returns what it did when recorded. This lets optimizations be
+timed against the arguments production really passes.
+
+Usage:
+
+  recorder = pyRecorder('parse.rec', sampleEvery=100)
+  recorder.attach(parse)            # parse is decorated with pyDecorator
+  ...
+  recorder.close()
+
+  python pyRecorder.py parse.rec mypackage.module:parse [repeat]
+
+Created by unsignedzero (David Tran)
+'''
+
+import struct
+import sys
+import threading
+from importlib import import_module
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+try:
+  from .pyDecorator import pyDecorator, _clock
+  from .pyHistogram import pyHistogram
+except (ImportError, ValueError):
+  from pyDecorator import pyDecorator, _clock
+  from pyHistogram import pyHistogram
+
+class pyRecorder(object):
+  r'''
+  Append only recording of the calls of decorated functions.
+
+  File layout: the magic line below, then one record per sampled call made
+  of the lengths of its two parts (two unsigned 32 bit integers, little
+  endian) followed by the parts, both pickles:
+
+      inputs           (args, kwargs), taken before the call.
+
+      outcome          ('return', value), ('raise', exception type name) or
+                       ('unknown', None) when the return value could not be
+                       pickled.
+
+  Calls whose inputs can not be pickled are skipped and counted in skipped.
+  '''
+
+  _magic = b'PYDECREC1\n'
+  _lengths = struct.Struct('<II')
+
+  def __init__(self, path, sampleEvery=1):
+    r'''
+    Opens path for appending, writing the magic line if it is new. One in
+    every sampleEvery calls is recorded.
+    '''
+
+    self.path = path
+    self.sampleEvery = max(1, int(sampleEvery))
+    self.recorded = 0
+    self.skipped = 0
+    self.failed = None        # What sample or write raised, once detached
+
+    self._seen = 0
+    self._lock = threading.Lock()
+    self._file = open(path, 'ab')
+    self._attached = []
+
+    if self._file.tell() == 0:
+      self._file.write(pyRecorder._magic)
+
+
+  def attach(self, decorated):
+    r'''
+    Starts sampling the calls of decorated, a pyDecorator instance.
+    '''
+
+    decorated.recorder = self
+    self._attached.append(decorated)
+
+
+  def detach(self, decorated):
+    r'''
+    Stops sampling the calls of decorated.
+    '''
+
+    if decorated.recorder is self:
+      decorated.recorder = None
+    if decorated in self._attached:
+      self._attached.remove(decorated)
+
+
+  def close(self):
+    r'''
+    Detaches from every function and closes the file.
+    '''
+
+    for decorated in list(self._attached):
+      self.detach(decorated)
+
+    with self._lock:
+      self._file.close()
+
+
+  ###########################################################################
+  # Recording, called by pyDecorator.__call__
+
+  def sample(self, args, kwargs):
+    r'''
+    Returns the pickled inputs if this call is to be recorded, else None.
+    '''
+
+    with self._lock:
+      self._seen += 1
+      if self._seen % self.sampleEvery:
+        return None
+
+    try:
+      return pickle.dumps((args, kwargs), pickle.HIGHEST_PROTOCOL)
+    except Exception:
+      with self._lock:
+        self.skipped += 1
+      return None
+
+
+  def write(self, inputs, returned, value):
+    r'''
+    Appends the record of a sampled call. returned tells if value is what
+    the call returned or what it raised.
+    '''
+
+    if returned:
+      try:
+        outcome = pickle.dumps(('return', value), pickle.HIGHEST_PROTOCOL)
+      except Exception:
+        outcome = pickle.dumps(('unknown', None), pickle.HIGHEST_PROTOCOL)
+    else:
+      outcome = pickle.dumps(('raise', type(value).__name__),
+        pickle.HIGHEST_PROTOCOL)
+
+    record = pyRecorder._lengths.pack(len(inputs), len(outcome)) + \
+      inputs + outcome
+
+    with self._lock:
+      if not self._file.closed:
+        self._file.write(record)
+        self.recorded += 1
+
+
+  ###########################################################################
+  # Reading and replaying
+
+  @staticmethod
+  def read(path):
+    r'''
+    Yields (inputs, outcome) for every record of path, both still pickled.
+    '''
+
+    lengths = pyRecorder._lengths
+
+    with open(path, 'rb') as recording:
+      if recording.read(len(pyRecorder._magic)) != pyRecorder._magic:
+        raise ValueError('%s is not a pyRecorder file' % path)
+
+      while True:
+        header = recording.read(lengths.size)
+        if len(header) < lengths.size:
+          return
+
+        inputSize, outcomeSize = lengths.unpack(header)
+        inputs = recording.read(inputSize)
+        outcome = recording.read(outcomeSize)
+
+        # A record cut short by a crash while writing ends the file
+        if len(outcome) < outcomeSize:
+          return
+
+        yield inputs, outcome
+
+
+  @staticmethod
+  def replay(path, func, repeat=1, verify=True):
+    r'''
+    Calls func with the inputs of every record of path, repeat times over,
+    timing each call. The inputs are unpickled again, outside the timing,
+    before every call so one that changes its arguments does not affect the
+    next. With verify set, the outcome of the first pass is compared with
+    the recorded one.
+
+    A pyDecorator instance is replayed through its undecorated function.
+
+    Returns a dict with the records and calls made, the mismatches found and
+    the pyHistogram snapshot of the call latency.
+    '''
+
+    if isinstance(func, pyDecorator):
+      func = func.func
+
+    records = list(pyRecorder.read(path))
+    histogram = pyHistogram(getattr(func, '__name__', 'replay'))
+    mismatches = 0
+
+    for iteration in range(repeat):
+      for inputs, outcome in records:
+        args, kwargs = pickle.loads(inputs)
+
+        start = _clock()
+        try:
+          actual = ('return', func(*args, **kwargs))
+        except Exception as error:
+          actual = ('raise', type(error).__name__)
+        histogram.record(_clock() - start)
+
+        if verify and iteration == 0:
+          expected = pickle.loads(outcome)
+          if expected[0] != 'unknown' and not pyRecorder._same(expected,
+              actual):
+            mismatches += 1
+
+    return {
+      'records': len(records),
+      'calls': len(records) * repeat,
+      'mismatches': mismatches,
+      'latency': histogram.snapshot(),
+    }
+
+
+  @staticmethod
+  def _same(expected, actual):
+    r'''
+    Compares two outcomes, counting a comparison that fails as a mismatch.
+    '''
+
+    try:
+      return bool(expected == actual)
+    except Exception:
+      return False
+
+# End of pyRecorder class
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print( 'Usage: %s recording module:function [repeat]' % sys.argv[0] )
+    sys.exit(2)
+
+  moduleName, attributes = sys.argv[2].split(':', 1)
+  target = import_module(moduleName)
+  for attribute in attributes.split('.'):
+    target = getattr(target, attribute)
+
+  results = pyRecorder.replay(sys.argv[1], target,
+    int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+
+  print( '%i records, %i calls, %i mismatches' %
+    (results['records'], results['calls'], results['mismatches']) )
+  print( pyHistogram.report([results['latency']]) )
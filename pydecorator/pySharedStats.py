@@ -0,0 +1,565 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pySharedStats class
+Per function call statistics kept in a shared memory segment so that the
+totals of every process of a pre-fork pool can be read from one place, and
+a small top like viewer that refreshes from it.
+
+Each process writes only to its own slot of the segment, so recording a call
+never takes a lock another process could hold. Readers sum the slots.
+
+Usage, in the parent before forking:
+
+  stats = pySharedStats('myapp', create=True)
+  pyDecorator.addHook(stats)
+
+and from anywhere else on the machine:
+
+  python pySharedStats.py myapp
+
+Requires Python 3.8+ for multiprocessing.shared_memory.
+
+Created by unsignedzero (David Tran)
+'''
+
+import os
+import struct
+import sys
+import threading
+import weakref
+from tempfile import gettempdir
+from time import sleep, time
+
+try:
+  from multiprocessing import shared_memory
+except ImportError:
+  shared_memory = None
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+class pySharedStats(object):
+  r'''
+  A shared memory segment of per process, per function call statistics. It
+  is a pyDecorator hook, see pyDecorator.addHook, and its reading methods
+  work from any process that attaches to it.
+
+  Layout, all integers native endian:
+
+      header           magic, version, slots, functions, nameSize
+
+      slots times      pid owning the slot (0 if free), functions used
+
+        functions times  name (utf-8, nul padded to nameSize bytes), calls,
+                         errors, total nanoseconds, max nanoseconds
+
+      retired slot     Laid out as the others, the pid being that of the
+                       process folding into it (0 when none is). It holds
+                       the counts of processes that died and whose slot was
+                       claimed by another, so their calls are still summed.
+
+  A process owns its slot while it holds the lock of the slot's byte in a
+  lock file next to the segment, see _lockPath, taken with fcntl.lockf. The
+  system drops the lock when the process dies, so a slot whose lock can be
+  taken is free or was left by a dead process. The retired slot is folded
+  into under the lock of the byte after the slots.
+
+  Warning:
+
+  Without fcntl, on Windows, a process claims its slot, or the retired
+  slot, by writing its pid in a free one and reading it back. Two processes
+  doing so at the very same time can both believe they own it, which mixes
+  their counts. A process should write to a segment through one
+  pySharedStats only. Function names longer than nameSize bytes are cut, and
+  the counts of a dead process for functions that no longer fit in the
+  retired slot are lost.
+  '''
+
+  _magic = b'PYDECSHM'
+  _version = 2
+  _header = struct.Struct('=8sIIII')
+  _slotHeader = struct.Struct('=QQ')
+  _entry = struct.Struct('=QQQQ')
+
+  # Segments created by this process, which the resource tracker must keep
+  _created = set()
+
+  # Lock file descriptors by segment name. Closing any descriptor of a file
+  # drops every lock the process holds on it, so each is opened once per
+  # process and never closed.
+  _lockFiles = {}
+
+  def __init__(self, name, create=False, slots=64, functions=256,
+      nameSize=96):
+    r'''
+    Creates, or attaches to, the shared memory segment called name. slots
+    bounds the number of processes and functions the number of functions
+    each may record; both are read from the segment when attaching.
+    '''
+
+    if shared_memory is None:
+      raise RuntimeError('pySharedStats requires Python 3.8+')
+
+    if create:
+      size = pySharedStats._header.size + (slots + 1) * (
+        pySharedStats._slotHeader.size + functions *
+        (nameSize + pySharedStats._entry.size))
+
+      self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+      pySharedStats._created.add(name)
+      pySharedStats._header.pack_into(self._shm.buf, 0, pySharedStats._magic,
+        pySharedStats._version, slots, functions, nameSize)
+
+    else:
+      self._shm = shared_memory.SharedMemory(name)
+      if name not in pySharedStats._created:
+        pySharedStats._untrack(self._shm)
+
+      magic, version, slots, functions, nameSize = \
+        pySharedStats._header.unpack_from(self._shm.buf, 0)
+
+      if magic != pySharedStats._magic or version != pySharedStats._version:
+        self._shm.close()
+        raise ValueError('%s is not a pySharedStats segment' % name)
+
+    self.name = name
+    self.created = create
+    self.slots = slots
+    self.functions = functions
+    self.nameSize = nameSize
+
+    self._entrySize = nameSize + pySharedStats._entry.size
+    self._slotSize = pySharedStats._slotHeader.size + \
+      functions * self._entrySize
+    self._retiredOffset = pySharedStats._header.size + slots * self._slotSize
+
+    # Writer side state, private to this process
+    self._lock = threading.Lock()
+    self._slot = None
+    self._offsets = {}
+
+    _instances.add(self)
+
+
+  @staticmethod
+  def _untrack(shm):
+    r'''
+    Stops the resource tracker from destroying a segment we only attached to
+    when this process exits, which Python before 3.13 does.
+    '''
+
+    try:
+      from multiprocessing import resource_tracker
+      resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+      pass
+
+
+  def close(self):
+    r'''
+    Detaches from the segment, destroying it if this object created it.
+    '''
+
+    self._shm.close()
+    if self.created:
+      self._shm.unlink()
+      pySharedStats._created.discard(self.name)
+      try:
+        os.remove(pySharedStats._lockPath(self.name))
+      except OSError:
+        pass
+
+      # A segment made again under this name gets a new lock file, which
+      # this process must lock rather than the removed one
+      fd = pySharedStats._lockFiles.pop(self.name, None)
+      if fd is not None:
+        os.close(fd)
+
+
+  @staticmethod
+  def _lockPath(name):
+    r'''
+    Returns the path of the lock file of the segment called name.
+    '''
+
+    return os.path.join(gettempdir(), 'pySharedStats_%s.lock' % name)
+
+
+  def _lockByte(self, position, blocking):
+    r'''
+    Takes, for this process, the lock of byte position of the lock file.
+    Returns whether it did, or None where there are no such locks.
+    '''
+
+    if fcntl is None:
+      return None
+
+    fd = pySharedStats._lockFiles.get(self.name)
+    if fd is None:
+      fd = pySharedStats._lockFiles[self.name] = os.open(
+        pySharedStats._lockPath(self.name), os.O_RDWR | os.O_CREAT, 0o600)
+
+    try:
+      fcntl.lockf(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB), 1,
+        position)
+    except (IOError, OSError):
+      return False
+    return True
+
+
+  def _unlockByte(self, position):
+    r'''
+    Drops the lock of byte position taken by _lockByte.
+    '''
+
+    fcntl.lockf(pySharedStats._lockFiles[self.name], fcntl.LOCK_UN, 1,
+      position)
+
+
+  def _forget(self):
+    r'''
+    Drops the slot inherited from the parent after a fork so the child
+    claims its own.
+    '''
+
+    self._lock = threading.Lock()
+    self._slot = None
+    self._offsets = {}
+
+
+  ###########################################################################
+  # Writing
+
+  def callStarted(self, name):
+    r'''
+    pyDecorator hook method. Nothing is kept about calls in flight.
+    '''
+
+    pass
+
+
+  def callEnded(self, name, elapsed, error):
+    r'''
+    pyDecorator hook method. Adds the call to this process's slot.
+    '''
+
+    offset = self._offsets.get(name, -1)
+
+    if offset == -1:
+      offset = self._register(name)
+    if offset is None:
+      return
+
+    nanos = int(elapsed * 1e9)
+    entry = pySharedStats._entry
+    buf = self._shm.buf
+
+    # Only threads of this process write here
+    with self._lock:
+      calls, errors, total, maximum = entry.unpack_from(buf, offset)
+      entry.pack_into(buf, offset, calls + 1, errors + (error is not None),
+        total + nanos, max(maximum, nanos))
+
+
+  def _register(self, name):
+    r'''
+    Adds name to this process's slot, claiming one first if needed, and
+    returns the offset of its counters. Returns None, and remembers not to
+    try again, when there is no room left.
+    '''
+
+    with self._lock:
+      if self._slot is None:
+        self._slot = self._claim()
+
+      if self._slot is None:
+        self._offsets[name] = None
+        return None
+
+      buf = self._shm.buf
+      slotOffset = pySharedStats._header.size + self._slot * self._slotSize
+      pid, used = pySharedStats._slotHeader.unpack_from(buf, slotOffset)
+
+      if used >= self.functions:
+        self._offsets[name] = None
+        return None
+
+      entryOffset = slotOffset + pySharedStats._slotHeader.size + \
+        used * self._entrySize
+      encoded = name.encode('utf-8')[:self.nameSize - 1]
+
+      buf[entryOffset:entryOffset + self.nameSize] = \
+        encoded.ljust(self.nameSize, b'\0')
+      pySharedStats._entry.pack_into(buf, entryOffset + self.nameSize,
+        0, 0, 0, 0)
+
+      # Publish the name only once it is written
+      pySharedStats._slotHeader.pack_into(buf, slotOffset, pid, used + 1)
+
+      offset = entryOffset + self.nameSize
+      self._offsets[name] = offset
+      return offset
+
+
+  def _claim(self):
+    r'''
+    Finds a slot for this process, preferring a free one over one left by a
+    process that died, whose counts are folded into the retired slot.
+    Returns its index, or None if all are taken.
+    '''
+
+    pid = os.getpid()
+    buf = self._shm.buf
+    slotHeader = pySharedStats._slotHeader
+
+    for wanted in ('free', 'dead'):
+      for step in range(self.slots):
+        index = (pid + step) % self.slots
+        offset = pySharedStats._header.size + index * self._slotSize
+        owner, used = slotHeader.unpack_from(buf, offset)
+
+        # Our own pid is a slot this process already holds the lock of
+        if owner == pid or (wanted == 'free') != (owner == 0):
+          continue
+
+        locked = self._lockByte(index, False)
+
+        if locked is False:
+          continue
+        if locked:
+          # Nobody else can claim it now, but it may have been before
+          owner, used = slotHeader.unpack_from(buf, offset)
+          if (wanted == 'free') != (owner == 0):
+            self._unlockByte(index)
+            continue
+        elif wanted == 'dead' and pySharedStats._alive(owner):
+          continue
+
+        entries = list(self._entries(offset, used))
+        slotHeader.pack_into(buf, offset, pid, 0)
+
+        if locked or slotHeader.unpack_from(buf, offset)[0] == pid:
+          if wanted == 'dead':
+            self._retire(entries)
+          return index
+
+    return None
+
+
+  def _retire(self, entries):
+    r'''
+    Adds entries, the counts of a process that died, to the retired slot.
+    '''
+
+    buf = self._shm.buf
+    slotHeader = pySharedStats._slotHeader
+    entry = pySharedStats._entry
+    offset = self._retiredOffset
+    pid = os.getpid()
+
+    locked = self._lockByte(self.slots, True)
+
+    # Wait for any other process folding, unless it died doing so
+    for attempt in range(1000):
+      owner, used = slotHeader.unpack_from(buf, offset)
+      if locked or owner == 0 or not pySharedStats._alive(owner):
+        slotHeader.pack_into(buf, offset, pid, used)
+        if slotHeader.unpack_from(buf, offset)[0] == pid:
+          break
+      sleep(0.001)
+    else:
+      return
+
+    try:
+      positions = dict( (name, position) for position, (name, counts) in
+        enumerate(self._entries(offset, used)) )
+
+      for name, (calls, errors, total, maximum) in entries:
+        position = positions.get(name)
+
+        if position is None:
+          if used >= self.functions:
+            continue
+          position = positions[name] = used
+          used += 1
+          entryOffset = offset + slotHeader.size + position * self._entrySize
+          buf[entryOffset:entryOffset + self.nameSize] = \
+            name.encode('utf-8')[:self.nameSize - 1].ljust(self.nameSize,
+            b'\0')
+          entry.pack_into(buf, entryOffset + self.nameSize, 0, 0, 0, 0)
+
+        countsOffset = offset + slotHeader.size + \
+          position * self._entrySize + self.nameSize
+        before = entry.unpack_from(buf, countsOffset)
+        entry.pack_into(buf, countsOffset, before[0] + calls,
+          before[1] + errors, before[2] + total, max(before[3], maximum))
+
+    finally:
+      slotHeader.pack_into(buf, offset, 0, used)
+      if locked:
+        self._unlockByte(self.slots)
+
+
+  @staticmethod
+  def _alive(pid):
+    r'''
+    Returns False only if we are sure process pid is gone.
+    '''
+
+    if os.name != 'posix':
+      return True
+
+    try:
+      os.kill(pid, 0)
+    except OSError as error:
+      return error.errno != 3     # ESRCH
+    return True
+
+
+  ###########################################################################
+  # Reading
+
+  def _entries(self, slotOffset, used):
+    r'''
+    Yields the function name and (calls, errors, total, max) counters, in
+    nanoseconds, of the first used entries of the slot at slotOffset.
+    '''
+
+    buf = self._shm.buf
+    entry = pySharedStats._entry
+
+    for position in range(min(used, self.functions)):
+      entryOffset = slotOffset + pySharedStats._slotHeader.size + \
+        position * self._entrySize
+      name = bytes(buf[entryOffset:entryOffset + self.nameSize])
+      yield name.rstrip(b'\0').decode('utf-8', 'replace'), \
+        entry.unpack_from(buf, entryOffset + self.nameSize)
+
+
+  def snapshot(self):
+    r'''
+    Sums the slots of every process, and the retired slot, and returns a
+    dict, keyed by function name, of dicts with calls, errors, total and
+    max (seconds) and the number of live processes that called it.
+    '''
+
+    buf = self._shm.buf
+    slotHeader = pySharedStats._slotHeader
+    totals = {}
+
+    slots = [ (pySharedStats._header.size + index * self._slotSize, 1)
+      for index in range(self.slots) ]
+    slots.append((self._retiredOffset, 0))
+
+    for slotOffset, process in slots:
+      pid, used = slotHeader.unpack_from(buf, slotOffset)
+
+      if not pid and process:
+        continue
+
+      for name, (calls, errors, total, maximum) in \
+          self._entries(slotOffset, used):
+        stats = totals.get(name)
+        if stats is None:
+          stats = totals[name] = { 'calls': 0, 'errors': 0, 'total': 0.0,
+            'max': 0.0, 'processes': 0 }
+
+        stats['calls'] += calls
+        stats['errors'] += errors
+        stats['total'] += total / 1e9
+        stats['max'] = max(stats['max'], maximum / 1e9)
+        stats['processes'] += process
+
+    return totals
+
+
+  _reportHeader = '%-40s %6s %12s %10s %8s %10s %10s' % ('function', 'procs',
+    'calls', 'calls/s', 'errors', 'mean ms', 'max ms')
+
+  @staticmethod
+  def report(totals, previous=None, interval=None):
+    r'''
+    Formats a snapshot as a text table sorted by total time. With the
+    previous snapshot and the seconds between the two, call rates are shown.
+    '''
+
+    lines = [pySharedStats._reportHeader]
+
+    for name, stats in sorted(totals.items(),
+        key=lambda item: item[1]['total'], reverse=True):
+      rate = 0.0
+      if previous is not None and interval:
+        before = previous.get(name, {}).get('calls', 0)
+        rate = (stats['calls'] - before) / interval
+
+      mean = stats['total'] / stats['calls'] if stats['calls'] else 0.0
+
+      lines.append('%-40s %6i %12i %10.1f %8i %10.3f %10.3f' % (name[-40:],
+        stats['processes'], stats['calls'], rate, stats['errors'],
+        mean * 1e3, stats['max'] * 1e3))
+
+    return '\n'.join(lines)
+
+
+  def top(self, interval=1.0, count=None, out=None):
+    r'''
+    Prints the report every interval seconds, clearing the terminal first,
+    count times or until interrupted.
+    '''
+
+    out = out or sys.stdout
+    previous = None
+    last = time()
+    shown = 0
+
+    try:
+      while count is None or shown < count:
+        totals = self.snapshot()
+        now = time()
+
+        out.write('\033[2J\033[H')
+        out.write('pyDecorator shared stats %s, every %.1fs\n\n' %
+          (self.name, interval))
+        out.write(pySharedStats.report(totals, previous, now - last))
+        out.write('\n')
+        out.flush()
+
+        previous, last = totals, now
+        shown += 1
+
+        if count is None or shown < count:
+          sleep(interval)
+
+    except KeyboardInterrupt:
+      pass
+
+# End of pySharedStats class
+
+# Every pySharedStats of this process, for _forgetAll after a fork
+_instances = weakref.WeakSet()
+
+def _forgetAll():
+  r'''
+  Makes every pySharedStats in a forked child forget its parent's slot.
+  '''
+
+  for stats in list(_instances):
+    stats._forget()
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_forgetAll)
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print( 'Usage: %s segment [interval]' % sys.argv[0] )
+    sys.exit(2)
+
+  viewer = pySharedStats(sys.argv[1])
+  try:
+    viewer.top(float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
+  finally:
+    viewer.close()
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+# coding: utf-8
+
+r'''
+Python pyTraceDiff class
+Captures the latency histograms and call graph of a run of decorated code to
+a file, and compares two of them, before and after a change, function by
+function: call counts, mean and tail latency, callers and callees, with a
+significance test on the latency distributions so that noise is not taken
+for a regression.
+
+Usage:
+
+  trace = pyTraceDiff()
+  pyDecorator.addHook(trace)
+  ...
+  trace.save('after.json')
+
+  python pyTraceDiff.py before.json after.json [max slowdown %]
+
+exits with status 1 if a function got significantly slower than allowed,
+10% by default, to gate a release on it.
+
+Created by unsignedzero (David Tran)
+'''
+
+import json
+import sys
+import threading
+from math import erfc, sqrt
+
+try:
+  from .pyDecorator import pyDecorator
+except (ImportError, ValueError):
+  from pyDecorator import pyDecorator
+
+class pyTraceDiff(object):
+  r'''
+  A pyDecorator hook counting the edges of the call graph, caller to callee,
+  and the methods capturing, saving and comparing traces.
+
+  A trace is a dict, saved as JSON:
+
+      functions        By qualified function name, the pyHistogram snapshot
+                       of its latency with the bucket counts kept sparse, as
+                       {bucket index: count}.
+
+      errors           By qualified function name, the calls that raised.
+
+      edges            [caller, callee, calls] for every pair seen, caller
+                       '' for calls made outside any decorated function.
+  '''
+
+  _version = 1
+
+  def __init__(self):
+    r'''
+    Initializes an empty call graph.
+    '''
+
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._edges = {}
+
+
+  ###########################################################################
+  # Hook methods
+
+  def callStarted(self, name):
+    r'''
+    pyDecorator hook method. Counts the edge from the caller to name.
+    '''
+
+    try:
+      stack = self._local.stack
+    except AttributeError:
+      stack = self._local.stack = []
+
+    edge = (stack[-1] if stack else '', name)
+    stack.append(name)
+
+    with self._lock:
+      self._edges[edge] = self._edges.get(edge, 0) + 1
+
+
+  def callEnded(self, name, elapsed, error):
+    r'''
+    pyDecorator hook method. Leaves the call.
+    '''
+
+    stack = getattr(self._local, 'stack', None)
+    if stack:
+      stack.pop()
+
+
+  ###########################################################################
+  # Capturing
+
+  def capture(self):
+    r'''
+    Returns the trace of everything decorated functions did so far.
+    '''
+
+    functions = {}
+    for snap in pyDecorator.latencySnapshot():
+      snap = dict(snap)
+      snap['counts'] = dict( (str(index), count)
+        for index, count in enumerate(snap['counts']) if count )
+      functions[snap['name']] = snap
+
+    errors = dict( (snap['name'], snap['count'])
+      for snap in pyDecorator.latencySnapshot(errors=True) )
+
+    with self._lock:
+      edges = sorted( [caller, callee, calls]
+        for (caller, callee), calls in self._edges.items() )
+
+    return { 'version': pyTraceDiff._version, 'functions': functions,
+      'errors': errors, 'edges': edges }
+
+
+  def save(self, path):
+    r'''
+    Writes the trace, see capture, to path.
+    '''
+
+    with open(path, 'w') as output:
+      json.dump(self.capture(), output, sort_keys=True)
+
+
+  @staticmethod
+  def load(path):
+    r'''
+    Reads a trace written by save.
+    '''
+
+    with open(path) as trace:
+      loaded = json.load(trace)
+
+    if loaded.get('version') != pyTraceDiff._version:
+      raise ValueError('%s is not a pyTraceDiff trace' % path)
+    return loaded
+
+
+  ###########################################################################
+  # Comparing
+
+  @staticmethod
+  def _mannWhitney(before, after):
+    r'''
+    Mann-Whitney U test of two latency distributions given as sparse bucket
+    counts. Values in the same bucket are ties. Returns the two sided p
+    value and the probability that a call after is slower than one before,
+    ties counting half. The normal approximation is used, good from a few
+    tens of calls on each side.
+    '''
+
+    countBefore = sum(before.values())
+    countAfter = sum(after.values())
+    total = countBefore + countAfter
+
+    if not countBefore or not countAfter:
+      return 1.0, 0.5
+
+    seen = 0
+    rankSum = 0.0
+    ties = 0.0
+
+    for index in sorted(set(before) | set(after), key=int):
+      inBucket = before.get(index, 0) + after.get(index, 0)
+      rankSum += after.get(index, 0) * (seen + (inBucket + 1) / 2.0)
+      ties += inBucket ** 3 - inBucket
+      seen += inBucket
+
+    u = rankSum - countAfter * (countAfter + 1) / 2.0
+    product = float(countBefore * countAfter)
+    variance = product / 12.0 * ((total + 1) - ties / (total * (total - 1.0)))
+
+    if variance <= 0:
+      return 1.0, u / product
+
+    z = (u - product / 2.0) / sqrt(variance)
+    return erfc(abs(z) / sqrt(2.0)), u / product
+
+
+  @staticmethod
+  def _ratio(before, after):
+    r'''
+    after / before, or None when there is nothing to compare to.
+    '''
+
+    return after / before if before else None
+
+
+  @staticmethod
+  def compare(before, after, threshold=0.1, alpha=0.01):
+    r'''
+    Compares two traces. A function regressed when its mean or p99 latency
+    grew by more than threshold (0.1 is 10%), its calls after are more
+    likely slower than faster and the difference is significant, a p value
+    under alpha.
+
+    Returns a dict of
+
+        functions        A dict per function in either trace with the
+                         calls, errors, mean and p99 before and after, their
+                         ratios, the p value and the probability a call got
+                         slower, and if it regressed.
+
+        regressions      The names of the functions that regressed.
+
+        edges            The call graph edges added, removed and those
+                         whose calls per call of the caller changed by more
+                         than threshold, as (caller, callee, before, after).
+    '''
+
+    functions = {}
+    empty = { 'count': 0, 'mean': 0.0, 'p99': 0.0, 'counts': {} }
+
+    for name in sorted(set(before['functions']) | set(after['functions'])):
+      old = before['functions'].get(name, empty)
+      new = after['functions'].get(name, empty)
+      pValue, slower = pyTraceDiff._mannWhitney(old['counts'], new['counts'])
+
+      meanRatio = pyTraceDiff._ratio(old['mean'], new['mean'])
+      p99Ratio = pyTraceDiff._ratio(old['p99'], new['p99'])
+      grew = any( ratio is not None and ratio > 1 + threshold
+        for ratio in (meanRatio, p99Ratio) )
+
+      functions[name] = {
+        'calls': (old['count'], new['count']),
+        'errors': (before['errors'].get(name, 0),
+          after['errors'].get(name, 0)),
+        'mean': (old['mean'], new['mean']),
+        'p99': (old['p99'], new['p99']),
+        'meanRatio': meanRatio,
+        'p99Ratio': p99Ratio,
+        'pValue': pValue,
+        'slower': slower,
+        'regressed': grew and slower > 0.5 and pValue < alpha,
+      }
+
+    return {
+      'functions': functions,
+      'regressions': [ name for name in sorted(functions)
+        if functions[name]['regressed'] ],
+      'edges': pyTraceDiff._compareEdges(before, after, threshold),
+    }
+
+
+  @staticmethod
+  def _compareEdges(before, after, threshold):
+    r'''
+    The call graph part of compare.
+    '''
+
+    def perCaller(trace):
+      edges = dict( ((caller, callee), calls)
+        for caller, callee, calls in trace['edges'] )
+      callers = dict( (name, snap['count'])
+        for name, snap in trace['functions'].items() )
+      return edges, callers
+
+    oldEdges, oldCallers = perCaller(before)
+    newEdges, newCallers = perCaller(after)
+    added, removed, changed = [], [], []
+
+    for edge in sorted(set(oldEdges) | set(newEdges)):
+      old, new = oldEdges.get(edge, 0), newEdges.get(edge, 0)
+
+      if not old:
+        added.append(edge + (old, new))
+      elif not new:
+        removed.append(edge + (old, new))
+      elif edge[0]:
+        # Calls made per call of the caller, as the runs may differ in length
+        oldRate = old / float(oldCallers.get(edge[0]) or 1)
+        newRate = new / float(newCallers.get(edge[0]) or 1)
+        if abs(newRate - oldRate) > threshold * oldRate:
+          changed.append(edge + (oldRate, newRate))
+
+    return { 'added': added, 'removed': removed, 'changed': changed }
+
+
+  @staticmethod
+  def report(diff):
+    r'''
+    Formats the result of compare as text, regressions marked with a !.
+    '''
+
+    lines = [ '  %-40s %17s %19s %19s %9s' % ('function', 'calls',
+      'mean ms', 'p99 ms', 'p value') ]
+
+    for name, entry in sorted(diff['functions'].items()):
+      lines.append('%s %-40s %8i>%-8i %9.3f>%-9.3f %9.3f>%-9.3f %9.2g' % (
+        entry['regressed'] and '!' or ' ', name[-40:], entry['calls'][0],
+        entry['calls'][1], entry['mean'][0] * 1e3, entry['mean'][1] * 1e3,
+        entry['p99'][0] * 1e3, entry['p99'][1] * 1e3, entry['pValue']))
+
+    edges = diff['edges']
+    for title, key, form in (('New calls', 'added', '%s -> %s'),
+        ('Calls gone', 'removed', '%s -> %s'),
+        ('Calls per caller call changed', 'changed', '%s -> %s')):
+      if edges[key]:
+        lines.append('')
+        lines.append(title + ':')
+        for edge in edges[key]:
+          lines.append('  ' + form % (edge[0] or '(outside)', edge[1]) +
+            ('  %.3g > %.3g' % edge[2:] if key == 'changed' else ''))
+
+    lines.append('')
+    if diff['regressions']:
+      lines.append('Regressed: %s' % ', '.join(diff['regressions']))
+    else:
+      lines.append('No function regressed')
+
+    return '\n'.join(lines)
+
+# End of pyTraceDiff class
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print( 'Usage: %s before.json after.json [max slowdown %%]' %
+      sys.argv[0] )
+    sys.exit(2)
+
+  result = pyTraceDiff.compare(pyTraceDiff.load(sys.argv[1]),
+    pyTraceDiff.load(sys.argv[2]),
+    float(sys.argv[3]) / 100 if len(sys.argv) > 3 else 0.1)
+
+  print( pyTraceDiff.report(result) )
+  sys.exit(1 if result['regressions'] else 0)
@@ -39,7 +39,18 @@ setup(name='pyDecorator',
       author_email='unsignedzero@gmail.com',
       url='https://github.com/unsignedzero',
 
-      py_modules=['pydecorator.pyDecorator'],
+      py_modules=['pydecorator.pyBudget',
+                  'pydecorator.pyDecorator',
+                  'pydecorator.pyEventBuffer',
+                  'pydecorator.pyHistogram',
+                  'pydecorator.pyLogAnalyzer',
+                  'pydecorator.pyLogIndex',
+                  'pydecorator.pyMetrics',
+                  'pydecorator.pyMonitor',
+                  'pydecorator.pyQueryServer',
+                  'pydecorator.pyRecorder',
+                  'pydecorator.pySharedStats',
+                  'pydecorator.pyTraceDiff'],
       license='MIT',
       classifiers=[
          'Intended Audience :: Developers',
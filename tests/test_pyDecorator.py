@@ -23,13 +23,26 @@ if getcwd().endswith('pydecorator'):
   # Running on the root of the repo
 
   path.append('.')
-  from pydecorator import pyDecorator
+  from pydecorator import pyDecorator, pyHistogram, pyMetrics, pyMonitor
+  from pydecorator import pyQueryServer, pyRecorder
+  from pydecorator import pySharedStats, pyEventBuffer, pyLogAnalyzer
+  from pydecorator import pyLogIndex, pyTraceDiff
 
 else:
   # Running inside the test dir
 
   path.append('../pydecorator')
   import pyDecorator
+  import pyEventBuffer
+  import pyHistogram
+  import pyLogAnalyzer
+  import pyLogIndex
+  import pyMetrics
+  import pyMonitor
+  import pyQueryServer
+  import pyRecorder
+  import pySharedStats
+  import pyTraceDiff
 
 # Fixing the fileError issue as seen in 3.3
 # Should python 4 roll around, this needs to be changed...
@@ -90,6 +103,1930 @@ def test_pyDecorator():
   return 0
 
 
+def test_instrument():
+  r'''
+  Test that instrument wraps the matching methods of a class in place, that
+  they still work as methods and that uninstrument puts them back.
+  '''
+
+  class Sample(object):
+    def add(self, a, b):
+      return a + b
+
+    def skipped(self):
+      return 'skipped'
+
+    @staticmethod
+    def double(a):
+      return a * 2
+
+  original = Sample.__dict__['add']
+
+  wrapped = pyDecorator.pyDecorator.instrument(Sample, exclude='skip*')
+  assert wrapped == ['add', 'double']
+  assert isinstance(Sample.__dict__['add'], pyDecorator.pyDecorator)
+  assert Sample().add(1, 2) == 3
+
+  import inspect
+
+  sample = Sample()
+  bound = sample.add
+  assert inspect.ismethod(bound)
+  assert bound.__self__ is sample
+  assert bound.__func__ is Sample.__dict__['add']
+  assert bound == sample.add and bound != Sample().add
+  assert Sample.add is Sample.__dict__['add']
+  assert Sample.double(4) == 8
+  assert Sample().skipped() == 'skipped'
+  print_test( 'instrument wrapped the matching methods' )
+
+  # Already wrapped methods are left alone
+  assert pyDecorator.pyDecorator.instrument(Sample, exclude='skip*') == []
+
+  assert pyDecorator.pyDecorator.uninstrument(Sample) == 2
+  assert Sample.__dict__['add'] is original
+  assert Sample().add(2, 2) == 4
+  print_test( 'uninstrument restored the originals' )
+
+
+def test_pyMonitor():
+  r'''
+  Test that pyMonitor traces a recursive function with both engines and that
+  the call accounting matches what the wrapper would do.
+  '''
+
+  def fact(n):
+    if n <= 1:
+      return 1
+    return n * fact(n - 1)
+
+  for useMonitoring in (True, False):
+    calls = pyDecorator.pyDecorator.getCallCount()
+
+    monitor = pyMonitor.pyMonitor([fact], useMonitoring=useMonitoring)
+    monitor.start()
+    try:
+      assert fact(4) == 24
+    finally:
+      monitor.stop()
+
+    assert pyDecorator.pyDecorator.getCallCount() == calls + 4
+    assert pyDecorator.pyDecorator.getRecursionLevel() == 0
+    print_test( 'pyMonitor %s engine traced every call' % monitor.engine )
+
+  def countdown(n):
+    while n:
+      yield n
+      n -= 1
+
+  for useMonitoring in (True, False):
+    calls = pyDecorator.pyDecorator.getCallCount()
+
+    monitor = pyMonitor.pyMonitor([countdown], useMonitoring=useMonitoring)
+    histogram = monitor._histograms[countdown.__code__]
+    recorded = histogram.snapshot()['count']
+    monitor.start()
+    try:
+      counting = countdown(3)
+      assert next(counting) == 3
+      assert pyDecorator.pyDecorator.getRecursionLevel() == 0
+      assert list(counting) == [2, 1]
+    finally:
+      monitor.stop()
+
+    assert pyDecorator.pyDecorator.getCallCount() == calls + 1
+    assert pyDecorator.pyDecorator.getRecursionLevel() == 0
+    assert histogram.snapshot()['count'] == recorded + 1
+    print_test( 'pyMonitor %s engine traced a generator as one call' %
+      monitor.engine )
+
+  def stopping(monitor):
+    monitor.stop()
+    return pyDecorator.pyDecorator.getRecursionLevel()
+
+  for useMonitoring in (True, False):
+    monitor = pyMonitor.pyMonitor([stopping], useMonitoring=useMonitoring)
+    monitor.start()
+    assert stopping(monitor) == 0
+    assert pyDecorator.pyDecorator.getRecursionLevel() == 0
+    print_test( 'pyMonitor %s engine unwound the calls it stopped in' %
+      monitor.engine )
+
+  monitor = pyMonitor.pyMonitor([fact.__code__])
+  assert monitor._histograms[fact.__code__].name == \
+    pyDecorator.pyDecorator._qualifiedName(fact)
+  print_test( 'code objects are traced under the name of their function' )
+
+  from threading import Thread
+
+  echo = pyDecorator.pyDecorator.getEcho()
+  pyDecorator.pyDecorator.setEcho(False)
+  monitor.start()
+  try:
+    threads = [ Thread(target=fact, args=(3,)) for each in range(4) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    monitor.stop()
+    pyDecorator.pyDecorator.setEcho(echo)
+
+  assert monitor._stacks == []
+  print_test( 'pyMonitor forgot the stacks of threads that ended' )
+
+  overhead = pyMonitor.pyMonitor.measureOverhead(lambda: 0, (), 10)
+  assert 'plain' in overhead and 'wrapper' in overhead
+  print_test( 'pyMonitor measured overhead' )
+
+
+def test_pyHistogram():
+  r'''
+  Test that the histogram percentiles stay within the bucket precision and
+  that shards recorded by other threads are merged on read.
+  '''
+
+  from threading import Thread
+
+  histogram = pyHistogram.pyHistogram('sample')
+
+  def recordRange():
+    for micro in range(1, 1001):
+      histogram.record(micro / 1e6)
+
+  recordRange()
+  worker = Thread(target=recordRange)
+  worker.start()
+  worker.join()
+
+  snap = histogram.snapshot()
+  assert snap['count'] == 2000
+  assert abs(snap['p50'] - 500e-6) / 500e-6 < 0.04
+  assert abs(snap['p99'] - 990e-6) / 990e-6 < 0.04
+  assert abs(snap['max'] - 1000e-6) < 1e-9
+  assert snap['counts'].itemsize >= 8
+  print_test( 'pyHistogram percentiles are within precision' )
+
+  # The worker's shard was folded into the retired one when it ended
+  assert len(histogram._shards) == 1 and histogram._retired.count == 1000
+  print_test( 'pyHistogram retires the shards of ended threads' )
+
+  histogram.reset()
+  assert histogram.snapshot()['count'] == 0
+  print_test( 'pyHistogram reset' )
+
+  @pyDecorator.pyDecorator
+  def timed():
+    return 1
+
+  timed()
+  names = [ snap['name'] for snap in pyDecorator.pyDecorator.latencySnapshot() ]
+  assert any(name.endswith('timed') for name in names)
+  assert 'p99 ms' in pyHistogram.pyHistogram.report([snap])
+  print_test( 'pyDecorator records call latency' )
+
+
+def test_failedCall():
+  r'''
+  Test that a decorated function that raises keeps the recursion level
+  right and is counted as an error.
+  '''
+
+  @pyDecorator.pyDecorator
+  def failing(value):
+    hidden = value * 2
+    raise ValueError(hidden)
+
+  level = pyDecorator.pyDecorator.getRecursionLevel()
+  pyDecorator.pyDecorator.setCaptureLocals(True)
+
+  for _ in range(3):
+    try:
+      failing(21)
+    except ValueError as error:
+      assert error.args == (42,)
+    else:
+      assert False
+
+  pyDecorator.pyDecorator.setCaptureLocals(False)
+
+  assert pyDecorator.pyDecorator.getRecursionLevel() == level
+  print_test( 'recursion level survives exceptions' )
+
+  errors = [ snap for snap in
+    pyDecorator.pyDecorator.latencySnapshot(errors=True)
+    if snap['name'].endswith('failing') ]
+  assert errors[0]['count'] == 3
+  print_test( 'failed calls are counted' )
+
+
+def test_unprintableCall(capsys):
+  r'''
+  Test that a call whose arguments or result can not be printed still runs,
+  returns and keeps the recursion level right.
+  '''
+
+  class Unprintable(object):
+    def __repr__(self):
+      raise RuntimeError('no repr')
+    __str__ = __repr__
+
+  decorator = pyDecorator.pyDecorator
+
+  @decorator
+  def identity(value):
+    return value
+
+  @decorator(slowMs=0)
+  def slow(value):
+    return value
+
+  level = decorator.getRecursionLevel()
+  verbosity = decorator.getVerbosity()
+  decorator.setVerbosity(1)
+  try:
+    value = Unprintable()
+    assert identity(value) is value
+    assert slow(value) is value
+  finally:
+    decorator.setVerbosity(verbosity)
+
+  assert decorator.getRecursionLevel() == level
+  assert '>>Could not print the record of identity' in capsys.readouterr()[0]
+  print_test( 'unprintable calls run and keep the recursion level' )
+
+def test_diffLocals(capsys):
+  r'''
+  Test that with _diffLocals set only the locals that changed between two
+  dumps of the same frame are printed.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+  verbosity = decorator.getVerbosity()
+
+  decorator.setVerbosity(2)
+  decorator.setDiffLocals(True)
+
+  def stepping():
+    unchanged = list(range(100))
+    counter = 0
+    decorator.printCurFrame()
+    counter += 1
+    added = 'new'
+    decorator.printCurFrame()
+    decorator.printCurFrame()
+    return unchanged
+
+  capsys.readouterr()
+  try:
+    stepping()
+  finally:
+    decorator.setVerbosity(verbosity)
+    decorator.setDiffLocals(False)
+
+  out = capsys.readouterr()[0]
+  first, second, third = out.split('>>Function stepping')[1:]
+
+  assert 'unchanged' in first
+  assert 'unchanged' not in second
+  assert "'counter': 1" in second and "'added': 'new'" in second
+  assert 'unchanged since the last dump' in third
+  print_test( 'only changed locals are printed' )
+
+  @decorator
+  def dumping(value, text):
+    decorator.printCurFrame()
+    return value
+
+  decorator.setVerbosity(2)
+  decorator.setDiffLocals(True)
+  capsys.readouterr()
+  try:
+    dumping(1, 'x')
+    dumping(1, 'x')
+  finally:
+    decorator.setVerbosity(verbosity)
+    decorator.setDiffLocals(False)
+
+  out = capsys.readouterr()[0]
+  assert out.count('>>>Locals in the function are:') == 2
+  assert 'unchanged since the last dump' not in out
+  print_test( 'a new call reusing a frame id is dumped in full' )
+
+  import gc
+  import weakref
+
+  class Held(object):
+    pass
+
+  @decorator
+  def holding():
+    held = Held()
+    decorator.printCurFrame()
+    return weakref.ref(held)
+
+  decorator.setVerbosity(2)
+  decorator.setDiffLocals(True)
+  try:
+    held = holding()
+    gc.collect()
+    assert held() is None
+    assert not decorator._state().locals
+  finally:
+    decorator.setVerbosity(verbosity)
+    decorator.setDiffLocals(False)
+  print_test( 'a dumped frame is let go once its call returns' )
+
+  def dumper(value):
+    decorator.printCurFrame()
+    return value
+
+  def stacked():
+    outer = 'same'
+    dumper(1)
+    dumper(1)
+    decorator.printCurStack()
+    decorator.printCurStack()
+
+  decorator.setVerbosity(2)
+  decorator.setDiffLocals(True)
+  capsys.readouterr()
+  try:
+    stacked()
+  finally:
+    decorator.setVerbosity(verbosity)
+    decorator.setDiffLocals(False)
+
+  out = capsys.readouterr()[0]
+  first, second = out.split('>>Function dumper')[1:]
+  assert '>>>Locals in the function are:' in first
+  assert '>>>Locals in the function are:' in second
+  assert 'unchanged since the last dump' not in second.split('>>Function')[0]
+  print_test( 'calling an undecorated function again dumps it in full' )
+
+  last = out.split('>>Function stacked')[-1].split('>>Function')[0]
+  assert out.count('>>Function stacked') == 2
+  assert 'unchanged since the last dump' in last
+  print_test( 'printCurStack diffs the outer frames' )
+
+
+def test_diffGlobals(capsys):
+  r'''
+  Test that with _diffGlobals set printGlobals prints the caller's globals in
+  full once, then only what changed, restricted to the names asked for.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+  decorator.setDiffGlobals(True)
+
+  global diffTargetA, diffTargetB
+  diffTargetA = 1
+  diffTargetB = [1]
+
+  capsys.readouterr()
+  try:
+    decorator.printGlobals('diffTarget*', frameIndex=1)
+    first = capsys.readouterr()[0]
+    decorator.printGlobals('diffTarget*', frameIndex=1)
+    second = capsys.readouterr()[0]
+    diffTargetB = [2]
+    decorator.printGlobals('diffTarget*', frameIndex=1)
+    third = capsys.readouterr()[0]
+  finally:
+    decorator.setDiffGlobals(False)
+
+  assert 'diffTargetA' in first and 'print_test' not in first
+  assert 'Globals: 2 names, 2 added, 0 changed, 0 removed' in first
+  assert 'diffTargetA' not in second
+  assert 'Globals: 2 names, 0 added, 0 changed, 0 removed' in second
+  assert "{'diffTargetB': [2]}" in third and 'diffTargetA' not in third
+  print_test( 'only changed globals are printed' )
+
+  class Target(object):
+    pass
+
+  # The old value is freed first, so the new one can take its address
+  decorator.setDiffGlobals(True)
+  try:
+    diffTargetA = Target()
+    decorator.printGlobals('diffTargetA', frameIndex=1)
+    diffTargetA = None
+    diffTargetA = Target()
+    capsys.readouterr()
+    decorator.printGlobals('diffTargetA', frameIndex=1)
+    replaced = capsys.readouterr()[0]
+  finally:
+    decorator.setDiffGlobals(False)
+
+  assert 'Globals: 1 names, 0 added, 1 changed, 0 removed' in replaced
+  print_test( 'a global replaced at the same address is changed' )
+
+  capsys.readouterr()
+  decorator.printGlobals('_spanContext')
+  assert '_spanContext' in capsys.readouterr()[0]
+  print_test( 'printGlobals prints its own module by default' )
+
+
+def test_codeTextCache(capsys):
+  r'''
+  Test that repeated frame dumps of the same function reuse the text cached
+  for its code object and still print the right line numbers.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+  verbosity = decorator.getVerbosity()
+  decorator.setVerbosity(3)
+
+  def dumped():
+    decorator.printCurFrame()
+    decorator.printCurFrame()
+    return dumped.__code__
+
+  capsys.readouterr()
+  try:
+    code = dumped()
+  finally:
+    decorator.setVerbosity(verbosity)
+
+  out = capsys.readouterr()[0]
+  line = code.co_firstlineno
+
+  assert code in decorator._codeText
+  assert "line %i, in dumped, argcount 0" % (line + 1) in out
+  assert "line %i, in dumped, argcount 0" % (line + 2) in out
+  assert out.count('>>>Constants set are:') == 2
+  print_test( 'frame headers are cached per code object' )
+
+  # The same source compiled from two files makes equal code objects
+  source = 'def same(decorator):\n  decorator.printCurFrame()\n'
+  functions = []
+  for filename in ('first.py', 'second.py'):
+    namespace = {}
+    exec(compile(source, filename, 'exec'), namespace)
+    functions.append(namespace['same'])
+
+  decorator.setVerbosity(1)
+  capsys.readouterr()
+  try:
+    for function in functions:
+      function(decorator)
+  finally:
+    decorator.setVerbosity(verbosity)
+
+  out = capsys.readouterr()[0]
+  assert functions[0].__code__ == functions[1].__code__
+  assert "File 'first.py'" in out and "File 'second.py'" in out
+  print_test( 'equal code objects from two files keep their own headers' )
+
+
+def test_foldRecursion(capsys):
+  r'''
+  Test that a folded recursive function prints only its root call and a
+  summary with the calls per depth.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+
+  @decorator
+  def fib(n):
+    if n < 2:
+      return n
+    return fib(n - 1) + fib(n - 2)
+
+  decorator.setFoldRecursion(True)
+  decorator.setFoldTopK(2)
+  calls = decorator.getCallCount()
+
+  capsys.readouterr()
+  try:
+    assert fib(5) == 5
+  finally:
+    decorator.setFoldRecursion(False)
+    decorator.setFoldTopK(0)
+
+  out = capsys.readouterr()[0]
+
+  assert decorator.getCallCount() == calls + 15
+  assert decorator.getRecursionLevel() == 0
+  assert out.count('Starting call') == 1 and out.count('Ended call') == 1
+  # Call numbers are handed out in blocks per thread, so the root's is read
+  root = out.split('Starting call to fib [Call#')[1].split(']')[0]
+  assert 'fib [Call#%s]: 15 calls, max depth 5, 0 raised' % root in out
+  assert out.count(' took ') == 2
+  print_test( 'recursive calls are folded into a summary' )
+
+  class Inner(object):
+    @decorator
+    def run(self):
+      return 1
+
+  class Outer(object):
+    @decorator
+    def run(self):
+      return Inner().run() + 1
+
+  decorator.setFoldRecursion(True)
+  capsys.readouterr()
+  try:
+    assert Outer().run() == 2
+  finally:
+    decorator.setFoldRecursion(False)
+
+  out = capsys.readouterr()[0]
+  assert out.count('Starting call to run') == 2
+  assert out.count(': 1 calls, max depth 1, 0 raised') == 2
+  print_test( 'functions sharing a name are not folded together' )
+
+
+def test_rateLimitAndCollapse(capsys):
+  r'''
+  Test that the rate limit drops the records, but not the count, of calls
+  over the limit, and that repeated calls are collapsed into a count.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+
+  @decorator
+  def hot(value):
+    return value
+
+  name = 'hot'
+  decorator.setRateLimit(3, name)
+  calls = decorator.getCallCount()
+
+  capsys.readouterr()
+  try:
+    for value in range(100):
+      hot(value)
+  finally:
+    decorator.setRateLimit(None, name)
+
+  out = capsys.readouterr()[0]
+  assert decorator.getCallCount() == calls + 100
+  assert out.count('Starting call to hot') == 3
+  assert out.count('Ended call to hot') == 3
+  print_test( 'rate limit bounds the records printed' )
+
+  decorator.setCollapseRepeats(True)
+  try:
+    for value in (1, 1, 1, 1, 2):
+      hot(value)
+    decorator.flush()
+  finally:
+    decorator.setCollapseRepeats(False)
+
+  out = capsys.readouterr()[0]
+  assert out.count('Starting call to hot') == 2
+  assert 'Previous call to hot repeated 3 more times' in out
+  assert out.index('repeated 3') < out.index('Returned 2')
+  print_test( 'repeated calls are collapsed' )
+
+  class First(object):
+    @staticmethod
+    @decorator
+    def hot(value):
+      return value
+
+  class Second(object):
+    @staticmethod
+    @decorator
+    def hot(value):
+      return value
+
+  decorator.setRateLimit(1, First.hot.qualname)
+  capsys.readouterr()
+  try:
+    for value in range(5):
+      First.hot(value)
+      Second.hot(value)
+  finally:
+    decorator.setRateLimit(None, First.hot.qualname)
+
+  out = capsys.readouterr()[0]
+  assert out.count('Starting call to hot') == 6
+  print_test( 'functions sharing a name are rate limited apart' )
+
+  decorator.setCollapseRepeats(True)
+  try:
+    for value in range(3):
+      First.hot(1)
+      Second.hot(1)
+    decorator.flush()
+  finally:
+    decorator.setCollapseRepeats(False)
+
+  out = capsys.readouterr()[0]
+  assert out.count('Starting call to hot') == 6
+  assert 'repeated' not in out
+  print_test( 'functions sharing a name are not collapsed together' )
+
+
+def test_collapseThreads(capsys):
+  r'''
+  Test that repeated calls from many threads at once are collapsed without
+  losing or double counting any, and that the rate limit keeps count.
+  '''
+
+  import re
+  import sys
+  import threading
+
+  decorator = pyDecorator.pyDecorator
+  errors = []
+
+  @decorator
+  def same(value):
+    return value
+
+  def calls():
+    try:
+      for each in range(200):
+        same(1)
+    except Exception as error:
+      errors.append(error)
+
+  # Switch threads as often as possible so that they interleave
+  interval = getattr(sys, 'getswitchinterval', lambda: None)()
+  if interval is not None:
+    sys.setswitchinterval(1e-6)
+
+  capsys.readouterr()
+  decorator.setCollapseRepeats(True)
+  try:
+    threads = [ threading.Thread(target=calls) for each in range(8) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    decorator.flush()
+  finally:
+    decorator.setCollapseRepeats(False)
+
+  out = capsys.readouterr()[0]
+  repeats = sum( int(count) for count in
+    re.findall(r'Previous call to same repeated (\d+) more times', out) )
+  assert errors == []
+  assert out.count('Ended call to same') + repeats == 1600
+  assert decorator.getRecursionLevel(allThreads=True) == 0
+  print_test( 'calls collapsed across threads are all counted' )
+
+  decorator.setRateLimit(5, 'same')
+  try:
+    threads = [ threading.Thread(target=calls) for each in range(8) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    decorator.setRateLimit(None, 'same')
+    if interval is not None:
+      sys.setswitchinterval(interval)
+
+  assert errors == [] and not decorator._muted
+  print_test( 'rate limited calls across threads are all unmuted' )
+
+def test_pySharedStats():
+  r'''
+  Test that calls made in forked children and in the parent are summed by a
+  reader of the shared segment, those of a child that died included once
+  another took its slot.
+  '''
+
+  from os import _exit, fork, getpid, waitpid
+
+  if pySharedStats.shared_memory is None:
+    print_test( 'pySharedStats skipped, no shared_memory' )
+    return
+
+  decorator = pyDecorator.pyDecorator
+  stats = pySharedStats.pySharedStats('pydecorator_test_%i' % getpid(),
+    create=True, slots=2, functions=8)
+  decorator.addHook(stats)
+
+  @decorator
+  def shared():
+    return 0
+
+  try:
+    shared()
+
+    # The second child only finds the slot the first left when it died
+    for calls in (3, 2):
+      child = fork()
+      if child == 0:
+        try:
+          for _ in range(calls):
+            shared()
+        finally:
+          _exit(0)
+      waitpid(child, 0)
+
+    reader = pySharedStats.pySharedStats(stats.name)
+    totals = reader.snapshot()
+    reader.close()
+  finally:
+    decorator.removeHook(stats)
+    stats.close()
+
+  name = [ key for key in totals if key.endswith('shared') ][0]
+  assert totals[name]['calls'] == 6
+  assert totals[name]['processes'] == 2
+  assert 'calls/s' in pySharedStats.pySharedStats.report(totals)
+  print_test( 'pySharedStats summed calls across processes' )
+
+  from os import close, pipe, read, write
+
+  # Children released at once all claim the only slot at the same time, one
+  # of them gets it. Each holds what it got until all of them tried.
+  stats = pySharedStats.pySharedStats('pydecorator_race_%i' % getpid(),
+    create=True, slots=1, functions=8)
+
+  try:
+    start, release = pipe()
+    hold, letGo = pipe()
+    triedRead, tried = pipe()
+    children = []
+
+    for each in range(16):
+      child = fork()
+      if child == 0:
+        claimed = False
+        try:
+          close(release)
+          close(letGo)
+          read(start, 1)
+          claimed = stats._claim() is not None
+          write(tried, b'.')
+          read(hold, 1)
+        finally:
+          _exit(int(claimed))
+      children.append(child)
+
+    close(start)
+    close(release)
+    for child in children:
+      read(triedRead, 1)
+    close(letGo)
+    claims = [ waitpid(child, 0)[1] >> 8 for child in children ]
+  finally:
+    stats.close()
+
+  for fd in (hold, triedRead, tried):
+    close(fd)
+
+  assert sum(claims) == 1
+  print_test( 'pySharedStats processes claimed the slot once' )
+
+  import gc
+  import weakref
+  from os import fstat, stat as statOf
+
+  # Made again under the same name, the segment is locked through its new
+  # lock file, and a closed one is not kept alive for the fork callback
+  stats = pySharedStats.pySharedStats('pydecorator_again_%i' % getpid(),
+    create=True, slots=1, functions=8)
+  stats._claim()
+  stats.close()
+  stats = pySharedStats.pySharedStats(stats.name, create=True, slots=1,
+    functions=8)
+  try:
+    assert stats._claim() == 0
+    fd = pySharedStats.pySharedStats._lockFiles[stats.name]
+    assert fstat(fd).st_ino == statOf(stats._lockPath(stats.name)).st_ino
+  finally:
+    stats.close()
+
+  closed = weakref.ref(stats)
+  del stats
+  gc.collect()
+  assert closed() is None
+  print_test( 'pySharedStats locks a segment made again and lets go of it' )
+
+
+def test_pyQueryServer():
+  r'''
+  Test that the query server answers stats and stacks over its socket.
+  '''
+
+  from os import getpid
+  from tempfile import gettempdir
+  from os.path import join
+
+  @pyDecorator.pyDecorator
+  def queried():
+    return 0
+
+  queried()
+
+  path = join(gettempdir(), 'pydecorator_test_%i.sock' % getpid())
+  server = pyQueryServer.pyQueryServer(path)
+  server.start()
+
+  try:
+    stats = pyQueryServer.pyQueryServer.query(path, 'stats')
+    stacks = pyQueryServer.pyQueryServer.query(path, 'stacks locals')
+    unknown = pyQueryServer.pyQueryServer.query(path, 'nonsense')
+  finally:
+    server.stop()
+
+  assert stats['callCount'] == pyDecorator.pyDecorator.getCallCount()
+  assert any(name.endswith('queried') for name in stats['functions'])
+  assert any(frame['function'] == 'test_pyQueryServer'
+    for frames in stacks['stacks'].values() for frame in frames)
+  assert 'error' in unknown
+  print_test( 'pyQueryServer answered over its socket' )
+
+  import socket
+  import stat
+  from os import stat as statOf
+
+  # A client that never sends its request only holds the server so long
+  timeout = pyQueryServer._pyQueryHandler.timeout
+  pyQueryServer._pyQueryHandler.timeout = 0.2
+  server.start()
+  idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+  try:
+    assert stat.S_IMODE(statOf(path).st_mode) & 0o077 == 0
+    idle.connect(path)
+    stats = pyQueryServer.pyQueryServer.query(path, 'stats', timeout=2.0)
+  finally:
+    idle.close()
+    server.stop()
+    pyQueryServer._pyQueryHandler.timeout = timeout
+
+  assert stats['callCount'] == pyDecorator.pyDecorator.getCallCount()
+  print_test( 'pyQueryServer socket is owner only and drops idle clients' )
+
+  with open(path, 'w') as taken:
+    taken.write('not a socket')
+  try:
+    server.start()
+  except ValueError:
+    pass
+  else:
+    server.stop()
+    assert False
+  assert isfile(path)
+  remove(path)
+  print_test( 'pyQueryServer leaves a file that is not a socket alone' )
+
+
+def test_pyMetrics():
+  r'''
+  Test that pyMetrics counts calls, errors and latency of decorated
+  functions, caps its label values and serves them over HTTP.
+  '''
+
+  try:
+    from urllib.request import urlopen
+  except ImportError:
+    from urllib2 import urlopen
+
+  decorator = pyDecorator.pyDecorator
+  metrics = pyMetrics.pyMetrics(maxFunctions=1)
+  decorator.addHook(metrics)
+
+  @decorator
+  def measured(fail):
+    if fail:
+      raise KeyError(fail)
+
+  @decorator
+  def unlabelled():
+    return 0
+
+  try:
+    measured(False)
+    try:
+      measured(True)
+    except KeyError:
+      pass
+    unlabelled()
+
+    port = metrics.startHTTP(0)
+    served = urlopen('http://127.0.0.1:%i/metrics' % port).read()
+  finally:
+    decorator.removeHook(metrics)
+    metrics.stop()
+
+  text = metrics.render()
+  name = [ key for key in metrics._labels if key.endswith('measured') ][0]
+
+  assert served.decode('utf-8') == text
+  assert 'pydecorator_calls_total{function="%s"} 2' % name in text
+  assert 'pydecorator_errors_total{function="%s"} 1' % name in text
+  assert 'pydecorator_in_flight{function="%s"} 0' % name in text
+  assert 'pydecorator_call_seconds_bucket{function="%s",le="+Inf"} 2' % name \
+    in text
+  assert 'pydecorator_calls_total{function="__other__"} 1' in text
+  print_test( 'pyMetrics rendered the exposition format' )
+
+  import threading
+
+  decorator.addHook(metrics)
+  try:
+    threads = [ threading.Thread(target=measured, args=(False,))
+      for each in range(4) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    measured(False)
+  finally:
+    decorator.removeHook(metrics)
+
+  text = metrics.render()
+  assert 'pydecorator_calls_total{function="%s"} 7' % name in text
+  assert [ shard.thread() for shard in metrics._shards ] == \
+    [threading.current_thread()]
+  assert metrics.render() == text
+  print_test( 'pyMetrics sums and retires the series of threads' )
+
+
+def test_failingHook(capsys):
+  r'''
+  Test that a hook that raises is removed and never changes what the
+  decorated call returns or raises, decorated or traced.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+
+  class Broken(object):
+    def __init__(self, method):
+      self.method = method
+      self.calls = 0
+
+    def callStarted(self, name):
+      self.calls += 1
+      if self.method == 'callStarted':
+        raise RuntimeError('hook broke')
+
+    def callEnded(self, name, elapsed, error):
+      if self.method == 'callEnded':
+        raise RuntimeError('hook broke')
+
+  @decorator
+  def ok():
+    return 'fine'
+
+  @decorator
+  def failing():
+    raise KeyError('own')
+
+  for method in ('callStarted', 'callEnded'):
+    hook = Broken(method)
+    decorator.addHook(hook)
+    try:
+      assert ok() == 'fine'
+      assert ok() == 'fine'
+    finally:
+      decorator.removeHook(hook)
+    assert hook.calls == 1 and hook not in decorator._hooks
+
+  hook = Broken('callEnded')
+  decorator.addHook(hook)
+  try:
+    failing()
+  except KeyError:
+    pass
+  else:
+    assert False
+  finally:
+    decorator.removeHook(hook)
+
+  assert 'hook broke' not in capsys.readouterr()[0]
+  print_test( 'a hook that raises is removed, the call is left alone' )
+
+  def traced(value):
+    return value * 2
+
+  hook = Broken('callEnded')
+  decorator.addHook(hook)
+  monitor = pyMonitor.pyMonitor([traced])
+  monitor.start()
+  try:
+    assert traced(2) == 4
+  finally:
+    monitor.stop()
+    decorator.removeHook(hook)
+
+  assert hook not in decorator._hooks
+  print_test( 'a hook that raises under pyMonitor is removed' )
+
+
+def test_pyRecorder():
+  r'''
+  Test that sampled calls are recorded with their inputs as they were before
+  the call and replayed with their results verified.
+  '''
+
+  from os import getpid
+  from os.path import join
+  from tempfile import gettempdir
+
+  @pyDecorator.pyDecorator
+  def consume(items, scale=1):
+    total = sum(items) * scale
+    del items[:]
+    return total
+
+  path = join(gettempdir(), 'pydecorator_test_%i.rec' % getpid())
+  recorder = pyRecorder.pyRecorder(path, sampleEvery=2)
+  recorder.attach(consume)
+
+  try:
+    for value in range(10):
+      consume([value, value], scale=2)
+  finally:
+    recorder.close()
+
+  assert recorder.recorded == 5 and consume.recorder is None
+
+  results = pyRecorder.pyRecorder.replay(path, consume, repeat=3)
+  remove(path)
+
+  assert results['records'] == 5 and results['calls'] == 15
+  assert results['mismatches'] == 0
+  assert results['latency']['count'] == 15
+  print_test( 'pyRecorder recorded and replayed sampled calls' )
+
+  @pyDecorator.pyDecorator
+  def divide(value):
+    return 1.0 / value
+
+  recorder = pyRecorder.pyRecorder(path)
+  recorder.attach(divide)
+  recorder.close()
+  recorder._file = None
+  recorder.attach(divide)
+
+  try:
+    divide(0)
+  except ZeroDivisionError:
+    pass
+  else:
+    assert False
+  remove(path)
+
+  assert divide.recorder is None and recorder.failed is not None
+  assert divide(2) == 0.5
+  print_test( 'a failing recorder is detached, the call raises its own error' )
+
+
+def test_snapshotStrategies(capsys):
+  r'''
+  Test that each argument snapshot strategy prints the arguments as they
+  were when it says it does.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+  verbosity = decorator.getVerbosity()
+
+  @decorator
+  def mutate(items):
+    items.append('after')
+    return len(items)
+
+  decorator.setVerbosity(1)
+  printed = {}
+
+  try:
+    for strategy in ('render', 'reference', 'shallow', 'pickle'):
+      decorator.setSnapshot(strategy, 'mutate')
+      capsys.readouterr()
+      mutate(['before'])
+      printed[strategy] = capsys.readouterr()[0]
+  finally:
+    decorator.setSnapshot(None, 'mutate')
+    decorator.setVerbosity(verbosity)
+
+  assert "(['before'],)" in printed['render']
+  assert "(['before', 'after'],)" in printed['reference']
+  assert "(['before'],)" in printed['shallow']
+  assert "(['before'],)" in printed['pickle']
+  assert printed['pickle'].index('Args are printed when the call ends') < \
+    printed['pickle'].index("(['before'],)")
+  print_test( 'snapshot strategies print the right arguments' )
+
+  # The qualified name wins over the bare one
+  decorator.setVerbosity(1)
+  decorator.setSnapshot('render', 'mutate')
+  decorator.setSnapshot('reference', mutate.qualname)
+  try:
+    capsys.readouterr()
+    mutate(['before'])
+    out = capsys.readouterr()[0]
+  finally:
+    decorator.setSnapshot(None, mutate.qualname)
+    decorator.setSnapshot(None, 'mutate')
+    decorator.setVerbosity(verbosity)
+
+  assert "(['before', 'after'],)" in out and "(['before'],)" not in out
+  print_test( 'snapshot strategies are looked up by qualified name' )
+
+  decorator.setVerbosity(1)
+  decorator.setSnapshot('pickle', 'mutate')
+  decorator.setBuffered(True, interval=60)
+  capsys.readouterr()
+  try:
+    mutate(['before'])
+    records = [ event[3] for shard in decorator._buffer._shards
+      for event in shard.events ]
+    decorator.flush()
+  finally:
+    decorator.setBuffered(False)
+    decorator.setSnapshot(None, 'mutate')
+    decorator.setVerbosity(verbosity)
+
+  out = capsys.readouterr()[0]
+  assert [ type(record).__name__ for record in records ].count(
+    '_pyDeferredArgs') == 1
+  assert out.index("(['before'],)") < out.index('Ended call to mutate')
+  print_test( 'buffered snapshots are rendered by the flusher' )
+
+  costs = decorator.measureSnapshotCost(([1] * 100,), calls=10)
+  assert sorted(costs) == ['pickle', 'reference', 'render', 'shallow']
+  print_test( 'snapshot strategies were measured' )
+
+
+def test_overheadGovernor(capsys):
+  r'''
+  Test that the governor steps down while over budget, back up once under
+  it and undoes everything when the budget is removed.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+  verbosity = decorator.getVerbosity()
+
+  @decorator
+  def cheap():
+    return 1
+
+  decorator.setVerbosity(1)
+  capsys.readouterr()
+
+  try:
+    # Any overhead is over this budget, and every call ends a window
+    assert decorator.setOverheadBudget(1e-12, window=0)
+    for each in range(20):
+      cheap()
+
+    printed = capsys.readouterr()[0]
+    config = decorator._config
+    assert 'Lowered verbosity to 0' in printed
+    assert 'Printing one call in 2' in printed
+    assert config.verbosity == 0 and decorator.getVerbosity() == 1
+    assert config.sampleEvery == decorator._governorMaxSampleEvery
+    assert decorator.getSampleEvery() == 1
+    assert not config.echo and decorator.getEcho()
+    print_test( 'governor stepped down over budget' )
+
+    # What is set while degraded is kept, the steps apply over it
+    decorator.setVerbosity(3)
+    assert decorator._config.verbosity == 2
+
+    decorator.setOverheadBudget(1e9, window=0)
+    for each in range(decorator._governor.calmWindows):
+      cheap()
+    assert decorator._config.echo
+    assert 'Restored echo' in capsys.readouterr()[0]
+    print_test( 'governor stepped back up under budget' )
+
+  finally:
+    decorator.setOverheadBudget(0)
+
+  config = decorator._config
+  assert decorator.getVerbosity() == 3 and config.verbosity == 3
+  assert config.sampleEvery == 1 and config.echo
+  assert not decorator.setOverheadBudget(-1)
+  decorator.setVerbosity(verbosity)
+  print_test( 'removing the budget undid every step' )
+
+
+def test_pyEventBuffer(capsys):
+  r'''
+  Test that buffered records of many threads are all written, whole and in
+  timestamp order, and that the contention benchmark runs.
+  '''
+
+  import threading
+
+  written = []
+  buffer = pyEventBuffer.pyEventBuffer(written.extend, grace=0)
+  buffer.append('first')
+  buffer.append('second')
+  assert buffer.flush() == 2
+  assert written == ['first', 'second']
+  print_test( 'records of one thread are written in order' )
+
+  decorator = pyDecorator.pyDecorator
+
+  @decorator
+  def work(value):
+    return value * 2
+
+  def calls():
+    for each in range(50):
+      work(each)
+
+  capsys.readouterr()
+  assert decorator.setBuffered(True, interval=0.01)
+  try:
+    threads = [ threading.Thread(target=calls) for each in range(4) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    decorator.flush()
+  finally:
+    decorator.setBuffered(False)
+
+  lines = capsys.readouterr()[0].splitlines()
+  assert sum(line.startswith('>>Ended call to work') for line in lines) == 200
+  print_test( 'every buffered record was written whole' )
+
+  results = pyEventBuffer.pyEventBuffer.measureContention((1, 2), events=200)
+  assert sorted(results) == [1, 2]
+  assert all(rate['buffered'] > 0 and rate['locked'] > 0
+    for rate in results.values())
+  print_test( 'contention benchmark ran' )
+
+
+def test_threadedCounters():
+  r'''
+  Test that call counts, call numbers and recursion levels stay right with
+  many threads calling at once, and that setters swap in a new snapshot.
+  '''
+
+  import threading
+
+  decorator = pyDecorator.pyDecorator
+  numbers = []
+  levels = []
+  errors = []
+
+  @decorator
+  def nested(depth):
+    numbers.append(decorator._state().nextNumber - 1)
+    if depth:
+      return nested(depth - 1)
+    return decorator.getRecursionLevel()
+
+  # Asserting in a thread would not fail the test, so everything is checked
+  # once they are joined
+  def calls():
+    try:
+      for each in range(100):
+        levels.append(nested(2))
+    except Exception as error:
+      errors.append(error)
+
+  echo = decorator.getEcho()
+  decorator.setEcho(False)
+  try:
+    before = decorator.getCallCount()
+    threads = [ threading.Thread(target=calls) for each in range(8) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    decorator.setEcho(echo)
+
+  assert errors == [] and levels == [3] * 800
+  assert decorator.getCallCount() == before + 2400
+  assert len(set(numbers)) == 2400
+  assert decorator.getRecursionLevel(allThreads=True) == 0
+  print_test( 'counters are right across threads' )
+
+  config = decorator._config
+  verbosity = decorator.getVerbosity()
+  decorator.setVerbosity(verbosity + 1)
+  assert decorator._config is not config
+  assert decorator._config.verbosity == verbosity + 1
+  assert config.verbosity == verbosity
+  decorator.setVerbosity(verbosity)
+  print_test( 'setters publish a new configuration' )
+
+  # Every call ends a governor window, and nested is folded
+  sampleEvery = decorator.getSampleEvery()
+  decorator.setEcho(False)
+  decorator.setFoldRecursion(True)
+  decorator.setOverheadBudget(1e-12, window=0)
+  try:
+    threads = [ threading.Thread(target=calls) for each in range(8) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # Closing the window drops the shards of the threads that ended
+    nested(0)
+    shards = decorator._governor.shards
+    assert [ shard.thread() for shard in shards ] == \
+      [threading.current_thread()]
+  finally:
+    decorator.setOverheadBudget(0)
+    decorator.setFoldRecursion(False)
+    decorator.setEcho(echo)
+
+  assert errors == [] and decorator.runningFolds() == []
+  assert decorator.getVerbosity() == verbosity
+  assert decorator.getSampleEvery() == sampleEvery
+  print_test( 'governor and folds stay right across threads' )
+
+  rates = decorator.measureScaling((1, 2), calls=200)
+  assert sorted(rates) == [1, 2] and all(rates.values())
+  print_test( 'scaling benchmark ran' )
+
+
+def test_slowCalls(capsys):
+  r'''
+  Test that a function with a latency budget prints only its slow and
+  failed calls, in full, and counts the slow ones.
+  '''
+
+  from time import sleep
+
+  decorator = pyDecorator.pyDecorator
+
+  @decorator(slowMs=20, slowStack=True)
+  def wait(seconds):
+    sleep(seconds)
+    if seconds < 0.001:
+      raise ValueError('too short')
+    return seconds
+
+  capsys.readouterr()
+  level = decorator.getRecursionLevel()
+  calls = decorator.getCallCount()
+
+  assert wait(0.001) == 0.001
+  assert capsys.readouterr()[0] == ''
+  print_test( 'calls within budget print nothing' )
+
+  assert wait(0.05) == 0.05
+  printed = capsys.readouterr()[0]
+  assert '>>Slow call to wait' in printed and '(1 so far)' in printed
+  assert '(0.05,)' in printed and '>>Returned 0.05' in printed
+  assert 'test_slowCalls' in printed
+  assert decorator.budgetViolations()[wait.qualname] == 1
+  print_test( 'slow calls print in full and are counted' )
+
+  try:
+    wait(0)
+  except ValueError:
+    pass
+  printed = capsys.readouterr()[0]
+  assert '>>Failed call to wait' in printed
+  assert '>>Raised ValueError: too short' in printed
+  assert decorator.budgetViolations()[wait.qualname] == 1
+  assert decorator.getCallCount() == calls + 3
+  assert decorator.getRecursionLevel() == level
+  print_test( 'failed calls print in full and are not counted as slow' )
+
+
+def test_tailSampling(capsys):
+  r'''
+  Test that whole call trees are held back and printed, in order, only when
+  a call raised, the root was slow or they were sampled.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+  verbosity = decorator.getVerbosity()
+
+  @decorator
+  def leaf(value):
+    if value < 0:
+      raise ValueError('negative')
+    return value
+
+  @decorator
+  def root(values):
+    total = 0
+    for value in values:
+      try:
+        total += leaf(value)
+      except ValueError:
+        pass
+    return total
+
+  decorator.setVerbosity(1)
+  before = decorator.tailSamplingStats()
+  capsys.readouterr()
+
+  try:
+    assert decorator.setTailSampling(True, slowMs=None, rate=0.0)
+    assert root([1, 2]) == 3
+    assert capsys.readouterr()[0] == ''
+    print_test( 'uninteresting trees print nothing' )
+
+    assert root([1, -1]) == 1
+    printed = capsys.readouterr()[0]
+    assert '>>Kept the call tree of root' in printed
+    assert 'a call raised' in printed
+    assert printed.index('>>Kept the call tree') < \
+      printed.index('Starting call to root') < \
+      printed.index('Raised ValueError: negative') < \
+      printed.index('Ended call to root')
+    print_test( 'trees with a failure are printed in order' )
+
+    decorator.setTailSampling(True, slowMs=0)
+    root([5])
+    printed = capsys.readouterr()[0]
+    assert 'the root took' in printed and '([5],)' in printed
+
+    decorator.setTailSampling(True, slowMs=None, rate=1.0)
+    root([6])
+    assert 'sampled' in capsys.readouterr()[0]
+    print_test( 'slow and sampled trees are printed' )
+
+  finally:
+    decorator.setTailSampling(False)
+    decorator.setVerbosity(verbosity)
+
+  after = decorator.tailSamplingStats()
+  assert after['kept'] == before['kept'] + 3
+  assert after['dropped'] == before['dropped'] + 1
+  assert decorator.getRecursionLevel() == 0
+  assert not decorator.setTailSampling(True, rate=2)
+  print_test( 'kept and dropped trees are counted' )
+
+
+def test_spans(capsys):
+  r'''
+  Test that spans follow work into executors and asyncio tasks so the whole
+  trace can be reassembled, and that records show them.
+  '''
+
+  import asyncio
+  from concurrent.futures import ThreadPoolExecutor
+  from time import sleep
+
+  decorator = pyDecorator.pyDecorator
+
+  @decorator
+  def work(seconds):
+    sleep(seconds)
+    return decorator.currentSpan()
+
+  async def task(seconds):
+    return work(seconds)
+
+  async def tasks():
+    return await asyncio.gather(task(0.001), task(0.002))
+
+  @decorator
+  def handler():
+    with ThreadPoolExecutor(2) as pool:
+      threaded = [ pool.submit(work, seconds).result()
+        for seconds in (0.001, 0.03) ]
+    return decorator.currentSpan(), threaded + asyncio.run(tasks())
+
+  assert decorator.setSpans(True)
+  try:
+    capsys.readouterr()
+    span, children = handler()
+    printed = capsys.readouterr()[0]
+  finally:
+    decorator.setSpans(False)
+
+  traceId, spanId, parentId = span
+  assert parentId == 0 and traceId == spanId
+  assert len(children) == 4
+  assert all( child[0] == traceId and child[2] == spanId
+    for child in children )
+  assert ('[trace %016x span %016x parent %016x]' % span) in printed
+  assert decorator.currentSpan() is None
+  print_test( 'spans followed the work into executors and tasks' )
+
+  roots = decorator.spanTree(traceId)
+  assert len(roots) == 1 and len(roots[0]['children']) == 4
+  path = decorator.criticalPath(traceId)
+  assert [ name for name, elapsed in path ] == [ handler.qualname,
+    work.qualname ]
+  assert path[0][1] >= 0.03
+  print_test( 'trace was reassembled with its critical path' )
+
+  assert not hasattr(ThreadPoolExecutor.submit, '_pyDecoratorOriginal')
+
+  @decorator
+  def leaf():
+    return decorator.currentSpan()
+
+  decorator.setSpans(True)
+  decorator.setTailSampling(True, slowMs=None, rate=1.0)
+  try:
+    capsys.readouterr()
+    span = leaf()
+    printed = capsys.readouterr()[0]
+  finally:
+    decorator.setTailSampling(False)
+    decorator.setSpans(False)
+
+  spanText = '[trace %016x span %016x parent %016x]' % span
+  assert 'Kept the call tree of leaf' in printed
+  assert ('%s. Returned' % spanText) in printed
+  print_test( 'kept call trees show spans on their end records' )
+
+  @decorator
+  async def fetch(seconds):
+    await asyncio.sleep(seconds)
+    return decorator.currentSpan(), work(0)
+
+  async def fetches():
+    return await asyncio.gather(fetch(0.02), asyncio.ensure_future(fetch(0)))
+
+  decorator.setSpans(True)
+  try:
+    (span, child), (other, otherChild) = asyncio.run(fetches())
+  finally:
+    decorator.setSpans(False)
+
+  # Each span lasted the await and was the parent of the work it did
+  assert child[2] == span[1] and otherChild[2] == other[1]
+  fetched = decorator.spanTree(span[0])[0]
+  assert fetched['name'] == fetch.qualname and fetched['parent'] == 0
+  assert fetched['elapsed'] >= 0.02
+  assert [ node['name'] for node in fetched['children'] ] == [work.qualname]
+  assert decorator.currentSpan() is None
+  print_test( 'spans of async functions cover their await' )
+
+
+def test_pyLogAnalyzer(capsys, tmp_path):
+  r'''
+  Test that the analyzer finds every call, duration, failure and the
+  deepest nesting in what pyDecorator prints, across chunk boundaries.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+  verbosity = decorator.getVerbosity()
+
+  @decorator
+  def fact(n):
+    if n < 0:
+      raise ValueError('negative')
+    return 1 if n <= 1 else n * fact(n - 1)
+
+  decorator.setVerbosity(1)
+  capsys.readouterr()
+  try:
+    fact(5)
+    try:
+      fact(-1)
+    except ValueError:
+      pass
+  finally:
+    decorator.setVerbosity(verbosity)
+
+  logpath = tmp_path / 'analyzed'
+  logpath.write_text(capsys.readouterr()[0])
+
+  for chunkSize in (7, 1 << 20):
+    result = pyLogAnalyzer.pyLogAnalyzer.analyze(str(logpath), top=3,
+      chunkSize=chunkSize)
+    summary = result.summary()
+
+    assert summary['functions']['fact']['calls'] == 6
+    assert summary['functions']['fact']['errors'] == 1
+    assert summary['maxDepth'] == 5
+    assert summary['unmatched'] == 0
+    assert len(summary['slowest']) == 3
+    assert summary['slowest'][0][0] >= summary['slowest'][-1][0]
+
+  assert 'Deepest nesting: 5' in result.report()
+  print_test( 'analyzer summarized the logfile' )
+
+
+def test_pyLogIndex(tmp_path):
+  r'''
+  Test that the sidecar index written with the logfile finds the records of
+  a call, of a function and of a span of time.
+  '''
+
+  import logging
+  from time import time
+
+  decorator = pyDecorator.pyDecorator
+  indexed = pyLogIndex.pyLogIndex
+  logpath = str(tmp_path / 'indexed')
+
+  handler = indexed.install(logpath)
+  echo = decorator.getEcho()
+  decorator.setEcho(False)
+  try:
+    @decorator
+    def double(value):
+      return value * 2
+
+    @decorator
+    def triple(value):
+      return value * 3
+
+    started = time()
+    for value in range(20):
+      double(value)
+      triple(value)
+    ended = time()
+    number = decorator._state().nextNumber - 2
+
+  finally:
+    decorator.setEcho(echo)
+    logging.getLogger().removeHandler(handler)
+    handler.close()
+
+  index = indexed(logpath)
+  try:
+    assert len(index) == 80
+    assert sorted(index.names) == ['double', 'triple']
+
+    text = index.call(number)
+    assert text.count('[Call#%03i]' % number) == 2
+    assert 'Starting call to double' in text
+    assert 'Returned 38' in text
+    print_test( 'index found the records of one call' )
+
+    starts = list(index.function('triple'))
+    assert len(starts) == 20
+    assert all( 'Starting call to triple' in each for each in starts )
+    assert len(list(index.between(started, ended))) == 80
+    assert list(index.between(0, started - 1)) == []
+    print_test( 'index found the calls of a function and of a time span' )
+  finally:
+    index.close()
+
+  # Times going backwards, as when the clock is stepped, are still found
+  handler = pyLogIndex.pyIndexedFileHandler(logpath)
+  try:
+    for callNumber, created in ((900, 100.0), (901, 50.0), (902, 75.0)):
+      record = logging.LogRecord('test', logging.INFO, __file__, 0,
+        '>>Starting call to stepped [Call#%i]', (callNumber,), None)
+      record.created = created
+      handler.emit(record)
+    handler.flush()
+
+    index = indexed(logpath)
+    try:
+      assert len(index) == 83
+      assert index.positionsBetween(60.0, 100.0) == [80, 82]
+      assert index.positionsOfFunction('stepped') == [80, 81, 82]
+      assert 'Call#901' in index.call(901)
+    finally:
+      index.close()
+  finally:
+    handler.close()
+  print_test( 'index found records logged while the clock went back' )
+
+  from os.path import getsize
+
+  def emitAll(handler, records):
+    for text, callNumber in records:
+      record = logging.LogRecord('test', logging.INFO, __file__, 0,
+        '>>%s [Call#%i]', (text, callNumber), None)
+      handler.emit(record)
+
+  handler = pyLogIndex.pyIndexedFileHandler(logpath, flushEvery=0)
+  try:
+    size = getsize(logpath)
+    emitAll(handler, [ ('Starting call to outer', 1000),
+      ('Starting call to inner', 1001), ('Ended call to inner', 1001),
+      ('Ended call to outer', 1000) ])
+    assert getsize(logpath) == size
+    print_test( 'call records are not flushed one by one' )
+    emitAll(handler, [ ('Starting call to many', 2000 + each)
+      for each in range(600) ])
+  finally:
+    handler.close()
+
+  index = indexed(logpath)
+  try:
+    assert index.positionsOfCall(1000) == [83, 86]
+    assert index.call(1000).count('Call#1000') == 2
+    assert len(index.positionsOfFunction('many')) == 600
+    assert index.positionsOfFunction('outer') == [83, 86]
+    print_test( 'index found calls out of order and functions in blocks' )
+  finally:
+    index.close()
+
+  # A table of the last blocks cut short is found by walking the blocks
+  with open(logpath + '.idx.functions', 'r+b') as functions:
+    functions.truncate(getsize(logpath + '.idx.functions') - 3)
+  index = indexed(logpath)
+  try:
+    assert len(index.positionsOfFunction('many')) == 600
+    assert index.positionsOfFunction('stepped') == [80, 81, 82]
+  finally:
+    index.close()
+  print_test( 'index found functions without a whole table' )
+
+  with open(logpath + '.idx', 'r+b') as corrupt:
+    corrupt.write(b'not an index at all')
+  for opening in (indexed, pyLogIndex.pyIndexedFileHandler):
+    try:
+      opening(logpath)
+    except ValueError:
+      pass
+    else:
+      assert False, 'opened an index of another format'
+  print_test( 'an index of another format is refused' )
+
+
+def test_pyTraceDiff(tmp_path):
+  r'''
+  Test that comparing two traces flags a significant slowdown, ignores an
+  unchanged function and reports the calls that appeared.
+  '''
+
+  from random import Random
+
+  differ = pyTraceDiff.pyTraceDiff
+  histogram = pyHistogram.pyHistogram
+  random = Random(7)
+
+  def trace(name, seconds):
+    latency = histogram(name)
+    for each in seconds:
+      latency.record(each)
+    snap = latency.snapshot()
+    snap['counts'] = dict( (str(index), count)
+      for index, count in enumerate(snap['counts']) if count )
+    return snap
+
+  def run(slowdown, edges):
+    return { 'version': 1, 'errors': {}, 'edges': edges, 'functions': {
+      'parse': trace('parse',
+        [ random.uniform(1e-3, 2e-3) * slowdown for each in range(500) ]),
+      'steady': trace('steady',
+        [ random.uniform(1e-3, 2e-3) for each in range(500) ]) } }
+
+  before = run(1.0, [['', 'parse', 500], ['', 'steady', 500]])
+  after = run(1.3, [['', 'parse', 500], ['', 'steady', 500],
+    ['parse', 'steady', 250]])
+
+  diff = differ.compare(before, after, threshold=0.1)
+  assert diff['regressions'] == ['parse']
+  assert diff['functions']['parse']['pValue'] < 1e-6
+  assert diff['functions']['parse']['slower'] > 0.5
+  assert not diff['functions']['steady']['regressed']
+  assert diff['edges']['added'] == [('parse', 'steady', 0, 250)]
+  assert differ.compare(before, after, threshold=0.5)['regressions'] == []
+  assert '! parse' in differ.report(diff)
+  print_test( 'trace diff flagged the slower function only' )
+
+  # A trace captured through the hook survives saving and loading
+  hook = differ()
+  decorator = pyDecorator.pyDecorator
+  decorator.addHook(hook)
+  try:
+    @decorator
+    def outer():
+      inner()
+
+    @decorator
+    def inner():
+      pass
+
+    outer()
+    outer()
+  finally:
+    decorator.removeHook(hook)
+
+  tracePath = str(tmp_path / 'trace.json')
+  hook.save(tracePath)
+  loaded = differ.load(tracePath)
+  edges = [ edge for edge in loaded['edges'] if edge[1].endswith('inner') ]
+  assert len(edges) == 1
+  assert edges[0][0].endswith('outer') and edges[0][2] == 2
+  assert edges[0][1] in loaded['functions']
+  assert differ.compare(loaded, loaded)['regressions'] == []
+  print_test( 'trace diff saved and loaded a captured trace' )
+
+
+def test_pyBudget(tmp_path):
+  r'''
+  Test that the pytest plugin fails a test over its budget, passes the
+  others and writes the summary.
+  '''
+
+  import json
+  import os
+  from os.path import abspath, dirname
+  from subprocess import call
+  from sys import executable
+
+  (tmp_path / 'test_budgets.py').write_text(u'''
+import pytest
+from pyDecorator import pyDecorator
+
+kept = []
+
+@pyDecorator
+def parse(value):
+  kept.append([value] * 1000)
+  return len(kept)
+
+@pytest.mark.pyBudget('parse', maxCalls=5)
+def test_within():
+  for value in range(5):
+    parse(value)
+
+@pytest.mark.pyBudget('parse', maxCalls=5)
+def test_over():
+  for value in range(6):
+    parse(value)
+
+def test_allocations(pyBudget):
+  pyBudget('pars*', maxAllocated=100)
+  for value in range(3):
+    parse(value)
+
+@pyDecorator
+def churn():
+  return len([0] * 100000)
+
+@pyDecorator
+def outer():
+  churn()
+  return len([0] * 10)
+
+def test_peak(pyBudget):
+  pyBudget('outer', maxAllocated=400000)
+  outer()
+''')
+
+  environment = dict(os.environ,
+    PYTHONPATH=dirname(abspath(pyDecorator.__file__)))
+  summaryPath = str(tmp_path / 'summary.json')
+
+  status = call([executable, '-m', 'pytest', '-q', '-p', 'pyBudget',
+    '-p', 'no:cacheprovider', '--budget-summary=' + summaryPath,
+    'test_budgets.py'], cwd=str(tmp_path), env=environment)
+  assert status == 1
+
+  with open(summaryPath) as summary:
+    tests = json.load(summary)['tests']
+
+  within = tests['test_budgets.py::test_within']
+  assert within['violations'] == []
+  assert within['functions']['test_budgets.parse']['calls'] == 5
+  assert tests['test_budgets.py::test_over']['violations'] == \
+    ['test_budgets.parse: 6 calls, budget 5']
+  allocated = tests['test_budgets.py::test_allocations']['functions']
+  assert allocated['test_budgets.parse']['allocated'] > 100
+  assert len(tests['test_budgets.py::test_allocations']['violations']) == 1
+
+  # Nothing is kept, but outer peaked at the list churn made and dropped
+  peaks = tests['test_budgets.py::test_peak']['functions']
+  assert peaks['test_budgets.churn']['allocated'] > 700000
+  assert peaks['test_budgets.outer']['allocated'] > 700000
+  assert len(tests['test_budgets.py::test_peak']['violations']) == 1
+  print_test( 'budget plugin failed the tests over their budgets' )
+
+  status = call([executable, '-m', 'pytest', '-q', '-p', 'pyBudget',
+    '-p', 'no:cacheprovider', '--budget-report-only', 'test_budgets.py'],
+    cwd=str(tmp_path), env=environment)
+  assert status == 0
+  print_test( 'budget plugin only reported with --budget-report-only' )
+
+
+def test_frameBackends(capsys):
+  r'''
+  Test that every frame backend prints the same frames, that the fastest
+  one is picked at import and that without frames the stack features
+  degrade instead of failing.
+  '''
+
+  decorator = pyDecorator.pyDecorator
+  picked = decorator.getFrameBackend()
+  costs = decorator.measureFrameBackends(100)
+
+  assert 'getframe' in costs and 'traceback' in costs
+  assert picked == min(costs, key=costs.get) or picked == 'getframe'
+  assert not decorator.setFrameBackend('bogus')
+  print_test( 'frame backend %s picked at import' % picked )
+
+  def inspected():
+    decorator.printCurFrame()
+    decorator.printCurStack()
+
+  outputs = {}
+  capsys.readouterr()
+  try:
+    for backend in sorted(costs) + ['none']:
+      assert decorator.setFrameBackend(backend)
+      inspected()
+      outputs[backend] = capsys.readouterr()[0]
+  finally:
+    decorator.setFrameBackend(picked)
+
+  assert '>>Function inspected' in outputs['getframe']
+  assert all( outputs[backend] == outputs['getframe'] for backend in costs )
+  assert '>>Function inspected' not in outputs['none']
+  assert 'Frames are not available' in outputs['none']
+  print_test( 'every frame backend printed the same stack' )
+
+
 if __name__ == '__main__':
 
   print( 'Executed directly' )
@@ -113,4 +2050,3 @@ if __name__ == '__main__':
   print( 'Removing logfile' )
   if isfile(logpath):
     remove(logpath)
-